@@ -1,15 +1,107 @@
+"""
+CenaPlus API.
+
+Startup does no I/O beyond what the lifespan tries: the DB connection is opened then
+(and again on first use if that failed or it dropped), so an unreachable DB no longer
+keeps a worker from starting, and /ready reports whether it can serve. The connection
+creates the tables the scrapers fill (promotions, market_stores) if they're missing and
+then runs in autocommit: the API only reads, and a failed query can't leave the shared
+connection in an aborted transaction. The embeddings
+client (langchain) is built on a background thread after startup instead of at import.
+
+/metrics exposes Prometheus metrics (see api_metrics): request latency per route,
+the time of each phase of an endpoint, rows returned and the DB connection's state.
+"""
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
 from enum import Enum
+from uuid import UUID
 import numpy as np
+import psycopg2
 from fastapi import FastAPI, Query, HTTPException
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response
 from psycopg2.extras import RealDictCursor
-from backend.data.db_utils import connect_to_db
+from backend.api_metrics import CONTENT_TYPE, ROWS_RETURNED, Counter, Gauge, MetricsMiddleware, phase, render
+from backend.data.db_utils import connect_to_db, ensure_schema
 from backend.data.constants import CATEGORIES
 from backend.data.text_utils import normalize_name, get_embeddings_client, normalize_embedding
 
-app = FastAPI()
-conn = connect_to_db()
-embeddings_client = get_embeddings_client()
+_conn = None
+_conn_lock = threading.Lock()
+_started_at = time.perf_counter()
+
+# Every request shares the one connection, so queries in flight above 1 are waiting on it
+DB_CONNECTION_UP = Gauge("cenaplus_db_connection_up", "Whether the API's DB connection is open.",
+                         lambda: int(_conn is not None and not _conn.closed))
+DB_QUERIES_IN_FLIGHT = Gauge("cenaplus_db_queries_in_flight", "Queries running or waiting for the DB connection.")
+DB_CONNECTS = Counter("cenaplus_db_connects_total", "Attempts to (re)open the DB connection.", ("outcome",))
+EMBEDDINGS_LOADED = Gauge("cenaplus_embeddings_client_loaded", "Whether the embeddings client has been built.",
+                          lambda: get_embeddings_client.cache_info().currsize)
+
+
+def db():
+    """The API's DB connection, (re)opened on first use after a failure or a dropped connection."""
+    global _conn
+    with _conn_lock:
+        if _conn is None or _conn.closed:
+            conn = None
+            try:
+                conn = connect_to_db()
+                ensure_schema(conn)
+                conn.autocommit = True
+            except psycopg2.Error as e:
+                if conn is not None:
+                    conn.close()
+                DB_CONNECTS.inc("error")
+                raise HTTPException(503, f"Database unavailable: {e}".strip())
+            DB_CONNECTS.inc("ok")
+            _conn = conn
+        return _conn
+
+
+@contextmanager
+def query(route: str):
+    """A RealDictCursor for route's query, timed as its "query" phase."""
+    DB_QUERIES_IN_FLIGHT.inc()
+    try:
+        with phase(route, "query"), db().cursor(cursor_factory=RealDictCursor) as cur:
+            yield cur
+    finally:
+        DB_QUERIES_IN_FLIGHT.dec()
+
+
+def respond(route: str, content) -> JSONResponse:
+    """content encoded as FastAPI would, timed as route's "serialize" phase."""
+    with phase(route, "serialize"):
+        return JSONResponse(jsonable_encoder(content))
+
+
+def warm_up_embeddings():
+    try:
+        start = time.perf_counter()
+        get_embeddings_client()
+        print(f"Embeddings client ready in {time.perf_counter() - start:.2f}s")
+    except Exception as e:  # /search builds it on first use instead
+        print(f"Embeddings client warm-up failed: {e}")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    try:
+        db()
+    except HTTPException as e:
+        print(f"Starting without a database connection: {e.detail}")
+    threading.Thread(target=warm_up_embeddings, name="embeddings-warm-up", daemon=True).start()
+    print(f"API started in {time.perf_counter() - _started_at:.2f}s since import")
+    yield
+    if _conn is not None and not _conn.closed:
+        _conn.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -20,6 +112,7 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware)
 
 
 class PerPage(int, Enum):
@@ -28,6 +121,31 @@ class PerPage(int, Enum):
     thirty_six = 36
 
 
+@app.get("/health")
+def health():
+    """Liveness: the process is up."""
+    return {"status": "ok"}
+
+
+@app.get("/ready")
+def ready():
+    """Readiness: the DB answers (the embeddings client is reported, but /search builds it if needed)."""
+    embeddings = "ready" if get_embeddings_client.cache_info().currsize else "not loaded"
+    try:
+        with db().cursor() as cur:
+            cur.execute("SELECT 1")
+        return {"status": "ready", "database": "ok", "embeddings": embeddings}
+    except (HTTPException, psycopg2.Error) as e:
+        detail = e.detail if isinstance(e, HTTPException) else str(e).strip()
+        return JSONResponse({"status": "unavailable", "database": detail, "embeddings": embeddings}, status_code=503)
+
+
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    """Prometheus scrape endpoint."""
+    return Response(render(), media_type=CONTENT_TYPE)
+
+
 @app.get("/categories")
 def get_categories():
     return {k: v for k, v in CATEGORIES.items()}
@@ -35,10 +153,13 @@ def get_categories():
 
 @app.get("/search")
 def search_products(q: str = Query(..., min_length=1)):
-    normalized = normalize_name(q)
-    vector = normalize_embedding(np.array(embeddings_client.embed_query(normalized))).tolist()
+    route = "/search"
+    with phase(route, "normalize"):
+        normalized = normalize_name(q)
+    with phase(route, "embed"):
+        vector = normalize_embedding(np.array(get_embeddings_client().embed_query(normalized))).tolist()
 
-    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+    with query(route) as cur:
         cur.execute(
             """
             SELECT *, 1 - (name_embedding <=> %s::vector) AS similarity
@@ -50,8 +171,95 @@ def search_products(q: str = Query(..., min_length=1)):
             (vector, vector),
         )
         rows = cur.fetchall()
+    ROWS_RETURNED.observe(len(rows), route)
+
+    return respond(route, {"data": rows})
+
+
+@app.get("/products/{product_id}/stores")
+def get_product_stores(product_id: UUID):
+    """Price and stock of a product in each store of its market, cheapest first."""
+    route = "/products/{product_id}/stores"
+    with query(route) as cur:
+        cur.execute(
+            """
+            SELECT p.id, p.name, p.market, p.price, p.store_prices, p.store_stock, ms.store_ids
+            FROM products p
+            JOIN market_stores ms ON ms.market = p.market
+            WHERE p.id = %s AND p.store_prices IS NOT NULL
+            """,
+            (str(product_id),),
+        )
+        row = cur.fetchone()
+    ROWS_RETURNED.observe(int(row is not None), route)
 
-    return {"data": rows}
+    if row is None:
+        raise HTTPException(404, "No per-store prices for this product")
+
+    # Bit i of store_stock (little-endian) is the i-th store of market_stores
+    stock = int.from_bytes(bytes(row["store_stock"] or b""), "little")
+    stores = [
+        {"store_id": store_id, "price": price, "in_stock": bool(stock >> i & 1)}
+        for i, (store_id, price) in enumerate(zip(row["store_ids"], row["store_prices"]))
+        if price is not None
+    ]
+    stores.sort(key=lambda store: (store["price"], store["store_id"]))
+
+    return respond(route, {
+        "id": row["id"],
+        "name": row["name"],
+        "market": row["market"],
+        "price": row["price"],
+        "stores": stores,
+    })
+
+
+@app.get("/deals/{main_category}/{sub_category}")
+def get_deals(
+    main_category: str,
+    sub_category: str,
+    page: int = Query(1, ge=1),
+    per_page: PerPage = Query(PerPage.twelve),
+    market: list[str] = Query(None),
+):
+    """Products of a sub-category on a running promotion, biggest discount first."""
+    if main_category not in CATEGORIES:
+        raise HTTPException(404, "Main category not found")
+    if sub_category not in CATEGORIES[main_category]:
+        raise HTTPException(404, "Sub-category not found")
+
+    route = "/deals/{main_category}/{sub_category}"
+    offset = per_page.value * (page - 1)
+    with query(route) as cur:
+        cur.execute(
+            """
+            SELECT p.id, p.name, p.market, p.image, p.link, p.singular_price,
+                   pr.regular_price, pr.promo_price, pr.percent, pr.valid_from, pr.valid_to,
+                   COUNT(*) OVER () AS total
+            FROM promotions pr
+            JOIN products p ON p.id = pr.product_id
+            WHERE p.main_category = %s AND p.sub_category = %s
+              AND p.in_stock
+              AND (pr.valid_to IS NULL OR pr.valid_to >= CURRENT_DATE)
+              AND (%s::text[] IS NULL OR p.market = ANY(%s::text[]))
+            ORDER BY pr.percent DESC, p.name
+            LIMIT %s OFFSET %s
+            """,
+            (main_category, sub_category, market, market, per_page.value, offset),
+        )
+        rows = cur.fetchall()
+    ROWS_RETURNED.observe(len(rows), route)
+
+    total = rows[0].pop("total") if rows else 0
+    for row in rows[1:]:
+        row.pop("total")
+
+    return respond(route, {
+        "total": total,
+        "page": page,
+        "per_page": per_page.value,
+        "data": rows,
+    })
 
 
 @app.get("/{main_category}/{sub_category}")
@@ -67,8 +275,9 @@ def get_grouped_products(
     if sub_category not in CATEGORIES[main_category]:
         raise HTTPException(404, "Sub-category not found")
 
+    route = "/{main_category}/{sub_category}"
     offset = per_page.value * (page - 1)
-    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+    with query(route) as cur:
         if market:
             cur.execute(
                 """
@@ -117,12 +326,13 @@ def get_grouped_products(
                 (main_category, sub_category),
             )
             total = cur.fetchone()["count"]
+    ROWS_RETURNED.observe(len(rows), route)
 
-    return {
+    return respond(route, {
         "total": total,
         "page": page,
         "per_page": per_page.value,
         "data": rows,
-    }
+    })
 
 
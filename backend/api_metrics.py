@@ -0,0 +1,189 @@
+"""
+Prometheus metrics of the API, served by /metrics in the text exposition format.
+
+Counters, gauges and fixed-bucket histograms kept in process, without a client
+library: an observation is a bisect and a few increments under a lock, and
+MetricsMiddleware is plain ASGI (no BaseHTTPMiddleware request/response wrapping), so
+the instrumentation costs microseconds per request. With several uvicorn workers each
+keeps its own metrics, like prometheus_client without multiprocess mode.
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+ROW_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 250, 1000)
+
+REGISTRY: List["Metric"] = []
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def format_labels(labels: Sequence[Tuple[str, str]]) -> str:
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n") for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def samples(self) -> Iterator[Tuple[str, Sequence[Tuple[str, str]], float]]:
+        """(sample name, labels, value) of every series."""
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines += [f"{name}{format_labels(labels)} {format_value(value)}" for name, labels, value in self.samples()]
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, *labels: str, value: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + value
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for labels, value in values.items():
+            yield self.name, list(zip(self.labelnames, labels)), value
+
+
+class Gauge(Metric):
+    """A value set by inc() / dec(), or read from `function` at scrape time."""
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, function: Callable[[], float] = None):
+        super().__init__(name, documentation)
+        self.function = function
+        self._value = 0.0
+
+    def inc(self, value: float = 1) -> None:
+        with self._lock:
+            self._value += value
+
+    def dec(self, value: float = 1) -> None:
+        self.inc(-value)
+
+    def samples(self):
+        yield self.name, [], self.function() if self.function else self._value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[tuple, list] = {}  # labels -> [count per bucket (+Inf last), sum]
+
+    def observe(self, value: float, *labels: str) -> None:
+        index = bisect.bisect_left(self.buckets, value)  # First bucket with value <= le
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    @contextmanager
+    def time(self, *labels: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def samples(self):
+        with self._lock:
+            series = {labels: (list(counts), total) for labels, (counts, total) in self._series.items()}
+        for labels, (counts, total) in series.items():
+            label_pairs = list(zip(self.labelnames, labels))
+            cumulative = 0
+            for le, bucket_count in zip((*self.buckets, float("inf")), counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket", label_pairs + [("le", format_value(le))], cumulative
+            yield f"{self.name}_sum", label_pairs, total
+            yield f"{self.name}_count", label_pairs, cumulative
+
+
+def render() -> str:
+    """Every registered metric, as served by /metrics."""
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+REQUEST_SECONDS = Histogram(
+    "cenaplus_http_request_duration_seconds", "Time from receiving a request to sending its response.",
+    ("method", "route", "status"),
+)
+PHASE_SECONDS = Histogram(
+    "cenaplus_request_phase_duration_seconds",
+    "Time spent in each phase of an endpoint (normalize, embed, query, serialize).",
+    ("route", "phase"),
+)
+ROWS_RETURNED = Histogram(
+    "cenaplus_db_rows_returned", "Rows returned by an endpoint's main query.", ("route",), ROW_BUCKETS,
+)
+
+
+def phase(route: str, name: str):
+    """Time one phase of route's handling (a context manager)."""
+    return PHASE_SECONDS.time(route, name)
+
+
+def route_template(scope: dict) -> Optional[str]:
+    """The path template the router matched (e.g. /deals/{main_category}/{sub_category})."""
+    route = scope.get("route")
+    return getattr(route, "path", None)
+
+
+class MetricsMiddleware:
+    """Records every HTTP request's latency by method, route template and status."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = 500  # Unless the app gets to start a response
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # Unmatched paths share one label, so stray URLs can't blow up the series count
+            REQUEST_SECONDS.observe(time.perf_counter() - start, scope["method"],
+                                    route_template(scope) or "unmatched", str(status))
@@ -1,16 +1,108 @@
 import asyncio
+import os
+import sqlite3
+import tempfile
+import threading
 import time
 from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
 from typing import Tuple
 
 
-class RateLimiter:
+class AdaptiveLimitsMixin:
+    """
+    AIMD adjustment of a limiter's effective rpm_limit / tpm_limit from API feedback.
+
+    - report_throttled(): multiplicative decrease when the API answers 429
+      (at most once per THROTTLE_COOLDOWN, since one burst produces many 429s)
+    - probing: while requests keep hitting the current limit and nothing was throttled
+      for PROBE_INTERVAL seconds, limits grow additively towards the configured ceiling
+    - record_usage(): replaces a request's estimated tokens with what the API reported
+
+    Limits only move when the limiter was created with adaptive=True. SharedRateLimiter
+    keeps them in its database instead, so every process sharing the window adapts together.
+    """
+
+    DECREASE_FACTOR = 0.7
+    INCREASE_STEP = 0.02  # Fraction of the ceiling added per probe
+    PROBE_INTERVAL = 10.0
+    THROTTLE_COOLDOWN = 5.0
+    MIN_FRACTION = 0.1  # Never go below this fraction of the ceiling
+    PROBE_USAGE = 0.9  # Only probe when the window is this close to a limit
+
+    def _init_adaptive(self, adaptive: bool, max_rpm_limit: int = None, max_tpm_limit: int = None):
+        self.adaptive = adaptive
+        self.max_rpm_limit = max(max_rpm_limit or self.rpm_limit, self.rpm_limit)
+        self.max_tpm_limit = max(max_tpm_limit or self.tpm_limit, self.tpm_limit)
+        self.throttle_count = 0
+        self.token_correction = 0  # Sum of (actual - estimated) tokens reported
+        self._last_throttle = 0.0
+        self._last_probe = time.monotonic()
+        self._adapt_lock = threading.Lock()
+
+    def report_throttled(self):
+        """Call when the API rejected a request for exceeding the quota."""
+        with self._adapt_lock:
+            self.throttle_count += 1
+            now = time.monotonic()
+            if not self.adaptive or now - self._last_throttle < self.THROTTLE_COOLDOWN:
+                return
+            self._last_throttle = now
+            self._last_probe = now
+            self.rpm_limit, self.tpm_limit = self._lowered(self.rpm_limit, self.tpm_limit)
+        print(f"📉 Throttled by API, lowering limits to RPM {self.rpm_limit}, TPM {self.tpm_limit:,}")
+
+    def _lowered(self, rpm_limit: int, tpm_limit: int) -> Tuple[int, int]:
+        return (max(int(rpm_limit * self.DECREASE_FACTOR), int(self.max_rpm_limit * self.MIN_FRACTION), 1),
+                max(int(tpm_limit * self.DECREASE_FACTOR), int(self.max_tpm_limit * self.MIN_FRACTION), 1))
+
+    def _raised(self, rpm_limit: int, tpm_limit: int) -> Tuple[int, int]:
+        return (min(self.max_rpm_limit, rpm_limit + max(1, int(self.max_rpm_limit * self.INCREASE_STEP))),
+                min(self.max_tpm_limit, tpm_limit + max(1, int(self.max_tpm_limit * self.INCREASE_STEP))))
+
+    def _near_limit(self, rpm_used: int, tpm_used: int, rpm_limit: int, tpm_limit: int) -> bool:
+        return rpm_used >= rpm_limit * self.PROBE_USAGE or tpm_used >= tpm_limit * self.PROBE_USAGE
+
+    def _maybe_probe(self, rpm_used: int, tpm_used: int):
+        if not self.adaptive:
+            return
+        with self._adapt_lock:
+            now = time.monotonic()
+            if now - self._last_probe < self.PROBE_INTERVAL or now - self._last_throttle < self.PROBE_INTERVAL:
+                return
+            self._last_probe = now
+            if self._near_limit(rpm_used, tpm_used, self.rpm_limit, self.tpm_limit):
+                self.rpm_limit, self.tpm_limit = self._raised(self.rpm_limit, self.tpm_limit)
+
+    def get_limits(self) -> dict:
+        """Current effective limits, for logging or exporting to a run summary."""
+        return {
+            'adaptive': self.adaptive,
+            'rpm_limit': self.rpm_limit,
+            'tpm_limit': self.tpm_limit,
+            'max_rpm_limit': self.max_rpm_limit,
+            'max_tpm_limit': self.max_tpm_limit,
+            'throttle_count': self.throttle_count,
+            'token_correction': self.token_correction,
+        }
+
+
+class RateLimiter(AdaptiveLimitsMixin):
     """
     Token-aware rate limiter for API calls.
     Tracks requests per minute (RPM) and tokens per minute (TPM).
+
+    Usage inside the 60-second window is kept as running totals that are updated
+    when entries are added or expire, so checking the budget is O(1) amortized.
+    The lock is only held while checking/recording; waiters sleep without it until
+    the exact moment enough of the window expires for their request.
     """
 
-    def __init__(self, rpm_limit: int = 1900, tpm_limit: int = 3800000):
+    WINDOW_SECONDS = 60
+
+    def __init__(self, rpm_limit: int = 1900, tpm_limit: int = 3800000, adaptive: bool = False,
+                 max_rpm_limit: int = None, max_tpm_limit: int = None):
         """
         Initialize rate limiter with conservative limits.
 
@@ -18,34 +110,75 @@ class RateLimiter:
         - 2,000 RPM
         - 4,000,000 TPM
 
-        We use 1900/3.8m to leave a safety buffer.
+        We use 1900/3.8m to leave a safety buffer. With adaptive=True these are the
+        starting limits and max_rpm_limit / max_tpm_limit the ceiling to probe up to.
         """
         self.rpm_limit = rpm_limit
         self.tpm_limit = tpm_limit
 
         self.request_times = deque()  # Timestamps of requests
         self.token_times = deque()  # (timestamp, token_count) tuples
+        self.tokens_in_window = 0  # Running sum of token_times
 
         self.lock = asyncio.Lock()
         self.total_requests = 0
         self.total_tokens = 0
+        self._init_adaptive(adaptive, max_rpm_limit, max_tpm_limit)
 
-    def _clean_old_entries(self):
+    def _clean_old_entries(self, now: float = None):
         """Remove entries older than 60 seconds."""
-        cutoff = time.time() - 60
+        cutoff = (now if now is not None else time.monotonic()) - self.WINDOW_SECONDS
 
         while self.request_times and self.request_times[0] < cutoff:
             self.request_times.popleft()
 
         while self.token_times and self.token_times[0][0] < cutoff:
-            self.token_times.popleft()
+            _, tokens = self.token_times.popleft()
+            self.tokens_in_window -= tokens
 
-    def _get_current_usage(self) -> Tuple[int, int]:
+    def _get_current_usage(self, now: float = None) -> Tuple[int, int]:
         """Get current RPM and TPM usage in the last 60 seconds."""
-        self._clean_old_entries()
-        rpm_used = len(self.request_times)
-        tpm_used = sum(tokens for _, tokens in self.token_times)
-        return rpm_used, tpm_used
+        self._clean_old_entries(now)
+        return len(self.request_times), self.tokens_in_window
+
+    def _fits(self, rpm_used: int, tpm_used: int, estimated_tokens: int) -> bool:
+        # A request larger than the whole TPM budget is let through on an empty window
+        return rpm_used < self.rpm_limit and (
+            tpm_used + estimated_tokens < self.tpm_limit or tpm_used == 0
+        )
+
+    def _seconds_until_available(self, estimated_tokens: int, now: float) -> float:
+        """How long until enough of the window expires for this request (0 if it fits now)."""
+        rpm_used, tpm_used = self._get_current_usage(now)
+        if self._fits(rpm_used, tpm_used, estimated_tokens):
+            return 0.0
+
+        wait_until = now
+        if rpm_used >= self.rpm_limit:
+            # The request that has to expire for us to be under the limit
+            index = rpm_used - self.rpm_limit
+            wait_until = max(wait_until, self.request_times[index] + self.WINDOW_SECONDS)
+
+        if tpm_used + estimated_tokens >= self.tpm_limit:
+            to_free = tpm_used + estimated_tokens - self.tpm_limit + 1
+            freed = 0
+            for timestamp, tokens in self.token_times:
+                freed += tokens
+                if freed >= to_free:
+                    wait_until = max(wait_until, timestamp + self.WINDOW_SECONDS)
+                    break
+            else:
+                wait_until = max(wait_until, self.token_times[-1][0] + self.WINDOW_SECONDS)
+
+        # Small margin so the entry is really out of the window when we wake up
+        return wait_until - now + 0.01
+
+    def _record(self, estimated_tokens: int, now: float):
+        self.request_times.append(now)
+        self.token_times.append((now, estimated_tokens))
+        self.tokens_in_window += estimated_tokens
+        self.total_requests += 1
+        self.total_tokens += estimated_tokens
 
     async def acquire(self, estimated_tokens: int):
         """
@@ -54,46 +187,313 @@ class RateLimiter:
         Args:
             estimated_tokens: Estimated tokens for the upcoming request
         """
-        async with self.lock:
-            while True:
-                rpm_used, tpm_used = self._get_current_usage()
-
-                # Check if we can make this request
-                if (rpm_used < self.rpm_limit and
-                        tpm_used + estimated_tokens < self.tpm_limit):
-                    # Record this request
-                    now = time.time()
-                    self.request_times.append(now)
-                    self.token_times.append((now, estimated_tokens))
+        while True:
+            async with self.lock:
+                now = time.monotonic()
+                wait_time = self._seconds_until_available(estimated_tokens, now)
+                if wait_time <= 0:
+                    self._record(estimated_tokens, now)
+                    self._maybe_probe(len(self.request_times), self.tokens_in_window)
+                    return
+                rpm_used, tpm_used = len(self.request_times), self.tokens_in_window
+
+            print(f"⏳ Rate limit: RPM {rpm_used}/{self.rpm_limit}, "
+                  f"TPM {tpm_used:,}/{self.tpm_limit:,}. "
+                  f"Waiting {wait_time:.1f}s...")
+            await asyncio.sleep(wait_time)
+
+    def record_usage(self, estimated_tokens: int, actual_tokens: int):
+        """Correct the window with the tokens the API actually counted for a request."""
+        delta = actual_tokens - estimated_tokens
+        if not delta:
+            return
+        # The correction expires from the window like any other entry
+        self.token_times.append((time.monotonic(), delta))
+        self.tokens_in_window += delta
+        self.total_tokens += delta
+        self.token_correction += delta
+
+    def get_stats(self) -> dict:
+        """Get usage statistics."""
+        rpm_used, tpm_used = self._get_current_usage()
+        return {
+            'total_requests': self.total_requests,
+            'total_tokens': self.total_tokens,
+            'current_rpm': rpm_used,
+            'current_tpm': tpm_used,
+            **self.get_limits()
+        }
+
+
+class SharedRateLimiter(AdaptiveLimitsMixin):
+    """
+    Rate limiter whose 60-second window is shared by every thread and process on the host.
+
+    Usage is stored in a small SQLite database (WAL mode); each check-and-record runs in
+    an IMMEDIATE transaction, so concurrent scrapers and pipeline stages draw from one
+    Gemini budget instead of each assuming they have the full quota. Limiters with the
+    same `name` share a window, so use one name per quota (i.e. per model).
+
+    With adaptive=True the effective limits live in the database too (adaptive_limits):
+    a 429 reported by one process lowers the limits of all of them, and probing back up
+    is paced host-wide. Limits nobody touched for LIMITS_TTL start over from the
+    configured ones.
+
+    Works from asyncio (`await acquire(...)`) and from plain threads (`acquire_sync(...)`).
+    """
+
+    WINDOW_SECONDS = 60
+    LIMITS_TTL = 600.0
+    DEFAULT_PATH = Path(
+        os.getenv("CENAPLUS_RATE_LIMIT_DB", Path(tempfile.gettempdir()) / "cenaplus_rate_limits.sqlite")
+    )
+
+    def __init__(self, name: str, rpm_limit: int = 1900, tpm_limit: int = 3800000, path: Path = None,
+                 adaptive: bool = False, max_rpm_limit: int = None, max_tpm_limit: int = None):
+        self.name = name
+        self.rpm_limit = rpm_limit
+        self.tpm_limit = tpm_limit
+        self.path = Path(path) if path else self.DEFAULT_PATH
+
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self.total_requests = 0
+        self.total_tokens = 0
+        self._init_adaptive(adaptive, max_rpm_limit, max_tpm_limit)
+
+        with self._transaction() as db:
+            columns = [row[1] for row in db.execute("PRAGMA table_info(usage)")]
+            if columns and "requests" not in columns:
+                # Window from an older layout without correction entries; it only covers a minute, so drop it
+                db.execute("DROP TABLE usage")
+                db.execute("DROP TABLE IF EXISTS window_totals")
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS usage (
+                    limiter TEXT NOT NULL,
+                    ts REAL NOT NULL,
+                    requests INTEGER NOT NULL,
+                    tokens INTEGER NOT NULL
+                )
+            """)
+            db.execute("CREATE INDEX IF NOT EXISTS usage_limiter_ts ON usage (limiter, ts)")
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS window_totals (
+                    limiter TEXT PRIMARY KEY,
+                    requests INTEGER NOT NULL,
+                    tokens INTEGER NOT NULL
+                )
+            """)
+            db.execute(
+                "INSERT OR IGNORE INTO window_totals (limiter, requests, tokens) VALUES (?, 0, 0)",
+                (self.name,),
+            )
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS adaptive_limits (
+                    limiter TEXT PRIMARY KEY,
+                    rpm_limit INTEGER NOT NULL,
+                    tpm_limit INTEGER NOT NULL,
+                    last_throttle REAL NOT NULL,
+                    last_probe REAL NOT NULL
+                )
+            """)
+            if adaptive:
+                # Probing touches last_probe every PROBE_INTERVAL while the limiter is in use
+                now = time.time()
+                db.execute("""
+                    INSERT INTO adaptive_limits (limiter, rpm_limit, tpm_limit, last_throttle, last_probe)
+                    VALUES (?, ?, ?, 0, ?)
+                    ON CONFLICT (limiter) DO UPDATE SET
+                        rpm_limit = excluded.rpm_limit, tpm_limit = excluded.tpm_limit,
+                        last_throttle = 0, last_probe = excluded.last_probe
+                    WHERE max(adaptive_limits.last_throttle, adaptive_limits.last_probe) < ?
+                """, (self.name, rpm_limit, tpm_limit, now, now - self.LIMITS_TTL))
+                self._load_limits(db)
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3 connections can't be shared between threads, so keep one per thread
+        db = getattr(self._local, "db", None)
+        if db is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    @contextmanager
+    def _transaction(self):
+        db = self._connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def _clean_old_entries(self, db: sqlite3.Connection, now: float):
+        cutoff = now - self.WINDOW_SECONDS
+        expired_requests, expired_tokens = db.execute(
+            "SELECT COALESCE(SUM(requests), 0), COALESCE(SUM(tokens), 0) FROM usage WHERE limiter = ? AND ts < ?",
+            (self.name, cutoff),
+        ).fetchone()
+        if expired_requests or expired_tokens:
+            db.execute("DELETE FROM usage WHERE limiter = ? AND ts < ?", (self.name, cutoff))
+            db.execute(
+                "UPDATE window_totals SET requests = requests - ?, tokens = tokens - ? WHERE limiter = ?",
+                (expired_requests, expired_tokens, self.name),
+            )
 
+    def _load_limits(self, db: sqlite3.Connection) -> Tuple[float, float]:
+        """Take the host-wide effective limits; returns (last throttle, last probe) wall-clock times."""
+        row = db.execute(
+            "SELECT rpm_limit, tpm_limit, last_throttle, last_probe FROM adaptive_limits WHERE limiter = ?",
+            (self.name,),
+        ).fetchone()
+        self.rpm_limit, self.tpm_limit, last_throttle, last_probe = row
+        return last_throttle, last_probe
+
+    def report_throttled(self):
+        """Call when the API rejected a request for exceeding the quota; lowers the limits host-wide."""
+        with self._stats_lock:
+            self.throttle_count += 1
+        if not self.adaptive:
+            return
+        now = time.time()
+        with self._transaction() as db:
+            last_throttle, _ = self._load_limits(db)
+            if now - last_throttle < self.THROTTLE_COOLDOWN:
+                return
+            self.rpm_limit, self.tpm_limit = self._lowered(self.rpm_limit, self.tpm_limit)
+            db.execute(
+                "UPDATE adaptive_limits SET rpm_limit = ?, tpm_limit = ?, last_throttle = ?, last_probe = ? WHERE limiter = ?",
+                (self.rpm_limit, self.tpm_limit, now, now, self.name),
+            )
+        print(f"📉 Throttled by API [{self.name}], lowering limits to RPM {self.rpm_limit}, TPM {self.tpm_limit:,}")
+
+    def _probe(self, db: sqlite3.Connection, now: float, last_throttle: float, last_probe: float,
+               rpm_used: int, tpm_used: int):
+        """Shared-database counterpart of _maybe_probe, inside the acquire transaction."""
+        if now - last_probe < self.PROBE_INTERVAL or now - last_throttle < self.PROBE_INTERVAL:
+            return
+        if self._near_limit(rpm_used, tpm_used, self.rpm_limit, self.tpm_limit):
+            self.rpm_limit, self.tpm_limit = self._raised(self.rpm_limit, self.tpm_limit)
+        db.execute(
+            "UPDATE adaptive_limits SET rpm_limit = ?, tpm_limit = ?, last_probe = ? WHERE limiter = ?",
+            (self.rpm_limit, self.tpm_limit, now, self.name),
+        )
+
+    def _get_current_usage(self, db: sqlite3.Connection, now: float) -> Tuple[int, int]:
+        self._clean_old_entries(db, now)
+        return db.execute(
+            "SELECT requests, tokens FROM window_totals WHERE limiter = ?", (self.name,)
+        ).fetchone()
+
+    def _try_acquire(self, estimated_tokens: int) -> Tuple[float, int, int]:
+        """Record the request if it fits. Returns (seconds to wait, rpm used, tpm used); 0 wait = acquired."""
+        # Wall clock, not monotonic: timestamps are compared across processes
+        now = time.time()
+        with self._transaction() as db:
+            if self.adaptive:
+                last_throttle, last_probe = self._load_limits(db)
+            rpm_used, tpm_used = self._get_current_usage(db, now)
+            fits = rpm_used < self.rpm_limit and (
+                tpm_used + estimated_tokens < self.tpm_limit or tpm_used == 0
+            )
+            if fits:
+                db.execute(
+                    "INSERT INTO usage (limiter, ts, requests, tokens) VALUES (?, ?, 1, ?)",
+                    (self.name, now, estimated_tokens),
+                )
+                db.execute(
+                    "UPDATE window_totals SET requests = requests + 1, tokens = tokens + ? WHERE limiter = ?",
+                    (estimated_tokens, self.name),
+                )
+                with self._stats_lock:
                     self.total_requests += 1
                     self.total_tokens += estimated_tokens
-                    return
+                if self.adaptive:
+                    self._probe(db, now, last_throttle, last_probe, rpm_used + 1, tpm_used + estimated_tokens)
+                return 0.0, rpm_used + 1, tpm_used + estimated_tokens
+
+            wait_until = now
+            if rpm_used >= self.rpm_limit:
+                row = db.execute(
+                    "SELECT ts FROM usage WHERE limiter = ? AND requests = 1 ORDER BY ts LIMIT 1 OFFSET ?",
+                    (self.name, rpm_used - self.rpm_limit),
+                ).fetchone()
+                if row:
+                    wait_until = max(wait_until, row[0] + self.WINDOW_SECONDS)
+
+            if tpm_used + estimated_tokens >= self.tpm_limit:
+                to_free = tpm_used + estimated_tokens - self.tpm_limit + 1
+                freed = 0
+                for ts, tokens in db.execute(
+                    "SELECT ts, tokens FROM usage WHERE limiter = ? ORDER BY ts", (self.name,)
+                ):
+                    freed += tokens
+                    wait_until = max(wait_until, ts + self.WINDOW_SECONDS)
+                    if freed >= to_free:
+                        break
+
+            return max(wait_until - now, 0.0) + 0.01, rpm_used, tpm_used
+
+    def _report_wait(self, wait_time: float, rpm_used: int, tpm_used: int):
+        print(f"⏳ Rate limit [{self.name}]: RPM {rpm_used}/{self.rpm_limit}, "
+              f"TPM {tpm_used:,}/{self.tpm_limit:,}. "
+              f"Waiting {wait_time:.1f}s...")
 
-                # Calculate wait time
-                wait_time = 1.0
+    def acquire_sync(self, estimated_tokens: int):
+        """Blocking acquire for threads and synchronous code."""
+        while True:
+            wait_time, rpm_used, tpm_used = self._try_acquire(estimated_tokens)
+            if wait_time <= 0:
+                return
+            self._report_wait(wait_time, rpm_used, tpm_used)
+            time.sleep(wait_time)
 
-                if rpm_used >= self.rpm_limit and self.request_times:
-                    oldest = self.request_times[0]
-                    wait_time = max(wait_time, 60 - (time.time() - oldest) + 0.2)
+    async def acquire(self, estimated_tokens: int):
+        """
+        Wait until we can make a request without exceeding rate limits.
 
-                if tpm_used + estimated_tokens >= self.tpm_limit and self.token_times:
-                    oldest_token_time = self.token_times[0][0]
-                    wait_time = max(wait_time, 60 - (time.time() - oldest_token_time) + 0.2)
+        Args:
+            estimated_tokens: Estimated tokens for the upcoming request
+        """
+        while True:
+            # The transaction may wait on another process's lock, so keep it off the event loop
+            wait_time, rpm_used, tpm_used = await asyncio.to_thread(self._try_acquire, estimated_tokens)
+            if wait_time <= 0:
+                return
+            self._report_wait(wait_time, rpm_used, tpm_used)
+            await asyncio.sleep(wait_time)
 
-                print(f"⏳ Rate limit: RPM {rpm_used}/{self.rpm_limit}, "
-                      f"TPM {tpm_used:,}/{self.tpm_limit:,}. "
-                      f"Waiting {wait_time:.1f}s...")
-                await asyncio.sleep(wait_time)
+    def record_usage(self, estimated_tokens: int, actual_tokens: int):
+        """Correct the shared window with the tokens the API actually counted for a request."""
+        delta = actual_tokens - estimated_tokens
+        if not delta:
+            return
+        with self._transaction() as db:
+            # A request-less entry that expires from the window like any other
+            db.execute(
+                "INSERT INTO usage (limiter, ts, requests, tokens) VALUES (?, ?, 0, ?)",
+                (self.name, time.time(), delta),
+            )
+            db.execute(
+                "UPDATE window_totals SET tokens = tokens + ? WHERE limiter = ?",
+                (delta, self.name),
+            )
+        with self._stats_lock:
+            self.total_tokens += delta
+            self.token_correction += delta
 
     def get_stats(self) -> dict:
-        """Get usage statistics."""
-        rpm_used, tpm_used = self._get_current_usage()
+        """Get usage statistics (totals are for this process, current usage is host-wide)."""
+        with self._transaction() as db:
+            rpm_used, tpm_used = self._get_current_usage(db, time.time())
         return {
             'total_requests': self.total_requests,
             'total_tokens': self.total_tokens,
             'current_rpm': rpm_used,
             'current_tpm': tpm_used,
-            'rpm_limit': self.rpm_limit,
-            'tpm_limit': self.tpm_limit
+            **self.get_limits()
         }
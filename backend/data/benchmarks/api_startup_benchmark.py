@@ -0,0 +1,63 @@
+"""
+Import time of the API process, per module.
+
+Runs `python -X importtime -c "import backend.api"` in fresh interpreters and reports
+the total and the modules with the largest cumulative import time (the module plus
+everything it pulled in first), i.e. what every new uvicorn worker pays before it can
+serve. --module measures another entry point the same way.
+
+    python -m backend.data.benchmarks.api_startup_benchmark --top 15 --depth 2
+"""
+import argparse
+import re
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+from backend.data.run_scrapers import PROJECT_ROOT
+
+IMPORT_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)$")
+
+
+def import_times(module: str) -> List[Tuple[str, int, int, int]]:
+    """(module, depth, self µs, cumulative µs) in import order, from a fresh interpreter."""
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                         cwd=PROJECT_ROOT, capture_output=True, text=True, check=True)
+    rows = []
+    for line in out.stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if match:
+            own, cumulative, indent, name = match.groups()
+            rows.append((name, len(indent) // 2, int(own), int(cumulative)))
+    return rows
+
+
+def best_of(module: str, repeat: int) -> Dict[str, Tuple[int, int]]:
+    """name -> (depth, best cumulative µs) over `repeat` runs."""
+    best: Dict[str, Tuple[int, int]] = {}
+    for _ in range(repeat):
+        for name, depth, _, cumulative in import_times(module):
+            if name not in best or cumulative < best[name][1]:
+                best[name] = (depth, cumulative)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report per-module import time of the API.")
+    parser.add_argument("--module", default="backend.api", help="Module to import")
+    parser.add_argument("--repeat", type=int, default=3, help="Best of N fresh interpreters")
+    parser.add_argument("--top", type=int, default=15, help="Modules to list")
+    parser.add_argument("--depth", type=int, default=2, help="Only list modules imported at most this deep")
+    args = parser.parse_args()
+
+    times = best_of(args.module, args.repeat)
+    total = times[args.module][1] if args.module in times else sum(c for d, c in times.values() if d == 0)
+    print(f"import {args.module}: {total / 1e6:.3f}s ({len(times)} modules)")
+
+    listed = sorted(((c, d, name) for name, (d, c) in times.items() if 0 < d <= args.depth), reverse=True)
+    for cumulative, depth, name in listed[:args.top]:
+        print(f"  {'  ' * (depth - 1)}{name:<{50 - 2 * (depth - 1)}} {cumulative / 1e3:8.1f} ms  {cumulative / total:6.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Compare categorization strategies on a fixed product sample.
+
+Runs the same sample through the two-stage flow and the joint single-call mode,
+and reports requests, tokens and wall time.
+Nothing is written to the database.
+
+    python -m backend.data.benchmarks.categorization_benchmark --sample 500
+"""
+import argparse
+import asyncio
+import copy
+import json
+import time
+
+from backend.data import categorize_products as cp
+from backend.data.db_utils import connect_to_db
+from psycopg2.extras import RealDictCursor
+
+STRATEGIES = {
+    "two_stage": {"mode": "two_stage"},
+    "joint": {"mode": "joint"},
+}
+
+
+def load_sample(size: int) -> list:
+    """Deterministic sample: the first `size` products ordered by id."""
+    conn = connect_to_db()
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    cur.execute("SELECT id, name, description, market FROM products ORDER BY id LIMIT %s", (size,))
+    sample = [
+        {
+            "id": row["id"],
+            "name": row["name"],
+            "description": row["description"] or "",
+            "existing_categories": row["description"] or "",
+            "market": row["market"],
+        }
+        for row in cur.fetchall()
+    ]
+    cur.close()
+    conn.close()
+    return sample
+
+
+async def run_strategy(name: str, sample: list, batch_size: int, concurrency: int) -> dict:
+    products = copy.deepcopy(sample)
+    usage_before = dict(cp.token_usage)
+    requests_before = cp.rate_limiter.total_requests
+
+    start = time.perf_counter()
+    await cp.categorize_all_products(
+        products, batch_size=batch_size, concurrency=concurrency, **STRATEGIES[name]
+    )
+    elapsed = time.perf_counter() - start
+
+    return {
+        "strategy": name,
+        "products": len(products),
+        "requests": cp.rate_limiter.total_requests - requests_before,
+        "prompt_tokens": cp.token_usage["prompt_tokens"] - usage_before["prompt_tokens"],
+        "output_tokens": cp.token_usage["output_tokens"] - usage_before["output_tokens"],
+        "wall_seconds": round(elapsed, 2),
+        "categories": {str(p["id"]): (p["categorization"]["main_category"], p["categorization"]["sub_category"]) for p in products},
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Benchmark categorization strategies.")
+    parser.add_argument("--sample", type=int, default=500, help="Number of products in the fixed sample")
+    parser.add_argument("--batch-size", type=int, default=cp.MAX_BATCH_SIZE, help="Maximum products per batch")
+    parser.add_argument("--concurrency", type=int, default=128)
+    parser.add_argument("--strategies", nargs="+", choices=list(STRATEGIES), default=list(STRATEGIES))
+    parser.add_argument("--output", help="Optional JSON file for the results")
+    args = parser.parse_args()
+
+    sample = load_sample(args.sample)
+    print(f"Loaded fixed sample of {len(sample)} products")
+
+    results = []
+    for name in args.strategies:
+        results.append(await run_strategy(name, sample, args.batch_size, args.concurrency))
+
+    baseline = results[0]["categories"]
+    print(f"\n{'strategy':<22} {'requests':>9} {'in tokens':>11} {'out tokens':>11} {'wall s':>8} {'agree':>7}")
+    for r in results:
+        agree = sum(1 for k, v in r["categories"].items() if baseline.get(k) == v) / max(len(baseline), 1)
+        r["agreement_with_first"] = round(agree, 3)
+        print(
+            f"{r['strategy']:<22} {r['requests']:>9,} {r['prompt_tokens']:>11,} "
+            f"{r['output_tokens']:>11,} {r['wall_seconds']:>8} {agree:>7.1%}"
+        )
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump([{k: v for k, v in r.items() if k != "categories"} for r in results], f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,296 @@
+"""
+Benchmark of Kam price list extraction: the camelot lattice -> stream -> pdfplumber
+cascade vs the single-pass pdfium extractor in kam_pdf_utils.
+
+Reports pages/second and accuracy for each. PDFs come from --fixtures, a directory
+of saved Kam PDFs (e.g. curl -O https://kam.com.mk/2025/11/25/73.pdf), where accuracy
+is agreement with the cascade; or they are generated with the Kam table layout,
+where accuracy is against the generated products. Generated price lists have their
+header on the first page only unless --repeat-header is given, and are ruled with
+lines, or with a rectangle per cell with --rect-borders.
+
+    python -m backend.data.benchmarks.kam_pdf_benchmark --pdfs 4 --rows 1500
+    python -m backend.data.benchmarks.kam_pdf_benchmark --fixtures ~/kam-pdfs --page-workers 4
+"""
+import argparse
+import contextlib
+import io
+import os
+import random
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+import pypdfium2 as pdfium
+
+from backend.data.scrapers.kam_pdf_utils import (
+    DESC_KEYWORDS, NAME_KEYWORDS, PRICE_KEYWORDS, SINGULAR_KEYWORDS, _clean_price, _col_index_from_headers,
+    extract_name_price,
+)
+
+HEADERS = [["Назив на", "стока-производ"], ["Продажна", "цена"], ["Единична", "цена"], ["Опис на", "стока"],
+           ["Достапност во", "продажен објект"], ["Редовна", "цена"], ["Цена со", "попуст"], ["Попуст(%)"],
+           ["Вид на продажно", "поттикнување"], ["Времетраење на", "промоција"]]
+COLUMN_WIDTHS = [190, 55, 70, 95, 65, 50, 50, 45, 80, 80]
+FONT_SIZE, CHAR_WIDTH, LINE_HEIGHT = 6, 0.6, 8
+PAGE_WIDTH, PAGE_HEIGHT, MARGIN = 842, 595, 30
+
+
+def cascade_extract(pdf_path: str) -> Dict:
+    """The camelot lattice -> camelot stream -> pdfplumber cascade extract_name_price used before."""
+    rows = cascade_camelot(pdf_path)
+    if not rows:
+        rows = cascade_pdfplumber(pdf_path)
+    return {row["name"]: [row["price"], row["singular_price"]] for row in rows}
+
+
+def cascade_camelot(pdf_path: str) -> List[Dict]:
+    try:
+        import camelot
+    except Exception:
+        return []
+    results = []
+    for flavor in ("lattice", "stream"):
+        try:
+            tables = camelot.read_pdf(pdf_path, pages="all", flavor=flavor)
+        except Exception:
+            tables = []
+        for t in tables:
+            df = t.df.copy()
+            if df.empty:
+                continue
+            headers = df.iloc[0].tolist()
+            name_col = _col_index_from_headers(headers, NAME_KEYWORDS)
+            price_col = _col_index_from_headers(headers, PRICE_KEYWORDS)
+            desc_col = _col_index_from_headers(headers, DESC_KEYWORDS)
+            sing_col = _col_index_from_headers(headers, SINGULAR_KEYWORDS)
+
+            data_rows = df.iloc[1:] if isinstance(name_col, int) and isinstance(price_col, int) else df
+            for _, row in data_rows.iterrows():
+                try:
+                    name = str(row[name_col]).replace('\n', ' ').strip() if name_col is not None else None
+                    price = _clean_price(row[price_col]) if price_col is not None else None
+                    description = str(row[desc_col]).replace('\n', ' ').strip() if desc_col is not None else ""
+                    singular_price = None
+                    if sing_col is not None:
+                        raw = row[sing_col]
+                        singular_price = str(raw).replace('\n', ' ').strip() if raw not in (None, "") else None
+                except Exception:
+                    continue
+
+                if name and price is not None:
+                    full_name = f"{name} - {description}" if description else name
+                    results.append({"name": full_name, "price": price, "singular_price": singular_price})
+        if results:
+            return results
+    return results
+
+
+def cascade_pdfplumber(pdf_path: str) -> List[Dict]:
+    import pdfplumber
+    results = []
+    with pdfplumber.open(pdf_path) as pdf:
+        for page in pdf.pages:
+            try:
+                tables = page.extract_tables()
+            except Exception:
+                tables = []
+            for table in tables:
+                if not table or not any(table):
+                    continue
+                headers = [str(x or "").strip() for x in table[0]]
+                name_col = _col_index_from_headers(headers, NAME_KEYWORDS)
+                price_col = _col_index_from_headers(headers, PRICE_KEYWORDS)
+                desc_col = _col_index_from_headers(headers, DESC_KEYWORDS)
+                sing_col = _col_index_from_headers(headers, SINGULAR_KEYWORDS)
+                start = 1 if (name_col is not None and price_col is not None) else 0
+                for row in table[start:]:
+                    try:
+                        name = str(row[name_col]).strip() if name_col is not None and name_col < len(row) else None
+                        price = _clean_price(row[price_col]) if price_col is not None and price_col < len(row) else None
+                        description = str(row[desc_col]).strip() if desc_col is not None and desc_col < len(row) else ""
+                        singular_price = None
+                        if sing_col is not None and sing_col < len(row):
+                            raw = row[sing_col]
+                            singular_price = str(raw).replace('\n', ' ').strip() if raw not in (None, "") else None
+                    except Exception:
+                        continue
+
+                    if name and price is not None:
+                        name = name.replace('\n', ' ').strip()
+                        description = description.replace('\n', ' ').strip()
+                        full_name = f"{name} - {description}" if description else name
+                        results.append({"name": full_name, "price": price, "singular_price": singular_price})
+    return results
+
+
+def product_rows(count: int, seed: int) -> Tuple[List[List[List[str]]], Dict]:
+    """Table rows (cells as lists of lines) of a generated price list, and the products they hold."""
+    rng = random.Random(seed)
+    rows, expected = [], {}
+    for i in range(count):
+        name = [f"ПРОИЗВОД {seed}-{i} МАРКА"] + (["ПАКУВАЊЕ 500Г"] if i % 3 == 0 else [])
+        price = 20 + rng.randrange(2000)
+        unit_price = f"{price * 2}.00 ден/кг"
+        description = f"КАТЕГОРИЈА {i % 30}"
+        in_stock = "Да" if i % 5 else "Не"
+        if i % 7 == 0:
+            regular = price + 10 + rng.randrange(100)
+            promotion = [[f"{regular},00"], [f"{price},00"], [f"{round((regular - price) * 100 / regular)}"], ["Акција"], ["01.01.25 - 31.01.25"]]
+        else:
+            promotion = [[f"{price},00"], [""], [""], [""], [""]]
+        rows.append([name, [f"{price},00"], [unit_price], [description], [in_stock]] + promotion)
+        expected[f"{' '.join(name)} - {description}"] = [price, unit_price]
+    return rows, expected
+
+
+def _text(text: str) -> str:
+    # Identity-H: two bytes per character, the Unicode code point (mapped back by the ToUnicode CMap)
+    return "<" + "".join(f"{ord(c):04X}" for c in text) + ">"
+
+
+def _row_height(row: List[List[str]]) -> float:
+    return LINE_HEIGHT * max(len(cell) for cell in row) + 2
+
+
+def table_content(rows: List[List[List[str]]], rect_borders: bool) -> bytes:
+    xs = [MARGIN]
+    for width in COLUMN_WIDTHS:
+        xs.append(xs[-1] + width)
+    ys = [PAGE_HEIGHT - MARGIN]
+    ops = ["0.5 w\n"]
+    for row in rows:
+        for x, cell in zip(xs, row):
+            for i, line in enumerate(cell):
+                ops.append(f"BT /F1 {FONT_SIZE} Tf {x + 2:.1f} {ys[-1] - LINE_HEIGHT * (i + 1) + 2:.1f} Td {_text(line)} Tj ET\n")
+        ys.append(ys[-1] - _row_height(row))
+    if rect_borders:
+        for top, bottom in zip(ys, ys[1:]):
+            for left, right in zip(xs, xs[1:]):
+                ops.append(f"{left} {bottom:.1f} {right - left} {top - bottom:.1f} re S\n")
+    else:
+        ops.extend(f"{xs[0]} {y:.1f} m {xs[-1]} {y:.1f} l S\n" for y in ys)
+        ops.extend(f"{x} {ys[0]:.1f} m {x} {ys[-1]:.1f} l S\n" for x in xs)
+    ops.append(f"BT /F1 {FONT_SIZE} Tf {MARGIN} {MARGIN / 2} Td {_text('Датум и време на последно ажурирање на цените: 01.01.2025')} Tj ET\n")
+    return "".join(ops).encode()
+
+
+def price_list_pdf(rows: List[List[List[str]]], repeat_header: bool, rect_borders: bool) -> bytes:
+    pages, page, height = [], [HEADERS], _row_height(HEADERS)
+    for row in rows:
+        if height + _row_height(row) > PAGE_HEIGHT - 2 * MARGIN:
+            pages.append(page)
+            page = [HEADERS] if repeat_header else []
+            height = _row_height(HEADERS) if repeat_header else 0
+        page.append(row)
+        height += _row_height(row)
+    pages.append(page)
+
+    cmap = (b"/CIDInit /ProcSet findresource begin 12 dict begin begincmap /CMapName /Identity-Unicode def "
+            b"1 begincodespacerange <0000> <FFFF> endcodespacerange 2 beginbfrange "
+            b"<0000> <00FF> <0000> <0400> <04FF> <0400> endbfrange endcmap "
+            b"CMapName currentdict /CMap defineresource pop end end")
+    objects = {
+        1: b"<< /Type /Catalog /Pages 2 0 R >>",
+        2: b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(b"%d 0 R" % (7 + 2 * i) for i in range(len(pages))), len(pages)),
+        3: b"<< /Type /Font /Subtype /Type0 /BaseFont /DejaVuSansMono /Encoding /Identity-H "
+           b"/DescendantFonts [4 0 R] /ToUnicode 5 0 R >>",
+        4: b"<< /Type /Font /Subtype /CIDFontType2 /BaseFont /DejaVuSansMono /FontDescriptor 6 0 R "
+           b"/CIDSystemInfo << /Registry (Adobe) /Ordering (Identity) /Supplement 0 >> /DW %d /CIDToGIDMap /Identity >>"
+           % int(CHAR_WIDTH * 1000),
+        5: b"<< /Length %d >>\nstream\n%s\nendstream" % (len(cmap), cmap),
+        6: b"<< /Type /FontDescriptor /FontName /DejaVuSansMono /Flags 33 /FontBBox [-558 -375 718 1042] "
+           b"/ItalicAngle 0 /Ascent 760 /Descent -240 /CapHeight 729 /StemV 80 >>",
+    }
+    for i, page_rows in enumerate(pages):
+        content = table_content(page_rows, rect_borders)
+        objects[7 + 2 * i] = (b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] /Contents %d 0 R "
+                              b"/Resources << /Font << /F1 3 0 R >> >> >>" % (PAGE_WIDTH, PAGE_HEIGHT, 8 + 2 * i))
+        objects[8 + 2 * i] = b"<< /Length %d >>\nstream\n%s\nendstream" % (len(content), content)
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = {}
+    for number in sorted(objects):
+        offsets[number] = len(out)
+        out += b"%d 0 obj\n%s\nendobj\n" % (number, objects[number])
+    xref = len(out)
+    size = max(objects) + 1
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % size
+    out += b"".join(b"%010d 00000 n \n" % offsets[number] for number in range(1, size))
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (size, xref)
+    return bytes(out)
+
+
+def accuracy(result: Dict, expected: Dict) -> float:
+    if not expected:
+        return 1.0 if not result else 0.0
+    # [price, singular_price]: the cascade didn't extract promotions
+    return sum(1 for name, value in expected.items() if result.get(name, [])[:2] == value) / len(expected)
+
+
+def time_extractor(extract: Callable[[str], Dict], paths: List[Path], repeat: int) -> Tuple[float, List[Dict]]:
+    best = float("inf")
+    results = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = [extract(str(path)) for path in paths]
+        best = min(best, time.perf_counter() - start)
+    return best, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the camelot/pdfplumber cascade with the pdfium extractor on Kam PDFs.")
+    parser.add_argument("--fixtures", type=Path, help="Directory of saved Kam price list PDFs")
+    parser.add_argument("--pdfs", type=int, default=3, help="Generated PDFs")
+    parser.add_argument("--rows", type=int, default=1500, help="Products per generated PDF")
+    parser.add_argument("--repeat-header", action="store_true", help="Repeat the header row on every generated page")
+    parser.add_argument("--rect-borders", action="store_true", help="Rule generated tables with a rectangle per cell")
+    parser.add_argument("--page-workers", type=int, default=os.cpu_count(), help="Processes for the page-parallel run")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--out", type=Path, default=Path("/tmp/kam_pdf_benchmark"), help="Where generated PDFs are written")
+    args = parser.parse_args()
+
+    if args.fixtures:
+        paths = sorted(args.fixtures.glob("*.pdf"))
+        expected = None
+    else:
+        args.out.mkdir(parents=True, exist_ok=True)
+        paths, expected = [], []
+        for seed in range(args.pdfs):
+            rows, products = product_rows(args.rows, seed)
+            path = args.out / f"kam-{seed}.pdf"
+            path.write_bytes(price_list_pdf(rows, args.repeat_header, args.rect_borders))
+            paths.append(path)
+            expected.append(products)
+    if not paths:
+        print("No PDFs to benchmark")
+        return
+
+    pages = 0
+    for path in paths:
+        document = pdfium.PdfDocument(str(path))
+        pages += len(document)
+        document.close()
+    print(f"{len(paths)} PDFs, {pages} pages")
+
+    extractors = {
+        "cascade": cascade_extract,
+        "single pass": extract_name_price,
+    }
+    if args.page_workers > 1:
+        extractors[f"single pass, {args.page_workers} procs"] = lambda path: extract_name_price(path, page_workers=args.page_workers)
+    reference = None
+    for label, extract in extractors.items():
+        elapsed, results = time_extractor(extract, paths, args.repeat)
+        if reference is None:
+            reference = results
+        truth = expected if expected is not None else reference
+        scores = [accuracy(result, products) for result, products in zip(results, truth)]
+        against = "generated products" if expected is not None else "the cascade"
+        print(f"{label:<24} {pages / elapsed:8.1f} pages/s, {sum(len(r) for r in results):6d} products, "
+              f"accuracy vs {against} {sum(scores) / len(scores):6.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Startup overhead of a pipeline run: a fresh interpreter per DAG node (run_pipeline
+--subprocess) vs running every node in-process (the default).
+
+For every node the subprocess runner pays interpreter startup plus the imports of the
+node's module (pandas, langchain, google-genai, ...), and with --db a new PostgreSQL
+connection. In-process, each module is imported once and connections come from a pool
+of --workers connections.
+
+    python -m backend.data.benchmarks.pipeline_startup_benchmark --repeat 3 [--db]
+"""
+import argparse
+import json
+import subprocess
+import sys
+import time
+from collections import Counter
+
+from backend.data.run_pipeline import DATA_DIR, build_dag
+from backend.data.run_scrapers import PROJECT_ROOT
+
+FRESH_IMPORT = "import json, {module}; print(json.dumps(None))"
+
+# Imports the modules one after another in one interpreter, like the in-process runner
+SHARED_IMPORTS = """
+import importlib, json, time
+seconds = {{}}
+for module in {modules!r}:
+    start = time.perf_counter()
+    importlib.import_module(module)
+    seconds[module] = time.perf_counter() - start
+print(json.dumps(seconds))
+"""
+
+
+def python(code: str) -> tuple:
+    """(wall seconds, parsed stdout) of running code in a fresh interpreter."""
+    start = time.perf_counter()
+    out = subprocess.run([sys.executable, "-c", code], cwd=PROJECT_ROOT, capture_output=True, text=True, check=True)
+    return time.perf_counter() - start, json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def subprocess_startup(module: str, repeat: int) -> float:
+    """Best wall time of a fresh interpreter that only imports module."""
+    return min(python(FRESH_IMPORT.format(module=module))[0] for _ in range(repeat))
+
+
+def connect_seconds(repeat: int) -> float:
+    from backend.data.db_utils import connect_to_db
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        connect_to_db().close()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline's per-node startup overhead.")
+    parser.add_argument("--repeat", type=int, default=3, help="Best of N fresh interpreters per module")
+    parser.add_argument("--workers", type=int, default=0, help="Connection pool size (0 = one per scraper, like run_pipeline)")
+    parser.add_argument("--db", action="store_true", help="Also measure PostgreSQL connection setup")
+    args = parser.parse_args()
+
+    nodes = build_dag(DATA_DIR / "scrapers")
+    per_module = Counter(node.module for node in nodes.values())
+    print(f"{len(nodes)} nodes over {len(per_module)} modules")
+
+    bare = min(python("import json; print(json.dumps(0))")[0] for _ in range(args.repeat))
+    subprocess_total = 0.0
+    for module, count in per_module.items():
+        seconds = subprocess_startup(module, args.repeat)
+        subprocess_total += seconds * count
+        print(f"  {module:<45} {count:>4} nodes x {seconds:.3f}s = {seconds * count:7.2f}s")
+
+    _, shared = python(SHARED_IMPORTS.format(modules=list(per_module)))
+    in_process_total = sum(shared.values())
+
+    print(f"\ninterpreter startup alone: {bare:.3f}s")
+    print(f"subprocess per node:       {subprocess_total:7.2f}s")
+    print(f"in-process (import once):  {in_process_total:7.2f}s")
+
+    saved = subprocess_total - in_process_total
+    if args.db:
+        workers = args.workers or len([n for n in nodes if n.startswith("scrape:")])
+        connect = connect_seconds(args.repeat)
+        # Every node connects once (the scrapers when saving); the pool connects `workers` times
+        saved += connect * (len(nodes) - workers)
+        print(f"connection setup:          {connect:.3f}s x {len(nodes)} nodes vs {workers} pooled")
+    print(f"saved per pipeline run:    {saved:7.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+Micro-benchmark of RateLimiter.acquire and SharedRateLimiter.acquire under high contention.
+
+Scenarios:
+- unthrottled: limits never reached, measures pure bookkeeping cost
+- full window: the window already holds a few thousand entries (as during a
+  categorization run), which used to make every acquire O(window)
+- throttled: a 1-second window with a low limit, checks that waiters wake up
+  on time and the achieved rate stays at the limit
+- shared unthrottled / shared full window: the same against SharedRateLimiter, where
+  every acquire is a BEGIN IMMEDIATE transaction on the SQLite window (run in a thread)
+- shared processes: --processes processes calling acquire_sync on one window at once,
+  i.e. scrapers and pipeline stages contending for the database lock
+
+The shared scenarios use a throwaway database, not the real window.
+
+    python -m backend.data.benchmarks.rate_limiter_benchmark --tasks 128 --acquires 200
+"""
+import argparse
+import asyncio
+import bisect
+import contextlib
+import io
+import multiprocessing
+import tempfile
+import time
+from pathlib import Path
+
+from backend.data.RateLimiter import RateLimiter, SharedRateLimiter
+
+
+async def hammer(limiter, tasks: int, acquires: int, tokens: int) -> float:
+    async def worker():
+        for _ in range(acquires):
+            await limiter.acquire(tokens)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(tasks)])
+    return time.perf_counter() - start
+
+
+def prefill(limiter: RateLimiter, entries: int, tokens: int):
+    now = time.monotonic()
+    for _ in range(entries):
+        limiter._record(tokens, now)
+
+
+def prefill_shared(limiter: SharedRateLimiter, entries: int, tokens: int):
+    now = time.time()
+    with limiter._transaction() as db:
+        db.executemany(
+            "INSERT INTO usage (limiter, ts, requests, tokens) VALUES (?, ?, 1, ?)",
+            [(limiter.name, now, tokens)] * entries,
+        )
+        db.execute(
+            "UPDATE window_totals SET requests = requests + ?, tokens = tokens + ? WHERE limiter = ?",
+            (entries, entries * tokens, limiter.name),
+        )
+
+
+def shared_process(path: str, acquires: int, tokens: int) -> float:
+    limiter = SharedRateLimiter("benchmark", rpm_limit=10 ** 9, tpm_limit=10 ** 12, path=Path(path))
+    start = time.perf_counter()
+    for _ in range(acquires):
+        limiter.acquire_sync(tokens)
+    return time.perf_counter() - start
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Benchmark RateLimiter.acquire throughput.")
+    parser.add_argument("--tasks", type=int, default=128)
+    parser.add_argument("--acquires", type=int, default=200, help="Acquires per task")
+    parser.add_argument("--prefill", type=int, default=2000, help="Window entries for the full-window scenario")
+    parser.add_argument("--processes", type=int, default=4, help="Processes of the shared-processes scenario")
+    args = parser.parse_args()
+    total = args.tasks * args.acquires
+
+    limiter = RateLimiter(rpm_limit=10 ** 9, tpm_limit=10 ** 12)
+    elapsed = await hammer(limiter, args.tasks, args.acquires, 1500)
+    print(f"unthrottled:  {total:,} acquires in {elapsed:.3f}s -> {total / elapsed:,.0f} acquires/s")
+
+    limiter = RateLimiter(rpm_limit=10 ** 9, tpm_limit=10 ** 12)
+    prefill(limiter, args.prefill, 1500)
+    elapsed = await hammer(limiter, args.tasks, args.acquires, 1500)
+    print(f"full window:  {total:,} acquires in {elapsed:.3f}s -> {total / elapsed:,.0f} acquires/s "
+          f"({args.prefill:,} entries prefilled)")
+
+    limit = 500
+    limiter = RateLimiter(rpm_limit=limit, tpm_limit=10 ** 12)
+    limiter.WINDOW_SECONDS = 1
+    granted = []
+    acquire = limiter.acquire
+
+    async def recording_acquire(tokens: int):
+        await acquire(tokens)
+        granted.append(time.monotonic())
+
+    limiter.acquire = recording_acquire
+    with contextlib.redirect_stdout(io.StringIO()):  # the limiter reports every wait
+        elapsed = await hammer(limiter, args.tasks, (limit * 3) // args.tasks, 10)
+    busiest = max(bisect.bisect_right(granted, t + 1.0) - i for i, t in enumerate(granted))
+    print(f"throttled:    {len(granted):,} acquires in {elapsed:.2f}s with limit {limit}/1s window, "
+          f"busiest window {busiest}, ideal time {(len(granted) - 1) // limit:.2f}s")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        limiter = SharedRateLimiter("unthrottled", rpm_limit=10 ** 9, tpm_limit=10 ** 12, path=Path(tmp) / "limits.sqlite")
+        elapsed = await hammer(limiter, args.tasks, args.acquires, 1500)
+        print(f"shared unthrottled:  {total:,} acquires in {elapsed:.3f}s -> {total / elapsed:,.0f} acquires/s")
+
+        limiter = SharedRateLimiter("full", rpm_limit=10 ** 9, tpm_limit=10 ** 12, path=Path(tmp) / "limits.sqlite")
+        prefill_shared(limiter, args.prefill, 1500)
+        elapsed = await hammer(limiter, args.tasks, args.acquires, 1500)
+        print(f"shared full window:  {total:,} acquires in {elapsed:.3f}s -> {total / elapsed:,.0f} acquires/s "
+              f"({args.prefill:,} entries prefilled)")
+
+        path = str(Path(tmp) / "processes.sqlite")
+        SharedRateLimiter("benchmark", path=Path(path))  # Create the schema before the processes race for it
+        per_process = total // args.processes
+        with multiprocessing.Pool(args.processes) as pool:
+            # The slowest process, not counting pool startup
+            elapsed = max(pool.starmap(shared_process, [(path, per_process, 1500)] * args.processes))
+        acquired = per_process * args.processes
+        print(f"shared processes:    {acquired:,} acquires in {elapsed:.3f}s -> {acquired / elapsed:,.0f} acquires/s "
+              f"({args.processes} processes)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
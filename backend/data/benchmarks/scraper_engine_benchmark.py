@@ -0,0 +1,176 @@
+"""
+Benchmark of the proverkanaceni scraping engines against a local mock site.
+
+The mock server (a separate process) serves a market select, per-market product
+counts and product tables with a fixed latency, and records the requests made and
+the peak number in flight. Markets share one catalogue and differ in stock, and
+pages hold up to --page-cap rows whatever perPage asks for. Each scenario runs in
+a fresh process so peak RSS is its own.
+
+Scenarios:
+- threads (uncapped): nested pools of markets × pages threads with nothing limiting
+  the requests per host, as the scrapers did before the shared client
+- threads: the same pools through the pooled HttpClient capped per host
+- async: one event loop and a FetchQueue with the same per-host cap
+
+    python -m backend.data.benchmarks.scraper_engine_benchmark --markets 10 --latency 0.05
+    python -m backend.data.benchmarks.scraper_engine_benchmark --page-cap 100
+"""
+import argparse
+import json
+import multiprocessing
+import resource
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+def serve(port_queue, markets: int, products: int, page_cap: int, latency: float):
+    in_flight = {"now": 0, "peak": 0, "total": 0}
+    lock = threading.Lock()
+
+    def page(org_id: int, page_num: int, per_page: int) -> str:
+        per_page = min(per_page, page_cap)
+        first = (page_num - 1) * per_page
+        body = "".join(
+            f"<tr><td>Производ {i}</td><td>{50 + i % 200} ден.</td>"
+            f"<td>{i} ден/кг</td><td>Категорија {i % 30}</td><td>{'Да' if (i + org_id) % 3 else 'Не'}</td></tr>"
+            for i in range(first, min(first + per_page, products))
+        )
+        return ('<html><body><table class="table table-bordered table-striped table-hover">'
+                f'<thead><tr><th>Име</th></tr></thead><tbody>{body}</tbody></table></body></html>')
+
+    index = ('<select class="form-select"><option>Сите</option>'
+             + "".join(f'<option value="{m}">Маркет {m}</option>' for m in range(1, markets + 1))
+             + "</select>")
+    count = f"<p>Прикажани 1 до 10 од {products} производи</p>"
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            if self.path in ("/stats", "/reset"):
+                if self.path == "/reset":
+                    in_flight["peak"] = 0
+                self._send(json.dumps(in_flight))
+                return
+            with lock:
+                in_flight["now"] += 1
+                in_flight["total"] += 1
+                in_flight["peak"] = max(in_flight["peak"], in_flight["now"])
+            try:
+                time.sleep(latency)
+                params = dict(p.split("=", 1) for p in self.path.split("?", 1)[-1].split("&") if "=" in p)
+                if "org" not in params:
+                    self._send(index)
+                elif params.get("perPage") == "10":
+                    self._send(count)
+                else:
+                    self._send(page(int(params["org"]), int(params["page"]), int(params["perPage"])))
+            finally:
+                with lock:
+                    in_flight["now"] -= 1
+
+        def _send(self, text: str):
+            body = text.encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    port_queue.put(server.server_port)
+    server.serve_forever()
+
+
+def run_scenario(result_queue, name: str, base_url: str, market_workers: int, page_workers: int, per_host_limit: int):
+    import asyncio
+    import contextlib
+    import io
+    from backend.data.scrapers import proverkanaceni
+
+    peak_threads = [threading.active_count()]
+    stop = threading.Event()
+
+    def sample_threads():
+        while not stop.wait(0.01):
+            peak_threads[0] = max(peak_threads[0], threading.active_count())
+
+    sampler = threading.Thread(target=sample_threads, daemon=True)
+    sampler.start()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        if name == "async":
+            products, _ = asyncio.run(proverkanaceni.scrape_chain_async(base_url, per_host_limit))
+        else:
+            products, _ = proverkanaceni.scrape_chain_threads(base_url, market_workers, page_workers, per_host_limit)
+    elapsed = time.perf_counter() - start
+    stop.set()
+    sampler.join()
+
+    result_queue.put({
+        "products": len(products),
+        "seconds": elapsed,
+        "peak_threads": peak_threads[0] - 1,  # Not counting the sampler
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    })
+
+
+def stats(base_url: str, path: str = "stats") -> dict:
+    import requests
+    return requests.get(base_url + path, timeout=10).json()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the thread-pool and asyncio scraping engines.")
+    parser.add_argument("--markets", type=int, default=10)
+    parser.add_argument("--products", type=int, default=3000, help="Products per market")
+    parser.add_argument("--page-cap", type=int, default=10000, help="Most rows the server puts on a page")
+    parser.add_argument("--latency", type=float, default=0.05, help="Server response delay in seconds")
+    parser.add_argument("--market-workers", type=int, default=8)
+    parser.add_argument("--page-workers", type=int, default=6)
+    parser.add_argument("--per-host-limit", type=int, default=16)
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context("spawn")
+    port_queue = ctx.Queue()
+    server = ctx.Process(target=serve, args=(port_queue, args.markets, args.products, args.page_cap, args.latency), daemon=True)
+    server.start()
+    base_url = f"http://127.0.0.1:{port_queue.get()}/"
+
+    uncapped = args.market_workers * args.page_workers
+    scenarios = [
+        ("threads (uncapped)", "threads", uncapped),
+        ("threads", "threads", args.per_host_limit),
+        ("async", "async", args.per_host_limit),
+    ]
+    # What the scrapers requested when the page count came from product count // 100
+    fixed_pages = args.markets * (args.products // 100 + 2) + 1
+    print(f"{args.markets} markets × {args.products} products, pages of up to {args.page_cap} rows, "
+          f"{args.latency * 1000:.0f}ms latency ({fixed_pages} requests with count // 100 pages)")
+
+    for label, engine, per_host_limit in scenarios:
+        before = stats(base_url, "reset")
+        result_queue = ctx.Queue()
+        proc = ctx.Process(target=run_scenario, args=(
+            result_queue, engine, base_url, args.market_workers, args.page_workers, per_host_limit,
+        ))
+        proc.start()
+        result = result_queue.get()
+        proc.join()
+        after = stats(base_url)
+        requests = after["total"] - before["total"]
+        print(f"{label:<20} {result['seconds']:6.2f}s  {requests:4d} requests  "
+              f"peak in flight {after['peak']:4d}  "
+              f"threads {result['peak_threads']:3d}  peak RSS {result['peak_rss_mb']:6.1f} MB  "
+              f"products {result['products']:,}")
+
+    server.terminate()
+
+
+if __name__ == "__main__":
+    main()
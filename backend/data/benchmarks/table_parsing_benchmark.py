@@ -0,0 +1,143 @@
+"""
+Benchmark of price table parsing: BeautifulSoup (html.parser) vs the lxml extractor.
+
+Runs both parsers on the same pages, checks they produce identical products and
+reports the time per page. Pages come from --fixtures, a directory of saved pages
+(proverkanaceni-*.html and vero-*.html, e.g. saved with curl), or are generated
+with the proverkanaceni / Vero table layout when no directory is given.
+
+    python -m backend.data.benchmarks.table_parsing_benchmark --rows 10000
+    python -m backend.data.benchmarks.table_parsing_benchmark --fixtures ~/saved-pages
+"""
+import argparse
+import time
+from pathlib import Path
+from typing import Callable, Dict, List
+
+from bs4 import BeautifulSoup
+
+from backend.data.scrapers.html_tables import extract_tables
+from backend.data.scrapers.proverkanaceni import PRICE_TABLE_CLASS, parse_page
+
+
+def bs4_parse_proverkanaceni(content: bytes) -> Dict[str, list]:
+    """The BeautifulSoup parse scrape_page used before the lxml extractor."""
+    soup = BeautifulSoup(content, "html.parser")
+    table = soup.find("table", class_=PRICE_TABLE_CLASS)
+    if not table:
+        return {}
+    tbody = table.find("tbody")
+    if not tbody:
+        return {}
+
+    page_products = {}
+    for row in tbody.find_all("tr"):
+        cols = row.find_all("td")
+        if len(cols) < 5:
+            continue
+        product_name = cols[0].text.strip()
+        price = cols[1].text.strip()
+        if price.count(".") >= 2:
+            continue
+        in_stock = "Да" in cols[4].text.strip()
+        if product_name not in page_products:
+            page_products[product_name] = [int(price[0:-5]), cols[2].text.strip(), cols[3].text.strip(), in_stock]
+        elif in_stock:
+            page_products[product_name][3] = True
+    return page_products
+
+
+def lxml_parse_proverkanaceni(content: bytes) -> Dict[str, list]:
+    return {
+        name: [p.price, p.singular_price, p.description, p.in_stock]
+        for name, p in parse_page(content).items()
+    }
+
+
+def bs4_parse_vero(content: bytes) -> List[list]:
+    soup = BeautifulSoup(content, "html.parser")
+    rows = []
+    for table in soup.find_all("table"):
+        for row in table.find_all("tr")[3:-1]:
+            rows.append([ele.text.strip() for ele in row.find_all("td")])
+    return rows
+
+
+def lxml_parse_vero(content: bytes) -> List[list]:
+    return [cols for rows in extract_tables(content) for cols in rows[3:-1]]
+
+
+def proverkanaceni_page(rows: int) -> bytes:
+    body = "".join(
+        f"<tr>\n<td> Производ број {i} &amp; уште </td>\n<td>{50 + i % 900} ден.</td>\n"
+        f"<td>{(i % 90) + 10}.00 ден/кг</td>\n<td>Категорија {i % 40}</td>\n<td>{'Да' if i % 4 else 'Не'}</td>\n</tr>\n"
+        for i in range(rows)
+    )
+    return (
+        '<!DOCTYPE html><html><head><meta charset="utf-8"><title>Цени</title></head><body>'
+        '<nav><a href="/">Почетна</a></nav><p>Прикажани 1 до 10000</p>'
+        f'<table class="{PRICE_TABLE_CLASS}"><thead><tr><th>Назив</th><th>Цена</th><th>Единечна</th>'
+        f'<th>Категорија</th><th>Залиха</th></tr></thead><tbody>{body}</tbody></table></body></html>'
+    ).encode("utf-8")
+
+
+def vero_page(rows: int) -> bytes:
+    header = "".join(f"<tr><td colspan=5>Заглавие {i}</td></tr>" for i in range(3))
+    body = "".join(
+        f"<tr><td>ПРОИЗВОД {i}</td><td>{40 + i % 700}</td><td>{i % 300} ден/кг</td>"
+        f"<td>{'Да' if i % 5 else 'Не'}</td><td>Група {i % 25}</td></tr>"
+        for i in range(rows)
+    )
+    return (
+        '<html><head><meta http-equiv="Content-Type" content="text/html; charset=utf-8"></head><body>'
+        f'<table border=1>{header}{body}<tr><td>Крај</td></tr></table></body></html>'
+    ).encode("utf-8")
+
+
+def time_parser(parse: Callable, pages: List[bytes], repeat: int):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        results = [parse(page) for page in pages]
+        best = min(best, time.perf_counter() - start)
+    return best, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare BeautifulSoup and lxml price table parsing.")
+    parser.add_argument("--fixtures", type=Path, help="Directory of saved proverkanaceni-*.html / vero-*.html pages")
+    parser.add_argument("--rows", type=int, default=10000, help="Rows per generated page")
+    parser.add_argument("--pages", type=int, default=3, help="Generated pages per layout")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.fixtures:
+        layouts = {
+            "proverkanaceni": [p.read_bytes() for p in sorted(args.fixtures.glob("proverkanaceni-*.html"))],
+            "vero": [p.read_bytes() for p in sorted(args.fixtures.glob("vero-*.html"))],
+        }
+    else:
+        layouts = {
+            "proverkanaceni": [proverkanaceni_page(args.rows) for _ in range(args.pages)],
+            "vero": [vero_page(args.rows) for _ in range(args.pages)],
+        }
+
+    parsers = {
+        "proverkanaceni": (bs4_parse_proverkanaceni, lxml_parse_proverkanaceni),
+        "vero": (bs4_parse_vero, lxml_parse_vero),
+    }
+    for layout, pages in layouts.items():
+        if not pages:
+            continue
+        size_mb = sum(len(p) for p in pages) / 1e6
+        bs4_parse, lxml_parse = parsers[layout]
+        bs4_time, bs4_results = time_parser(bs4_parse, pages, args.repeat)
+        lxml_time, lxml_results = time_parser(lxml_parse, pages, args.repeat)
+        same = "identical" if bs4_results == lxml_results else "DIFFERENT"
+        print(f"{layout:<15} {len(pages)} pages, {size_mb:.1f} MB: "
+              f"bs4 {bs4_time / len(pages) * 1000:8.1f} ms/page, lxml {lxml_time / len(pages) * 1000:7.1f} ms/page "
+              f"({bs4_time / lxml_time:.1f}x), results {same}")
+
+
+if __name__ == "__main__":
+    main()
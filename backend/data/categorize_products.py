@@ -1,11 +1,22 @@
 import asyncio
-from typing import Optional
+import html
+import itertools
+from typing import Dict, Optional
 from pydantic import BaseModel, Field
 from google import genai
+from google.genai import errors as genai_errors
+import httpx
+from langchain_google_genai import GoogleGenerativeAIEmbeddings
 import json
+import random
+from pathlib import Path
+from typing import Callable
 
-from backend.data.RateLimiter import RateLimiter
+from backend.data.RateLimiter import SharedRateLimiter
 from backend.data.db_utils import *
+from backend.data.metrics import count, span
+from backend.data.text_utils import normalize_name, get_embeddings_client, normalize_embedding, is_throttling_error
+import numpy as np
 
 from backend.data.db_utils import connect_to_db
 
@@ -57,37 +68,346 @@ class BatchSubResponse(BaseModel):
     products: List[ProductSubCategory]
 
 
-rate_limiter = RateLimiter(rpm_limit=1900, tpm_limit=3800000)
+class ProductJointCategory(BaseModel):
+    """Single product main and subcategory categorization in one call."""
 
+    main_category: str = Field(description="Main category from taxonomy")
+    sub_category: str = Field(description="Subcategory belonging to main category")
+    confidence: float = Field(description="Confidence 0.0-1.0", ge=0.0, le=1.0)
+    reasoning: Optional[str] = Field(default=None, description="Brief explanation")
 
-def estimate_tokens_main_category(products: List[dict]) -> int:
-    system_tokens = 300
-    categories_tokens = 200
-    user_content = "\n\n".join(
+
+class BatchJointResponse(BaseModel):
+    products: List[ProductJointCategory]
+
+
+# Shared with every other process on the host that calls the same model. Starts below the
+# tier 1 quota (2,000 RPM / 4M TPM), backs off on 429s and probes back up towards it.
+rate_limiter = SharedRateLimiter(
+    "gemini-2.0-flash", rpm_limit=1900, tpm_limit=3800000,
+    adaptive=True, max_rpm_limit=2000, max_tpm_limit=4000000,
+)
+
+# "two_stage": main category call, then a subcategory call per main category
+# "joint": one call returning both, using the compressed taxonomy
+CATEGORIZATION_MODES = ("two_stage", "joint")
+
+# Actual usage reported by Gemini, as opposed to the rate limiter's estimates
+token_usage = {"requests": 0, "prompt_tokens": 0, "output_tokens": 0}
+
+
+async def record_usage(response, kind: str, products_chunk: List[dict]) -> None:
+    token_usage["requests"] += 1
+    count("llm.products", len(products_chunk))
+    usage = getattr(response, "usage_metadata", None)
+    if usage:
+        prompt_tokens = usage.prompt_token_count or 0
+        output_tokens = usage.candidates_token_count or 0
+        token_usage["prompt_tokens"] += prompt_tokens
+        token_usage["output_tokens"] += output_tokens
+        count("llm.prompt_tokens", prompt_tokens)
+        count("llm.output_tokens", output_tokens)
+        # What rate_limiter.acquire() reserved, before the estimator learns from this response
+        estimated_tokens = token_estimator.estimate(kind, products_chunk)
+        token_estimator.observe(kind, products_chunk, prompt_tokens, output_tokens)
+        await asyncio.to_thread(rate_limiter.record_usage, estimated_tokens, prompt_tokens + output_tokens)
+
+
+# Categorizations at or above this confidence are reused for products with the same dedup key
+REUSE_MIN_CONFIDENCE = 0.9
+
+
+def dedup_key(product: dict) -> tuple:
+    """Key under which products from different markets are considered the same item."""
+    name = normalize_name(html.unescape(product.get("name") or "").strip())
+    description = (product.get("description") or "").strip().lower()
+    return name, description
+
+
+def group_duplicate_products(products: List[dict]) -> Dict[tuple, List[dict]]:
+    groups = {}
+    for product in products:
+        groups.setdefault(dedup_key(product), []).append(product)
+    return groups
+
+
+def build_known_categorizations(rows: List[dict]) -> Dict[tuple, dict]:
+    """Index confident DB categorizations by dedup key, keeping the most confident one per key."""
+    known = {}
+    for row in rows:
+        key = dedup_key(row)
+        if key in known and known[key]["sub_confidence"] >= row["confidence"]:
+            continue
+        known[key] = ProductCategory(
+            main_category=row["main_category"],
+            sub_category=row["sub_category"],
+            main_confidence=row["confidence"],
+            sub_confidence=row["confidence"],
+            main_reasoning=None,
+            sub_reasoning=row["reasoning"],
+        ).model_dump()
+    return known
+
+
+# Nearest-neighbour propagation: a product inherits the category of its already-categorized
+# neighbours when enough of them are close and agree, skipping the LLM entirely
+NEIGHBOUR_K = 10
+NEIGHBOUR_MIN_SIMILARITY = 0.95
+NEIGHBOUR_MIN_VOTES = 3
+NEIGHBOUR_MIN_VOTE_SHARE = 0.8
+NEIGHBOUR_MIN_CONFIDENCE = 0.7
+EMBEDDING_BATCH_SIZE = 100
+
+# Same quota and settings as embed_products' limiter (3,000 RPM / 1M TPM)
+embedding_rate_limiter = SharedRateLimiter(
+    "gemini-embedding-001", rpm_limit=2850, tpm_limit=1000000,
+    adaptive=True, max_rpm_limit=3000, max_tpm_limit=1000000,
+)
+
+
+def vote_neighbour_category(
+    neighbours: List[dict],
+    min_similarity: float = NEIGHBOUR_MIN_SIMILARITY,
+    min_votes: int = NEIGHBOUR_MIN_VOTES,
+    min_vote_share: float = NEIGHBOUR_MIN_VOTE_SHARE,
+) -> Optional[dict]:
+    """Similarity-weighted vote over close neighbours; None when they don't agree strongly enough."""
+    close = [
+        n for n in neighbours
+        if n["similarity"] >= min_similarity
+        and n["main_category"] in CATEGORIES
+        and n["sub_category"] in CATEGORIES[n["main_category"]]
+    ]
+    if len(close) < min_votes:
+        return None
+
+    votes = {}
+    for n in close:
+        key = (n["main_category"], n["sub_category"])
+        votes[key] = votes.get(key, 0.0) + n["similarity"]
+
+    (main_cat, sub_cat), weight = max(votes.items(), key=lambda item: item[1])
+    share = weight / sum(votes.values())
+    if share < min_vote_share:
+        return None
+
+    main_weight = sum(w for (m, _), w in votes.items() if m == main_cat)
+    main_share = main_weight / sum(votes.values())
+    winners = [n["similarity"] for n in close if (n["main_category"], n["sub_category"]) == (main_cat, sub_cat)]
+    mean_similarity = sum(winners) / len(winners)
+
+    return ProductCategory(
+        main_category=main_cat,
+        sub_category=sub_cat,
+        main_confidence=round(main_share * mean_similarity, 3),
+        sub_confidence=round(share * mean_similarity, 3),
+        main_reasoning=None,
+        sub_reasoning=f"{PROPAGATED_REASONING_PREFIX}{len(winners)}/{len(close)} nearest neighbours (mean similarity {mean_similarity:.3f})",
+    ).model_dump()
+
+
+async def propagate_neighbour_categories(
+    conn: psycopg2.extensions.connection,
+    products: List[dict],
+    embeddings_client: GoogleGenerativeAIEmbeddings,
+    k: int = NEIGHBOUR_K,
+    min_similarity: float = NEIGHBOUR_MIN_SIMILARITY,
+    min_votes: int = NEIGHBOUR_MIN_VOTES,
+    min_vote_share: float = NEIGHBOUR_MIN_VOTE_SHARE,
+) -> List[dict]:
+    """
+    Embed products and assign categories from agreeing neighbours.
+    Returns the products that are still ambiguous and need the LLM.
+    The computed embeddings are stored so the embedding stage can skip these products.
+    """
+    start = time.time()
+    print(f"🧭 Nearest-neighbour propagation for {len(products):,} products...")
+    names = [normalize_name(p["name"]) for p in products]
+    embedding_rows = []
+    remaining = []
+
+    for batch_start in range(0, len(products), EMBEDDING_BATCH_SIZE):
+        batch_products = products[batch_start:batch_start + EMBEDDING_BATCH_SIZE]
+        batch_names = names[batch_start:batch_start + EMBEDDING_BATCH_SIZE]
+        batch_tokens = sum(len(n) for n in batch_names) // 4
+
+        for _ in range(len(batch_names)):
+            await embedding_rate_limiter.acquire(batch_tokens // len(batch_names))
+
+        try:
+            with span("embedding.request", texts=len(batch_names)):
+                vectors = await asyncio.to_thread(
+                    embeddings_client.embed_documents, batch_names, batch_size=len(batch_names)
+                )
+        except Exception as e:
+            if is_throttling_error(e):
+                await asyncio.to_thread(embedding_rate_limiter.report_throttled)
+            raise
+        count("embedding.texts", len(batch_names))
+
+        batch_rows = [
+            (normalize_embedding(np.array(vector)).tolist(), str(product["id"]))
+            for product, vector in zip(batch_products, vectors)
+        ]
+        embedding_rows.extend(batch_rows)
+
+        # One kNN query for the batch, off the event loop
+        neighbours = await asyncio.to_thread(
+            find_categorized_neighbours, conn, batch_rows, k, NEIGHBOUR_MIN_CONFIDENCE
+        )
+        for product in batch_products:
+            categorization = vote_neighbour_category(
+                neighbours[str(product["id"])], min_similarity, min_votes, min_vote_share
+            )
+            if categorization:
+                product["categorization"] = categorization
+            else:
+                remaining.append(product)
+
+    await asyncio.to_thread(save_name_embeddings, conn, embedding_rows)
+    print(
+        f"   Resolved {len(products) - len(remaining):,}/{len(products):,} from neighbours "
+        f"in {round(time.time() - start, 2)}s"
+    )
+    return remaining
+
+
+def format_products_text(products: List[dict]) -> str:
+    return "\n\n".join(
         [
             f"Product {i + 1}:\nName: {p.get('name', '')}\nDescription: {p.get('description', 'Нема опис')}\nSource: {p.get('existing_categories', 'Нема')}"
             for i, p in enumerate(products)
         ]
     )
-    user_tokens = len(user_content) // 4
-    output_tokens = len(products) * 60
+
+
+# Static per-product output estimates, used until real usage has been observed
+OUTPUT_TOKENS_PER_PRODUCT = {"main": 60, "sub": 60, "joint": 75}
+
+# Token-budgeted batching: batches are packed up to these limits
+MAX_BATCH_INPUT_TOKENS = 6000
+MAX_BATCH_OUTPUT_TOKENS = 3000
+MAX_BATCH_SIZE = 40
+
+
+def estimate_tokens_main_category(products: List[dict]) -> int:
+    system_tokens = 300
+    categories_tokens = 200
+    user_tokens = len(format_products_text(products)) // 4
+    output_tokens = len(products) * OUTPUT_TOKENS_PER_PRODUCT["main"]
     return system_tokens + categories_tokens + user_tokens + output_tokens
 
 
 def estimate_tokens_sub_category(products: List[dict]) -> int:
     system_tokens = 250
     subcategories_tokens = 100
-    user_content = "\n\n".join(
-        [
-            f"Product {i + 1}:\nName: {p.get('name', '')}\nDescription: {p.get('description', 'Нема опис')}\nSource: {p.get('existing_categories', 'Нема')}"
-            for i, p in enumerate(products)
-        ]
-    )
-    user_tokens = len(user_content) // 4
-    output_tokens = len(products) * 60
+    user_tokens = len(format_products_text(products)) // 4
+    output_tokens = len(products) * OUTPUT_TOKENS_PER_PRODUCT["sub"]
     return system_tokens + subcategories_tokens + user_tokens + output_tokens
 
 
+def estimate_tokens_joint_category(products: List[dict]) -> int:
+    system_tokens = 250
+    taxonomy_tokens = len(TAXONOMY_COMPRESSED) // 4
+    user_tokens = len(format_products_text(products)) // 4
+    output_tokens = len(products) * OUTPUT_TOKENS_PER_PRODUCT["joint"]
+    return system_tokens + taxonomy_tokens + user_tokens + output_tokens
+
+
+STATIC_ESTIMATORS = {
+    "main": estimate_tokens_main_category,
+    "sub": estimate_tokens_sub_category,
+    "joint": estimate_tokens_joint_category,
+}
+
+
+class TokenEstimator:
+    """
+    Corrects the static token estimates with the usage Gemini actually reports.
+    Keeps an exponential moving average per request kind of the prompt-token ratio
+    (actual / estimated) and of the output tokens per product.
+    """
+
+    def __init__(self, smoothing: float = 0.2):
+        self.smoothing = smoothing
+        self.input_ratio = {}
+        self.output_per_product = {}
+
+    def _smooth(self, current: Optional[float], observed: float) -> float:
+        if current is None:
+            return observed
+        return current + self.smoothing * (observed - current)
+
+    def _static_input(self, kind: str, products: List[dict]) -> int:
+        return STATIC_ESTIMATORS[kind](products) - len(products) * OUTPUT_TOKENS_PER_PRODUCT[kind]
+
+    def observe(self, kind: str, products: List[dict], prompt_tokens: int, output_tokens: int) -> None:
+        if not products:
+            return
+        static_input = self._static_input(kind, products)
+        if prompt_tokens > 0 and static_input > 0:
+            self.input_ratio[kind] = self._smooth(self.input_ratio.get(kind), prompt_tokens / static_input)
+        if output_tokens > 0:
+            self.output_per_product[kind] = self._smooth(
+                self.output_per_product.get(kind), output_tokens / len(products)
+            )
+
+    def output_tokens_per_product(self, kind: str) -> float:
+        return self.output_per_product.get(kind, OUTPUT_TOKENS_PER_PRODUCT[kind])
+
+    def product_input_tokens(self, kind: str, product: dict) -> float:
+        return len(format_products_text([product])) / 4 * self.input_ratio.get(kind, 1.0)
+
+    def estimate(self, kind: str, products: List[dict]) -> int:
+        input_tokens = self._static_input(kind, products) * self.input_ratio.get(kind, 1.0)
+        return int(input_tokens + len(products) * self.output_tokens_per_product(kind))
+
+
+token_estimator = TokenEstimator()
+
+
+def batch_is_full(
+    kind: str,
+    batch: List[dict],
+    max_batch_size: int = MAX_BATCH_SIZE,
+    max_input_tokens: int = MAX_BATCH_INPUT_TOKENS,
+    max_output_tokens: int = MAX_BATCH_OUTPUT_TOKENS,
+) -> bool:
+    if len(batch) >= max_batch_size:
+        return True
+    if len(batch) * token_estimator.output_tokens_per_product(kind) >= max_output_tokens:
+        return True
+    return sum(token_estimator.product_input_tokens(kind, p) for p in batch) >= max_input_tokens
+
+
+def pack_batches(
+    products: List[dict],
+    kind: str,
+    max_batch_size: int = MAX_BATCH_SIZE,
+    max_input_tokens: int = MAX_BATCH_INPUT_TOKENS,
+    max_output_tokens: int = MAX_BATCH_OUTPUT_TOKENS,
+) -> List[List[dict]]:
+    """Greedily pack products into batches that stay within the token and size budgets."""
+    output_per_product = token_estimator.output_tokens_per_product(kind)
+    max_by_output = max(1, int(max_output_tokens // output_per_product))
+    size_limit = min(max_batch_size, max_by_output)
+
+    batches = []
+    current = []
+    input_tokens = 0.0
+    for product in products:
+        product_tokens = token_estimator.product_input_tokens(kind, product)
+        if current and (len(current) >= size_limit or input_tokens + product_tokens > max_input_tokens):
+            batches.append(current)
+            current = []
+            input_tokens = 0.0
+        current.append(product)
+        input_tokens += product_tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
 def create_main_category_prompt() -> str:
     categories_block = "\n".join(
         [f"- {cat}: {desc}" for cat, desc in CATEGORY_DESCRIPTIONS.items()]
@@ -126,19 +446,33 @@ RULES:
 6. Select ONLY from the provided list. Do not invent categories."""
 
 
+def create_joint_category_prompt() -> str:
+    return f"""You are a product categorization expert for Macedonian supermarkets.
+Categorize each product into ONE main category and ONE subcategory of that main category.
+
+TAXONOMY (main category: subcategories):
+{TAXONOMY_COMPRESSED}
+
+RULES:
+1. Choose the most specific and relevant main category and subcategory
+2. If multiple fit, choose based on the product's PRIMARY use case
+3. Canned/preserved goods go in Сосови, намази и конзерви; frozen goods in Замрзната храна; plant milks in Безалкохолни пијалоци
+4. The subcategory MUST belong to the chosen main category
+5. Confidence: 0.9-1.0 clear, 0.7-0.89 good, 0.5-0.69 uncertain, <0.5 needs review
+6. Return categorizations IN THE SAME ORDER as input products
+7. Reasoning must be brief (1 sentence)
+8. Select ONLY from the provided names. Do not invent categories."""
+
+
 async def categorize_batch_main_category(
     products_chunk: List[dict], client: genai.Client, model_id: str
 ) -> List[ProductMainCategory]:
-    products_text = "\n\n".join(
-        [
-            f"Product {i + 1}:\nName: {p.get('name', '')}\nDescription: {p.get('description', 'Нема опис')}\nSource: {p.get('existing_categories', 'Нема')}"
-            for i, p in enumerate(products_chunk)
-        ]
-    )
+    """Raises on request errors and on responses whose length doesn't match the batch."""
+    products_text = format_products_text(products_chunk)
 
     prompt = f"{create_main_category_prompt()}\n\n{products_text}"
 
-    try:
+    with span("llm.request", kind="main", model=model_id, products=len(products_chunk)):
         response = await asyncio.to_thread(
             client.models.generate_content,
             model=model_id,
@@ -149,43 +483,22 @@ async def categorize_batch_main_category(
                 response_schema=BatchMainResponse,
             ),
         )
+    await record_usage(response, "main", products_chunk)
 
-        result = BatchMainResponse(**json.loads(response.text))
-
-        if len(result.products) != len(products_chunk):
-            while len(result.products) < len(products_chunk):
-                result.products.append(
-                    ProductMainCategory(
-                        main_category="Разно",
-                        confidence=0.0,
-                        reasoning="Missing from batch response",
-                    )
-                )
-
-        return result.products[: len(products_chunk)]
-
-    except Exception as e:
-        return [
-            ProductMainCategory(
-                main_category="Разно", confidence=0.0, reasoning=f"Error: {str(e)}"
-            )
-            for _ in products_chunk
-        ]
+    result = BatchMainResponse(**json.loads(response.text))
+    check_response_length(result.products, products_chunk)
+    return result.products
 
 
 async def categorize_batch_sub_category(
     products_chunk: List[dict], main_category: str, client: genai.Client, model_id: str
 ) -> List[ProductSubCategory]:
-    products_text = "\n\n".join(
-        [
-            f"Product {i + 1}:\nName: {p.get('name', '')}\nDescription: {p.get('description', 'Нема опис')}\nSource: {p.get('existing_categories', 'Нема')}"
-            for i, p in enumerate(products_chunk)
-        ]
-    )
+    """Raises on request errors and on responses whose length doesn't match the batch."""
+    products_text = format_products_text(products_chunk)
 
     prompt = f"{create_sub_category_prompt(main_category)}\n\n{products_text}"
 
-    try:
+    with span("llm.request", kind="sub", model=model_id, products=len(products_chunk)):
         response = await asyncio.to_thread(
             client.models.generate_content,
             model=model_id,
@@ -196,40 +509,205 @@ async def categorize_batch_sub_category(
                 response_schema=BatchSubResponse,
             ),
         )
+    await record_usage(response, "sub", products_chunk)
 
-        result = BatchSubResponse(**json.loads(response.text))
-
-        if len(result.products) != len(products_chunk):
-            sub_cats = CATEGORIES.get(main_category, [])
-            default_sub = sub_cats[0] if sub_cats else "Останато"
-            while len(result.products) < len(products_chunk):
-                result.products.append(
-                    ProductSubCategory(
-                        sub_category=default_sub,
-                        confidence=0.0,
-                        reasoning="Missing from batch response",
-                    )
-                )
+    result = BatchSubResponse(**json.loads(response.text))
+    check_response_length(result.products, products_chunk)
+    return result.products
 
-        return result.products[: len(products_chunk)]
 
-    except Exception as e:
-        sub_cats = CATEGORIES.get(main_category, [])
-        default_sub = sub_cats[0] if sub_cats else "Останато"
-        return [
-            ProductSubCategory(
-                sub_category=default_sub, confidence=0.0, reasoning=f"Error: {str(e)}"
-            )
-            for _ in products_chunk
-        ]
+async def categorize_batch_joint_category(
+    products_chunk: List[dict], client: genai.Client, model_id: str
+) -> List[ProductCategory]:
+    """Raises on request errors and on responses whose length doesn't match the batch."""
+    products_text = format_products_text(products_chunk)
+
+    prompt = f"{create_joint_category_prompt()}\n\n{products_text}"
+
+    with span("llm.request", kind="joint", model=model_id, products=len(products_chunk)):
+        response = await asyncio.to_thread(
+            client.models.generate_content,
+            model=model_id,
+            contents=prompt,
+            config=genai.types.GenerateContentConfig(
+                temperature=0.1,
+                response_mime_type="application/json",
+                response_schema=BatchJointResponse,
+            ),
+        )
+    await record_usage(response, "joint", products_chunk)
+
+    result = BatchJointResponse(**json.loads(response.text))
+    check_response_length(result.products, products_chunk)
+    return [validate_joint_category(cat) for cat in result.products]
+
+
+def check_response_length(results: list, products_chunk: List[dict]) -> None:
+    # A short or long answer means the order can't be trusted (often truncated output)
+    if len(results) != len(products_chunk):
+        raise ValueError(f"Batch response has {len(results)} items for {len(products_chunk)} products")
+
+
+def error_categorization(main_category: str, reason: str, main_result: Optional[ProductMainCategory] = None) -> dict:
+    """Fallback categorization with confidence 0.0 so the product is retried by the next run."""
+    sub_cats = CATEGORIES.get(main_category, [])
+    return ProductCategory(
+        main_category=main_category,
+        sub_category=sub_cats[0] if sub_cats else "Останато",
+        main_confidence=main_result.confidence if main_result else 0.0,
+        sub_confidence=0.0,
+        main_reasoning=main_result.reasoning if main_result else None,
+        sub_reasoning=f"Error: {reason}",
+    ).model_dump()
+
+
+def validate_joint_category(cat: ProductJointCategory) -> ProductCategory:
+    """
+    Check a joint answer against CATEGORIES. Invalid answers get confidence 0.0
+    so the product is picked up again by the next run.
+    """
+    main_cat, sub_cat = cat.main_category, cat.sub_category
+    main_conf = sub_conf = cat.confidence
+    reasoning = cat.reasoning
+
+    if main_cat not in CATEGORIES:
+        owners = [m for m, subs in CATEGORIES.items() if sub_cat in subs]
+        if len(owners) == 1:
+            main_cat = owners[0]
+        else:
+            main_cat, main_conf = "Разно", 0.0
+    if sub_cat not in CATEGORIES[main_cat]:
+        sub_cat, sub_conf = CATEGORIES[main_cat][0], 0.0
+        reasoning = f"Invalid subcategory '{cat.sub_category}' for '{main_cat}'"
+
+    return ProductCategory(
+        main_category=main_cat,
+        sub_category=sub_cat,
+        main_confidence=main_conf,
+        sub_confidence=sub_conf,
+        main_reasoning=cat.reasoning,
+        sub_reasoning=reasoning,
+    )
+
+
+# Transient errors (throttling, 5xx, network) are retried with exponential backoff
+MAX_TRANSIENT_RETRIES = 5
+RETRY_BASE_DELAY = 2.0
+RETRY_MAX_DELAY = 60.0
+
+# Products whose single-item request failed this many runs in a row are skipped
+DEAD_LETTER_PATH = Path(__file__).parent / "logs" / "categorization_dead_letter.json"
+DEAD_LETTER_MAX_FAILURES = 3
+
+
+def is_transient_error(error: Exception) -> bool:
+    if isinstance(error, genai_errors.ServerError):
+        return True
+    if isinstance(error, genai_errors.ClientError):
+        return error.code in (408, 429)
+    return isinstance(error, (httpx.TransportError, ConnectionError, TimeoutError))
+
+
+def retry_delay(attempt: int) -> float:
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** attempt))
+    return delay * random.uniform(0.5, 1.0)
+
+
+def load_dead_letters(path: Path = DEAD_LETTER_PATH) -> Dict[str, dict]:
+    if not path.exists():
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_dead_letters(dead_letters: Dict[str, dict], path: Path = DEAD_LETTER_PATH) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(dead_letters, f, ensure_ascii=False, indent=2)
+
+
+class CategorizationCheckpoint:
+    """
+    Saves categorizations to the database as batches finish instead of at the end of the run.
+    Saved products have confidence >= 0.5 and are no longer returned by
+    load_products_to_categorize, so a crashed run resumes where it stopped.
+
+    add() only queues the write: saves run one at a time in a thread (asyncio.to_thread),
+    in the order they were queued, so the event loop keeps serving the LLM workers.
+    await flush() saves what is left and waits for every queued write.
+    """
+
+    def __init__(self, conn: psycopg2.extensions.connection, groups: Dict[tuple, List[dict]], flush_every: int = 500):
+        self.conn = conn
+        self.groups = groups
+        self.flush_every = flush_every
+        self.pending = []
+        self.saved = 0
+        self._writer: Optional[asyncio.Task] = None  # Last queued write
+
+    def add(self, representatives: List[dict]) -> None:
+        for product in representatives:
+            members = self.groups.get(dedup_key(product), [product])
+            for member in members:
+                if member is not product:
+                    member["categorization"] = dict(product["categorization"])
+            self.pending.extend(members)
+        if len(self.pending) >= self.flush_every:
+            self._queue_write()
+
+    def _queue_write(self) -> None:
+        rows, self.pending = self.pending, []
+        self._writer = asyncio.create_task(self._write(rows, self._writer))
+
+    async def _write(self, rows: List[dict], previous: Optional[asyncio.Task]) -> None:
+        if previous is not None:
+            await previous  # One write at a time on the shared connection
+        await asyncio.to_thread(save_categorizations_to_db, self.conn, rows)
+        self.saved += len(rows)
+
+    async def flush(self) -> None:
+        if self.pending:
+            self._queue_write()
+        if self._writer is not None:
+            await self._writer
 
 
 async def categorize_all_products(
     products: List[dict],
-    batch_size: int = 32,
+    batch_size: int = MAX_BATCH_SIZE,
     concurrency: int = 1,
     gemini_api_key: str = None,
+    mode: str = "two_stage",
+    max_input_tokens: int = MAX_BATCH_INPUT_TOKENS,
+    max_output_tokens: int = MAX_BATCH_OUTPUT_TOKENS,
+    on_batch_done: Optional[Callable[[List[dict]], None]] = None,
+    dead_letters: Optional[Dict[str, dict]] = None,
 ) -> List[dict]:
+    """
+    Categorize products in place (product["categorization"]).
+
+    Runs as a queue-based pipeline: `concurrency` workers share one priority queue
+    and the module rate limiter. In two-stage mode, stage-1 results flow into
+    per-main-category buffers and a subcategory batch is queued as soon as a buffer
+    is full; partial buffers are flushed once the last stage-1 batch finishes.
+    Subcategory batches are served first so products complete early and no worker
+    sits idle waiting for a stage barrier.
+
+    Batches are packed by token budget (max_input_tokens / max_output_tokens, at most
+    batch_size products) using estimates corrected by observed usage. A batch that
+    fails is split in half and both halves are re-queued, so only the failing part
+    is retried; a single failing product gets a 0.0-confidence fallback and is
+    recorded in `dead_letters`. Transient errors (429, 5xx, network) are retried
+    with exponential backoff before counting as a failure.
+
+    on_batch_done is called with each group of products as soon as their final
+    categorization is set, so results can be checkpointed during the run.
+
+    mode="joint" asks for main and subcategory in a single request per batch.
+    """
+    if mode not in CATEGORIZATION_MODES:
+        raise ValueError(f"Unknown categorization mode '{mode}', expected one of {CATEGORIZATION_MODES}")
+
     if not gemini_api_key:
         gemini_api_key = os.getenv("GOOGLE_API_KEY")
         if not gemini_api_key:
@@ -237,93 +715,176 @@ async def categorize_all_products(
 
     client = genai.Client(api_key=gemini_api_key)
     model_id = "gemini-2.0-flash"
+    first_stage_kind = "joint" if mode == "joint" else "main"
+    budget = dict(
+        max_batch_size=batch_size,
+        max_input_tokens=max_input_tokens,
+        max_output_tokens=max_output_tokens,
+    )
 
-    print(f"🚀 Starting TWO-STAGE categorization of {len(products)} products")
-    print(f"   Batch size: {batch_size}, Concurrency: {concurrency}")
+    stage_label = "JOINT" if mode == "joint" else "TWO-STAGE"
+    print(f"🚀 Starting {stage_label} categorization of {len(products)} products")
+    print(
+        f"   Max batch size: {batch_size}, token budget: {max_input_tokens:,} in / "
+        f"{max_output_tokens:,} out, Concurrency: {concurrency}"
+    )
     print()
 
-    batches = [
-        products[i : i + batch_size] for i in range(0, len(products), batch_size)
-    ]
-    semaphore = asyncio.Semaphore(concurrency)
-    completed = 0
-    start_time = time.time()
+    if not products:
+        return products
 
-    # Stage 1: Main categories
-    print("📍 Stage 1: Categorizing main categories...")
-    main_categorizations = {}
+    batches = pack_batches(products, first_stage_kind, **budget)
+    print(f"   Packed {len(products):,} products into {len(batches):,} batches")
+    start_time = time.time()
+    usage_before = dict(token_usage)
+    requests_before = rate_limiter.total_requests
+    estimated_before = rate_limiter.total_tokens - rate_limiter.token_correction
 
-    async def process_main_batch(batch_idx: int, batch: List[dict]):
-        nonlocal completed
-        async with semaphore:
-            estimated_tokens = estimate_tokens_main_category(batch)
-            await rate_limiter.acquire(estimated_tokens)
-            main_cats = await categorize_batch_main_category(batch, client, model_id)
-            for product, cat in zip(batch, main_cats):
-                main_categorizations[product["id"]] = cat
-            completed += len(batch)
-            elapsed = time.time() - start_time
-            rate = completed / elapsed if elapsed > 0 else 0
-            print(
-                f"   {completed:,}/{len(products):,} ({completed * 100 // len(products)}%) | {rate:.1f} products/sec"
-            )
+    # Lower number = served first; the counter keeps FIFO order within a priority
+    SUB_PRIORITY, MAIN_PRIORITY = 0, 1
+    queue = asyncio.PriorityQueue()
+    sequence = itertools.count()
 
-    tasks = [process_main_batch(i, batch) for i, batch in enumerate(batches)]
-    await asyncio.gather(*tasks)
+    def enqueue(priority: int, kind: str, batch: List[dict], main_cat: Optional[str] = None):
+        queue.put_nowait((priority, next(sequence), kind, batch, main_cat))
 
-    # Stage 2: Group by main category and categorize subcategories
-    print("\n📍 Stage 2: Categorizing subcategories...")
+    main_categorizations = {}
+    buffers = {}
+    pending_first_stage = len(batches)
     completed = 0
-    products_by_main_cat = {}
-    for product in products:
-        main_cat = main_categorizations[product["id"]].main_category
-        if main_cat not in products_by_main_cat:
-            products_by_main_cat[main_cat] = []
-        products_by_main_cat[main_cat].append(product)
-
-    all_sub_results = {}
-
-    async def process_sub_batch(batch_idx: int, batch: List[dict], main_cat: str):
+    splits = 0
+    retries = 0
+    failed_products = 0
+    if dead_letters is None:
+        dead_letters = {}
+
+    def finish(batch: List[dict], failed: bool = False):
+        if not failed:
+            for product in batch:
+                dead_letters.pop(str(product["id"]), None)
+        if on_batch_done:
+            on_batch_done(batch)
+
+    def report_progress(label: str, products_done: int):
         nonlocal completed
-        start_sub = time.time()
-        async with semaphore:
-            estimated_tokens = estimate_tokens_sub_category(batch)
-            await rate_limiter.acquire(estimated_tokens)
-            sub_cats = await categorize_batch_sub_category(
-                batch, main_cat, client, model_id
-            )
-            for product, cat in zip(batch, sub_cats):
-                all_sub_results[product["id"]] = cat
-            completed += len(batch)
-            elapsed = time.time() - start_sub
-            rate = completed / elapsed if elapsed > 0 else 0
-            print(
-                f"   {completed:,}/{len(products):,} ({completed * 100 // len(products)}%) | {rate:.1f} products/sec"
-            )
-
-    tasks = []
-    for main_cat, products_in_cat in products_by_main_cat.items():
-        sub_batches = [
-            products_in_cat[i : i + batch_size]
-            for i in range(0, len(products_in_cat), batch_size)
-        ]
-        for batch_idx, batch in enumerate(sub_batches):
-            tasks.append(process_sub_batch(batch_idx, batch, main_cat))
-
-    await asyncio.gather(*tasks)
+        completed += products_done
+        elapsed = time.time() - start_time
+        rate = completed / elapsed if elapsed > 0 else 0
+        print(
+            f"   [{label}] {completed:,}/{len(products):,} ({completed * 100 // len(products)}%) "
+            f"| queued {queue.qsize():,} | {rate:.1f} products/sec"
+        )
 
-    # Combine results
-    for product in products:
-        main_result = main_categorizations[product["id"]]
-        sub_result = all_sub_results[product["id"]]
-        product["categorization"] = ProductCategory(
-            main_category=main_result.main_category,
-            sub_category=sub_result.sub_category,
-            main_confidence=main_result.confidence,
-            sub_confidence=sub_result.confidence,
-            main_reasoning=main_result.reasoning,
-            sub_reasoning=sub_result.reasoning,
-        ).model_dump()
+    def flush_buffer(main_cat: str):
+        buffer = buffers.pop(main_cat, [])
+        if buffer:
+            enqueue(SUB_PRIORITY, "sub", buffer, main_cat)
+
+    async def run_joint_batch(batch: List[dict]):
+        await rate_limiter.acquire(token_estimator.estimate("joint", batch))
+        results = await categorize_batch_joint_category(batch, client, model_id)
+        for product, cat in zip(batch, results):
+            product["categorization"] = cat.model_dump()
+        finish(batch)
+        report_progress("joint", len(batch))
+
+    async def run_main_batch(batch: List[dict]):
+        await rate_limiter.acquire(token_estimator.estimate("main", batch))
+        main_cats = await categorize_batch_main_category(batch, client, model_id)
+        for product, cat in zip(batch, main_cats):
+            main_categorizations[product["id"]] = cat
+            buffer = buffers.setdefault(cat.main_category, [])
+            buffer.append(product)
+            if batch_is_full("sub", buffer, **budget):
+                flush_buffer(cat.main_category)
+
+    async def run_sub_batch(batch: List[dict], main_cat: str):
+        await rate_limiter.acquire(token_estimator.estimate("sub", batch))
+        sub_cats = await categorize_batch_sub_category(batch, main_cat, client, model_id)
+        for product, sub_result in zip(batch, sub_cats):
+            main_result = main_categorizations[product["id"]]
+            product["categorization"] = ProductCategory(
+                main_category=main_result.main_category,
+                sub_category=sub_result.sub_category,
+                main_confidence=main_result.confidence,
+                sub_confidence=sub_result.confidence,
+                main_reasoning=main_result.reasoning,
+                sub_reasoning=sub_result.reasoning,
+            ).model_dump()
+        finish(batch)
+        report_progress("sub", len(batch))
+
+    def handle_failure(priority: int, kind: str, batch: List[dict], main_cat: Optional[str], error: Exception):
+        nonlocal splits, pending_first_stage, failed_products
+        if len(batch) > 1:
+            splits += 1
+            middle = len(batch) // 2
+            if kind != "sub":
+                pending_first_stage += 2
+            enqueue(priority, kind, batch[:middle], main_cat)
+            enqueue(priority, kind, batch[middle:], main_cat)
+            return
+
+        product = batch[0]
+        if kind == "sub":
+            product["categorization"] = error_categorization(
+                main_cat, str(error), main_categorizations.get(product["id"])
+            )
+        else:
+            product["categorization"] = error_categorization("Разно", str(error))
+        failed_products += 1
+        entry = dead_letters.setdefault(str(product["id"]), {"name": product["name"], "failures": 0})
+        entry["failures"] += 1
+        entry["last_error"] = str(error)[:500]
+        entry["last_failed_at"] = datetime.now().isoformat(timespec="seconds")
+        finish(batch, failed=True)
+        report_progress(f"{kind} failed", 1)
+
+    async def run_with_retries(kind: str, batch: List[dict], main_cat: Optional[str]):
+        nonlocal retries
+        for attempt in range(MAX_TRANSIENT_RETRIES + 1):
+            try:
+                if kind == "joint":
+                    return await run_joint_batch(batch)
+                elif kind == "main":
+                    return await run_main_batch(batch)
+                else:
+                    return await run_sub_batch(batch, main_cat)
+            except Exception as e:
+                if attempt == MAX_TRANSIENT_RETRIES or not is_transient_error(e):
+                    raise
+                if is_throttling_error(e):
+                    await asyncio.to_thread(rate_limiter.report_throttled)
+                retries += 1
+                delay = retry_delay(attempt)
+                print(f"   ⚠️ Transient error on {kind} batch of {len(batch)} ({e}); retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    async def worker():
+        nonlocal pending_first_stage
+        while True:
+            priority, _, kind, batch, main_cat = await queue.get()
+            try:
+                await run_with_retries(kind, batch, main_cat)
+            except Exception as e:
+                handle_failure(priority, kind, batch, main_cat, e)
+            finally:
+                if kind != "sub":
+                    pending_first_stage -= 1
+                    if pending_first_stage == 0:
+                        # Drain: no more stage-1 results will arrive
+                        for buffered_cat in list(buffers):
+                            flush_buffer(buffered_cat)
+                queue.task_done()
+
+    for batch in batches:
+        enqueue(MAIN_PRIORITY, first_stage_kind, batch)
+
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    await queue.join()
+    for w in workers:
+        w.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
 
     elapsed = time.time() - start_time
     stats = rate_limiter.get_stats()
@@ -334,14 +895,25 @@ async def categorize_all_products(
     print(f"   Total products: {len(products):,}")
     print(f"   Total time: {elapsed / 60:.2f} minutes")
     print(f"   Average rate: {len(products) / elapsed:.1f} products/sec")
-    print(f"   Total API requests: {stats['total_requests']:,}")
-    print(f"   Total tokens used: {stats['total_tokens']:,}")
+    print(f"   Total API requests: {stats['total_requests'] - requests_before:,}")
+    print(f"   Estimated tokens (rate limiter): {stats['total_tokens'] - stats['token_correction'] - estimated_before:,}")
+    print(
+        f"   Actual tokens: {token_usage['prompt_tokens'] - usage_before['prompt_tokens']:,} in / "
+        f"{token_usage['output_tokens'] - usage_before['output_tokens']:,} out"
+    )
+    print(f"   Transient errors retried: {retries:,}")
+    print(f"   Failed batches split and retried: {splits:,}")
+    print(f"   Products that still failed (dead-lettered): {failed_products:,}")
+    print(
+        f"   Effective limits: RPM {stats['rpm_limit']:,}/{stats['max_rpm_limit']:,}, "
+        f"TPM {stats['tpm_limit']:,}/{stats['max_tpm_limit']:,} ({stats['throttle_count']} throttled)"
+    )
     print("=" * 70)
 
     return products
 
 
-async def main():
+async def main(mode: str = "two_stage", market: str = None):
     gemini_api_key = os.getenv("GOOGLE_API_KEY")
     if not gemini_api_key:
         print("❌ ERROR: GOOGLE_API_KEY not found!")
@@ -349,18 +921,70 @@ async def main():
 
     db = connect_to_db()
 
-    products = load_products_to_categorize(db, limit=None)
+    products = load_products_to_categorize(db, limit=None, market=market)
 
     if not products:
         print("✅ No products need categorization!")
         db.close()
         return
 
-    categorized_products = await categorize_all_products(
-        products, batch_size=20, concurrency=128, gemini_api_key=gemini_api_key
-    )
+    dead_letters = load_dead_letters()
+    skipped = {
+        product_id for product_id, entry in dead_letters.items()
+        if entry["failures"] >= DEAD_LETTER_MAX_FAILURES
+    }
+    if skipped:
+        products = [p for p in products if str(p["id"]) not in skipped]
+        print(f"☠️  Skipping {len(skipped):,} dead-lettered products (see {DEAD_LETTER_PATH})")
+
+    groups = group_duplicate_products(products)
+    known = build_known_categorizations(load_confident_categorizations(db, REUSE_MIN_CONFIDENCE))
+    checkpoint = CategorizationCheckpoint(db, groups)
+
+    to_categorize = []
+    reused = 0
+    for key, members in groups.items():
+        if key in known:
+            members[0]["categorization"] = dict(known[key])
+            checkpoint.add([members[0]])
+            reused += len(members)
+        else:
+            to_categorize.append(members[0])
 
-    save_categorizations_to_db(db, categorized_products)
+    print(f"🔁 {len(products):,} products collapsed into {len(groups):,} unique items")
+    print(f"   Reused existing categorizations: {reused:,} products")
+
+    try:
+        from_neighbours = 0
+        if to_categorize:
+            ambiguous = await propagate_neighbour_categories(db, to_categorize, get_embeddings_client())
+            ambiguous_ids = {p["id"] for p in ambiguous}
+            resolved = [p for p in to_categorize if p["id"] not in ambiguous_ids]
+            checkpoint.add(resolved)
+            from_neighbours = sum(len(groups[dedup_key(p)]) for p in resolved)
+            to_categorize = ambiguous
+
+        print(f"   Sending to LLM: {len(to_categorize):,} unique items")
+        if to_categorize:
+            await categorize_all_products(
+                to_categorize,
+                concurrency=128,
+                gemini_api_key=gemini_api_key,
+                mode=mode,
+                on_batch_done=checkpoint.add,
+                dead_letters=dead_letters,
+            )
+    finally:
+        # Keep whatever finished even if the run crashes
+        await checkpoint.flush()
+        save_dead_letters(dead_letters)
+        print(f"💾 Checkpointed {checkpoint.saved:,} categorizations")
+
+    from_llm = sum(len(groups[dedup_key(p)]) for p in to_categorize)
+    print("\n📊 Resolution summary:")
+    print(f"   Local (reused from DB): {reused:,}")
+    print(f"   Local (nearest neighbours): {from_neighbours:,}")
+    print(f"   Remote (LLM): {from_llm:,} products in {len(to_categorize):,} unique items")
 
     print("\n📈 Categorization Quality Analysis:")
     confidence_ranges = {
@@ -371,7 +995,7 @@ async def main():
         "Errors": 0,
     }
 
-    for p in categorized_products:
+    for p in products:
         cat = p["categorization"]
         sub_conf = cat.get("sub_confidence", 0)
 
@@ -386,12 +1010,12 @@ async def main():
         else:
             confidence_ranges["Low (<0.5)"] += 1
 
-    for range_name, count in confidence_ranges.items():
-        pct = (count / len(categorized_products) * 100) if categorized_products else 0
-        print(f"    {range_name}: {count:,} ({pct:.1f}%)")
+    for range_name, n in confidence_ranges.items():
+        pct = (n / len(products) * 100) if products else 0
+        print(f"    {range_name}: {n:,} ({pct:.1f}%)")
 
     print("\n📋 Sample categorizations:")
-    for i, p in enumerate(categorized_products[:20]):
+    for i, p in enumerate(products[:20]):
         cat = p["categorization"]
         print(f"\n{i + 1}. {p['name'][:60]}")
         print(f"   → {cat['main_category']} / {cat['sub_category']}")
@@ -404,4 +1028,11 @@ async def main():
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Categorize products with Gemini.")
+    parser.add_argument("--mode", choices=CATEGORIZATION_MODES, default="two_stage", help="Categorization strategy")
+    parser.add_argument("--market", help="Only categorize this market's products")
+    args = parser.parse_args()
+
+    asyncio.run(main(mode=args.mode, market=args.market))
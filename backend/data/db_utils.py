@@ -2,39 +2,154 @@ import html
 import time
 import uuid
 from datetime import datetime
-from typing import List
+from typing import Dict, List, Optional
 import psycopg2
 from psycopg2.extras import execute_values, RealDictCursor
+from psycopg2.pool import PoolError, ThreadedConnectionPool
 import os
 from dotenv import load_dotenv, find_dotenv
 from backend.data.constants import *
+from backend.data.metrics import count, span
 
 
-def connect_to_db() -> psycopg2.extensions.connection:
+def connection_params() -> dict:
     load_dotenv(find_dotenv())
-    conn = psycopg2.connect(
+    return dict(
         host=os.getenv("POSTGRES_HOST", "localhost"),
         port=os.getenv("POSTGRES_PORT", "5432"),
         database=os.getenv("POSTGRES_DB", "postgres"),
         user=os.getenv("POSTGRES_USER", "user"),
         password=os.getenv("POSTGRES_PASSWORD", "password")
     )
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    """Connection of the shared pool: close() hands it back to the pool instead of closing it."""
+    pool = None
+
+    def close(self):
+        pool, self.pool = self.pool, None
+        if pool is not None and pool is _pool:
+            pool.putconn(self)
+        else:
+            # Not pooled, or the pool was closed while this connection was out
+            super().close()
+
+
+_pool: Optional[ThreadedConnectionPool] = None
+
+
+def use_connection_pool(size: int) -> None:
+    """
+    Have connect_to_db hand out the connections of one shared pool, for stages running
+    in-process (run_pipeline) that would otherwise each open and close their own.
+    """
+    global _pool
+    if _pool is None:
+        # psycopg2's pools only keep minconn connections, so open them all up front
+        _pool = ThreadedConnectionPool(size, size, connection_factory=PooledConnection, **connection_params())
+        print(f"Opened a pool of {size} PostgreSQL connections")
+
+
+def close_connection_pool() -> None:
+    global _pool
+    pool, _pool = _pool, None
+    if pool is not None:
+        pool.closeall()
+
+
+def connect_to_db() -> psycopg2.extensions.connection:
+    if _pool is not None:
+        try:
+            conn = _pool.getconn()
+            conn.pool = _pool
+            return conn
+        except PoolError:
+            pass  # Every pooled connection is taken, open one of its own
+    conn = psycopg2.connect(**connection_params())
     print(f"Connected to PostgreSQL at {os.getenv('POSTGRES_HOST', 'localhost')}:{os.getenv('POSTGRES_PORT', '5432')}, db '{os.getenv('POSTGRES_DB')}'")
     return conn
 
 
+# Schema added on top of the base tables (products, groups), in creation order
+SCHEMA_COLUMNS = {
+    "store_stock": "ALTER TABLE products ADD COLUMN IF NOT EXISTS store_stock BYTEA",
+    "store_prices": "ALTER TABLE products ADD COLUMN IF NOT EXISTS store_prices INTEGER[]",
+}
+SCHEMA_RELATIONS = {
+    "market_stores": """
+        CREATE TABLE IF NOT EXISTS market_stores (
+            market TEXT PRIMARY KEY,
+            store_ids TEXT[] NOT NULL,
+            updated_at TIMESTAMP NOT NULL
+        )
+    """,
+    "promotions": """
+        CREATE TABLE IF NOT EXISTS promotions (
+            product_id UUID PRIMARY KEY,
+            market TEXT NOT NULL,
+            regular_price INTEGER NOT NULL,
+            promo_price INTEGER NOT NULL,
+            percent REAL NOT NULL,
+            valid_from DATE,
+            valid_to DATE,
+            updated_at TIMESTAMP NOT NULL
+        )
+    """,
+    "promotions_market_idx": "CREATE INDEX IF NOT EXISTS promotions_market_idx ON promotions (market)",
+    "products_category_idx": "CREATE INDEX IF NOT EXISTS products_category_idx ON products (main_category, sub_category)",
+}
+SCHEMA_LOCK_KEY = 7267530  # pg_advisory_xact_lock key serializing schema setup across processes
+
+_schema_ready = False
+
+
+def ensure_schema(conn: psycopg2.extensions.connection) -> None:
+    """
+    Create the SCHEMA_COLUMNS / SCHEMA_RELATIONS that are missing, once per process.
+
+    Called at startup (API, run_pipeline) and before a scraper's first save, in its own
+    transaction. Once everything exists it only reads the catalog, so it takes no lock
+    on products; a first setup is serialized across processes with an advisory lock.
+    """
+    global _schema_ready
+    if _schema_ready:
+        return
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT column_name FROM information_schema.columns WHERE table_name = 'products' AND column_name = ANY(%s)",
+        (list(SCHEMA_COLUMNS),)
+    )
+    existing = {row[0] for row in cursor.fetchall()}
+    for name in SCHEMA_RELATIONS:
+        cursor.execute("SELECT to_regclass(%s) IS NOT NULL", (name,))
+        if cursor.fetchone()[0]:
+            existing.add(name)
+    missing = [ddl for name, ddl in {**SCHEMA_COLUMNS, **SCHEMA_RELATIONS}.items() if name not in existing]
+    if missing:
+        cursor.execute("SELECT pg_advisory_xact_lock(%s)", (SCHEMA_LOCK_KEY,))
+        for ddl in missing:
+            cursor.execute(ddl)
+        print(f"Created {len(missing)} missing schema objects")
+    conn.commit()
+    cursor.close()
+    _schema_ready = True
+
+
 def mark_out_of_stock_products_table(conn: psycopg2.extensions.connection, market: str, product_names: set):
     cursor = conn.cursor()
     cursor.execute("SELECT id, name FROM products WHERE market = %s AND in_stock = true", (market,))
 
     ids_to_update = [row[0] for row in cursor.fetchall() if row[1] not in product_names]
 
-    if ids_to_update:
-        cursor.execute(
-            "UPDATE products SET in_stock = false, last_updated = %s WHERE id = ANY(%s::uuid[])",
-            (datetime.now(), ids_to_update)
-        )
-    conn.commit()
+    with span("db.write.out_of_stock", market=market, rows=len(ids_to_update)):
+        if ids_to_update:
+            cursor.execute(
+                "UPDATE products SET in_stock = false, last_updated = %s WHERE id = ANY(%s::uuid[])",
+                (datetime.now(), ids_to_update)
+            )
+        conn.commit()
+    count("db.rows.out_of_stock", len(ids_to_update))
     cursor.close()
 
 
@@ -52,12 +167,15 @@ def bulk_upsert_products_table(conn: psycopg2.extensions.connection, products: l
         ON CONFLICT (id) DO UPDATE SET {update_set}
     """
     data = [tuple(prod.get(col) for col in columns) for prod in products]
-    execute_values(cursor, insert_sql, data, page_size=5000)
-    conn.commit()
+    with span("db.write.products", rows=len(data)):
+        execute_values(cursor, insert_sql, data, page_size=5000)
+        conn.commit()
+    count("db.rows.products", len(data))
     cursor.close()
 
 
-def save_products_to_products_table(conn: psycopg2.extensions.connection, market: str, products_to_upsert: list, all_product_names: set):
+def save_products_to_products_table(conn: psycopg2.extensions.connection, market: str, products_to_upsert: list, all_product_names: set, mark_missing: bool = True):
+    """Upsert products and, unless mark_missing is False, mark the market's other products out of stock."""
     save_start = time.time()
 
     for prod in products_to_upsert:
@@ -74,10 +192,10 @@ def save_products_to_products_table(conn: psycopg2.extensions.connection, market
         bulk_upsert_products_table(conn, products_to_upsert)
 
     print(f"Saved to PostgreSQL in {round(time.time() - save_start, 2)}s")
-    mark_start = time.time()
-    mark_out_of_stock_products_table(conn, market, all_product_names)
-    print(f"Marked out of stock products in {round(time.time() - mark_start, 2)}s")
-    conn.close()
+    if mark_missing:
+        mark_start = time.time()
+        mark_out_of_stock_products_table(conn, market, all_product_names)
+        print(f"Marked out of stock products in {round(time.time() - mark_start, 2)}s")
 
 
 def get_products_by_market(conn: psycopg2.extensions.connection, market: str) -> dict:
@@ -88,7 +206,56 @@ def get_products_by_market(conn: psycopg2.extensions.connection, market: str) ->
     return result
 
 
-def load_products_to_categorize(conn: psycopg2.extensions.connection, limit: int = None) -> List[dict]:
+def save_market_stores(conn: psycopg2.extensions.connection, market: str, store_ids: List[str]):
+    """
+    Record which store each bit of products.store_stock and each element of
+    products.store_prices stands for (see ensure_schema for those columns and the table).
+    """
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT INTO market_stores (market, store_ids, updated_at)
+        VALUES (%s, %s, %s)
+        ON CONFLICT (market) DO UPDATE SET store_ids = EXCLUDED.store_ids, updated_at = EXCLUDED.updated_at
+    """, (market, list(store_ids), datetime.now()))
+    conn.commit()
+    cursor.close()
+
+
+def save_promotions(conn: psycopg2.extensions.connection, market: str, promotions: List[dict], product_ids: List[str], replace: bool):
+    """
+    Upsert a market's promotions (rows keyed by product_id) and drop the ones that ended:
+    those of product_ids without a promotion now, or with replace (a full scrape) every
+    other promotion of the market.
+    """
+    cursor = conn.cursor()
+    promotion_ids = [row['product_id'] for row in promotions]
+    if replace:
+        cursor.execute(
+            "DELETE FROM promotions WHERE market = %s AND NOT (product_id = ANY(%s::uuid[]))",
+            (market, promotion_ids)
+        )
+    else:
+        ended = list(set(product_ids) - set(promotion_ids))
+        if ended:
+            cursor.execute("DELETE FROM promotions WHERE product_id = ANY(%s::uuid[])", (ended,))
+
+    if promotions:
+        columns = list(promotions[0].keys())
+        update_set = ', '.join([f"{col} = EXCLUDED.{col}" for col in columns if col != 'product_id'])
+        with span("db.write.promotions", market=market, rows=len(promotions)):
+            execute_values(cursor, f"""
+                INSERT INTO promotions ({', '.join(columns)})
+                VALUES %s
+                ON CONFLICT (product_id) DO UPDATE SET {update_set}
+            """, [tuple(row[col] for col in columns) for row in promotions], page_size=5000)
+    conn.commit()
+    count("db.rows.promotions", len(promotions))
+    cursor.close()
+    print(f"Saved {len(promotions)} promotions")
+
+
+def load_products_to_categorize(conn: psycopg2.extensions.connection, limit: int = None, market: str = None) -> List[dict]:
+    """Products without a valid categorization, optionally only those of one market."""
     products = []
     cursor = conn.cursor(cursor_factory=RealDictCursor)
     main_cats = set(CATEGORIES.keys())
@@ -97,13 +264,14 @@ def load_products_to_categorize(conn: psycopg2.extensions.connection, limit: int
     query = f"""
         SELECT id, name, description, market
         FROM products 
-        WHERE main_category IS NULL 
+        WHERE (main_category IS NULL 
            OR confidence IS NULL 
-           OR confidence < 0.5
+           OR confidence < 0.5)
+          AND (%(market)s IS NULL OR market = %(market)s)
     """
     if limit:
         query += f" LIMIT {limit}"
-    cursor.execute(query)
+    cursor.execute(query, {'market': market})
 
     for row in cursor.fetchall():
         products.append({
@@ -122,8 +290,9 @@ def load_products_to_categorize(conn: psycopg2.extensions.connection, limit: int
           AND sub_category IS NOT NULL
           AND confidence IS NOT NULL
           AND confidence >= 0.5
+          AND (%(market)s IS NULL OR market = %(market)s)
     """
-    cursor.execute(query2)
+    cursor.execute(query2, {'market': market})
 
     for row in cursor.fetchall():
         main_cat = row['main_category']
@@ -151,6 +320,29 @@ def load_products_to_categorize(conn: psycopg2.extensions.connection, limit: int
     return products
 
 
+def load_confident_categorizations(conn: psycopg2.extensions.connection, min_confidence: float = 0.9) -> List[dict]:
+    """Load already-categorized products whose confidence is high enough to be reused for duplicates."""
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    cursor.execute("""
+        SELECT name, description, main_category, sub_category, confidence, reasoning
+        FROM products
+        WHERE main_category IS NOT NULL
+          AND sub_category IS NOT NULL
+          AND confidence >= %s
+    """, (min_confidence,))
+
+    rows = []
+    for row in cursor.fetchall():
+        main_cat = row['main_category']
+        if main_cat not in CATEGORIES or row['sub_category'] not in CATEGORIES[main_cat]:
+            continue
+        rows.append(dict(row))
+
+    cursor.close()
+    print(f"📚 Loaded {len(rows)} confident categorizations for reuse")
+    return rows
+
+
 def batch_update_products(conn: psycopg2.extensions.connection, products: List[dict], fields_to_update: List[str], batch_size: int = 500):
     if not products:
         return
@@ -163,6 +355,24 @@ def batch_update_products(conn: psycopg2.extensions.connection, products: List[d
         if len(batch) >= batch_size:
             set_clause = ', '.join([f"{f} = v.{f}" for f in fields_to_update])
             value_cols = ', '.join(fields_to_update + ['id'])
+            with span("db.write.product_updates", rows=len(batch)):
+                execute_values(
+                    cursor,
+                    f"""
+                    UPDATE products AS p
+                    SET {set_clause}
+                    FROM (VALUES %s) AS v({value_cols})
+                    WHERE p.id = v.id::uuid
+                    """,
+                    batch
+                )
+                conn.commit()
+            count("db.rows.product_updates", len(batch))
+            batch.clear()
+    if batch:
+        set_clause = ', '.join([f"{f} = v.{f}" for f in fields_to_update])
+        value_cols = ', '.join(fields_to_update + ['id'])
+        with span("db.write.product_updates", rows=len(batch)):
             execute_values(
                 cursor,
                 f"""
@@ -174,21 +384,7 @@ def batch_update_products(conn: psycopg2.extensions.connection, products: List[d
                 batch
             )
             conn.commit()
-            batch.clear()
-    if batch:
-        set_clause = ', '.join([f"{f} = v.{f}" for f in fields_to_update])
-        value_cols = ', '.join(fields_to_update + ['id'])
-        execute_values(
-            cursor,
-            f"""
-            UPDATE products AS p
-            SET {set_clause}
-            FROM (VALUES %s) AS v({value_cols})
-            WHERE p.id = v.id::uuid
-            """,
-            batch
-        )
-        conn.commit()
+        count("db.rows.product_updates", len(batch))
     cursor.close()
 
 
@@ -208,6 +404,68 @@ def save_categorizations_to_db(conn: psycopg2.extensions.connection, products: L
     batch_update_products(conn, updates, ['main_category', 'sub_category', 'confidence', 'reasoning', 'categorized_at'], batch_size)
     print(f"   Updated: {len(products)}")
 
+# Reasoning of categorizations copied from neighbours; they don't serve as neighbours themselves
+PROPAGATED_REASONING_PREFIX = "Propagated from "
+
+
+def find_categorized_neighbours(conn: psycopg2.extensions.connection, rows: List[tuple], k: int = 10, min_confidence: float = 0.7) -> Dict[str, List[dict]]:
+    """
+    The k nearest already-categorized products of each (embedding, id) row, excluding the
+    product itself and categorizations that were propagated rather than made by the LLM,
+    so propagation errors don't compound. One query (a LATERAL kNN per row) for all rows.
+    """
+    neighbours = {product_id: [] for _, product_id in rows}
+    if not rows:
+        return neighbours
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    cur.execute("""
+        SELECT q.id AS product_id, n.main_category, n.sub_category, n.similarity
+        FROM unnest(%s::text[], %s::text[]) AS q(id, embedding)
+        CROSS JOIN LATERAL (
+            SELECT main_category, sub_category,
+                   1 - (name_embedding <=> q.embedding::vector) AS similarity
+            FROM products
+            WHERE name_embedding IS NOT NULL
+              AND main_category IS NOT NULL
+              AND sub_category IS NOT NULL
+              AND confidence >= %s
+              AND (reasoning IS NULL OR reasoning NOT LIKE %s)
+              AND id != q.id::uuid
+            ORDER BY name_embedding <=> q.embedding::vector
+            LIMIT %s
+        ) n
+    """, (
+        [product_id for _, product_id in rows],
+        ["[" + ",".join(map(str, embedding)) + "]" for embedding, _ in rows],
+        min_confidence, PROPAGATED_REASONING_PREFIX + "%", k,
+    ))
+    for row in cur.fetchall():
+        neighbours[row.pop("product_id")].append(row)
+    cur.close()
+    return neighbours
+
+
+def save_name_embeddings(conn: psycopg2.extensions.connection, rows: List[tuple]):
+    """Store (embedding, id) rows in products.name_embedding."""
+    if not rows:
+        return
+    cur = conn.cursor()
+    with span("db.write.embeddings", rows=len(rows)):
+        execute_values(
+            cur,
+            """
+            UPDATE products AS p
+            SET name_embedding = v.embedding
+            FROM (VALUES %s) AS v(embedding, id)
+            WHERE p.id = v.id::uuid
+            """,
+            rows
+        )
+        conn.commit()
+    count("db.rows.embeddings", len(rows))
+    cur.close()
+
+
 def group_products_by_category(conn: psycopg2.extensions.connection, main_category: str, sub_category: str, similarity_threshold: float = 0.98):
     cur = conn.cursor(cursor_factory=RealDictCursor)
 
@@ -227,6 +485,7 @@ def group_products_by_category(conn: psycopg2.extensions.connection, main_catego
         return
 
     print(f"Found {len(ungrouped_products)} ungrouped products in '{sub_category}'")
+    count("group.products", len(ungrouped_products))
 
     for product in ungrouped_products:
         product_id = product['id']
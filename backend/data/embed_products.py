@@ -1,37 +1,32 @@
+import argparse
 import psycopg2
 import numpy as np
-from dotenv import find_dotenv, load_dotenv
-import os
-import asyncio
 from langchain_google_genai import GoogleGenerativeAIEmbeddings
 import time
 from backend.data.constants import *
-from psycopg2.extras import execute_values
-from backend.data.RateLimiter import RateLimiter
-from backend.data.text_utils import normalize_name, get_embeddings_client, normalize_embedding
+from backend.data.db_utils import connect_to_db, save_name_embeddings
+from backend.data.metrics import count, span
+from backend.data.RateLimiter import SharedRateLimiter
+from backend.data.text_utils import normalize_name, get_embeddings_client, normalize_embedding, is_throttling_error
 
-load_dotenv(find_dotenv())
 BATCH_SIZE = 100
-conn = psycopg2.connect(
-    host=os.getenv("POSTGRES_HOST", "localhost"),
-    port=os.getenv("POSTGRES_PORT", "5432"),
-    database=os.getenv("POSTGRES_DB", "postgres"),
-    user=os.getenv("POSTGRES_USER", "user"),
-    password=os.getenv("POSTGRES_PASSWORD", "password")
+# Shared with categorize_products' neighbour propagation, which embeds with the same quota
+rate_limiter = SharedRateLimiter(
+    "gemini-embedding-001", rpm_limit=2850, tpm_limit=1000000,
+    adaptive=True, max_rpm_limit=3000, max_tpm_limit=1000000,
 )
 
-embeddings = get_embeddings_client()
-rate_limiter = RateLimiter(rpm_limit=2850, tpm_limit=1000000)
 
-
-def embed_category_products(category: str, sub_category: str, embeddings: GoogleGenerativeAIEmbeddings, conn: psycopg2.extensions.connection):
+def embed_category_products(category: str, sub_category: str, embeddings: GoogleGenerativeAIEmbeddings, conn: psycopg2.extensions.connection,
+                            market: str = None):
     start = time.time()
     print(f"Embedding products for category '{category}' and sub-category '{sub_category}'...")
     cur = conn.cursor()
     cur.execute("""SELECT id, name FROM products 
                     WHERE main_category = %s 
                     AND sub_category = %s
-                    AND name_embedding IS NULL""", (category, sub_category))
+                    AND name_embedding IS NULL
+                    AND (%s IS NULL OR market = %s)""", (category, sub_category, market, market))
     products = cur.fetchall()
     if not products:
         cur.close()
@@ -47,38 +42,46 @@ def embed_category_products(category: str, sub_category: str, embeddings: Google
         batch_tokens = sum(len(n) for n in batch_names) // 4
 
         for _ in range(len(batch_names)):
-            asyncio.run(rate_limiter.acquire(batch_tokens // len(batch_names)))
+            rate_limiter.acquire_sync(batch_tokens // len(batch_names))
 
-        vectors = embeddings.embed_documents(batch_names, batch_size=len(batch_names))
+        try:
+            with span("embedding.request", texts=len(batch_names)):
+                vectors = embeddings.embed_documents(batch_names, batch_size=len(batch_names))
+        except Exception as e:
+            if is_throttling_error(e):
+                rate_limiter.report_throttled()  # Slows down every process embedding on this host
+            raise
+        count("embedding.texts", len(batch_names))
 
         for i, product in enumerate(batch_products):
             embedding = np.array(vectors[i])
             embedding = normalize_embedding(embedding)
             all_rows.append((embedding.tolist(), str(product[0])))
 
-    execute_values(
-        cur,
-        """
-        UPDATE products AS p
-        SET name_embedding = v.embedding
-        FROM (VALUES %s) AS v(embedding, id)
-        WHERE p.id = v.id::uuid
-        """,
-        all_rows
-    )
-    conn.commit()
     cur.close()
+    save_name_embeddings(conn, all_rows)
     print(f"Finished embedding {len(all_rows)} products for '{category}' -> '{sub_category}' in {round(time.time() - start, 2)}s.")
 
-for main_category in CATEGORIES.keys():
-    main_start = time.time()
-    if main_category == 'Разно':
-        continue
-    sub_categories = CATEGORIES[main_category]
-    for sub_category in sub_categories:
-        if sub_category == 'Останато':
-            print(f"Skipping sub-category '{sub_category}' in main category '{main_category}'")
+
+def main(market: str = None):
+    """Embed the names of categorized products without an embedding (only one market's with `market`)."""
+    conn = connect_to_db()
+    embeddings = get_embeddings_client()
+    for main_category in CATEGORIES.keys():
+        main_start = time.time()
+        if main_category == 'Разно':
             continue
-        embed_category_products(main_category, sub_category, embeddings, conn)
-    print(f"Finished embedding for main category '{main_category}' in {round(time.time() - main_start, 2)} seconds.")
-conn.close()
+        sub_categories = CATEGORIES[main_category]
+        for sub_category in sub_categories:
+            if sub_category == 'Останато':
+                print(f"Skipping sub-category '{sub_category}' in main category '{main_category}'")
+                continue
+            embed_category_products(main_category, sub_category, embeddings, conn, market)
+        print(f"Finished embedding for main category '{main_category}' in {round(time.time() - main_start, 2)} seconds.")
+    conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Embed product names.")
+    parser.add_argument("--market", help="Only embed this market's products")
+    main(parser.parse_args().market)
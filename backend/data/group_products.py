@@ -1,5 +1,8 @@
+from typing import List, Tuple
+
 from backend.data.db_utils import *
 from backend.data.constants import CATEGORIES
+from backend.data.metrics import span
 
 GROUPING_THRESHOLDS = {
     'Основни намирници': {
@@ -19,23 +22,43 @@ GROUPING_THRESHOLDS = {
 }
 
 
-if __name__ == "__main__":
-    conn = connect_to_db()
-    for main_category, sub_categories in GROUPING_THRESHOLDS.items():
-        for sub_category in sub_categories:
-            threshold = GROUPING_THRESHOLDS[main_category][sub_category]
-            print(f"Grouping products for main category '{main_category}' and sub-category '{sub_category}' with threshold {threshold}...")
-            group_products_by_category(conn, main_category, sub_category, threshold)
-    print("Finished grouping products with specific thresholds. Now processing remaining categories with default threshold 0.95...")
+DEFAULT_THRESHOLD = 0.95
+
+
+def grouped_sub_categories() -> List[Tuple[str, str]]:
+    """(main_category, sub_category) pairs that get grouped, the ones with specific thresholds first."""
+    pairs = [(main, sub) for main, subs in GROUPING_THRESHOLDS.items() for sub in subs]
     for main_category in CATEGORIES.keys():
         if main_category == 'Разно':
-            print(f"Skipping grouping for main category '{main_category}'")
             continue
         for sub_category in CATEGORIES[main_category]:
-            if sub_category == 'Останато':
-                print(f"Skipping grouping for sub-category '{sub_category}' in main category '{main_category}'")
-                continue
-            if main_category not in GROUPING_THRESHOLDS or sub_category not in GROUPING_THRESHOLDS[main_category]:
-                print(f"No specific threshold for '{main_category}' -> '{sub_category}', using default 0.95")
-                group_products_by_category(conn, main_category, sub_category, 0.95)
+            if sub_category != 'Останато' and (main_category, sub_category) not in pairs:
+                pairs.append((main_category, sub_category))
+    return pairs
+
+
+def grouping_threshold(main_category: str, sub_category: str) -> float:
+    return GROUPING_THRESHOLDS.get(main_category, {}).get(sub_category, DEFAULT_THRESHOLD)
+
+
+def main(main_category: str = None, sub_category: str = None):
+    """Group every grouped sub-category, or only those matching main_category / sub_category."""
+    conn = connect_to_db()
+    for main, sub in grouped_sub_categories():
+        if (main_category and main != main_category) or (sub_category and sub != sub_category):
+            continue
+        threshold = grouping_threshold(main, sub)
+        print(f"Grouping products for main category '{main}' and sub-category '{sub}' with threshold {threshold}...")
+        with span("group.sub_category", main_category=main, sub_category=sub, threshold=threshold):
+            group_products_by_category(conn, main, sub, threshold)
     conn.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Group products of the same item across markets.")
+    parser.add_argument("--main-category", help="Only group this main category")
+    parser.add_argument("--sub-category", help="Only group this sub-category")
+    args = parser.parse_args()
+    main(args.main_category, args.sub_category)
@@ -0,0 +1,207 @@
+"""
+Run metrics: timed spans and counters around the pipeline's hot spots (HTTP fetch,
+parse, DB write, LLM request, embedding request, grouping per sub-category).
+
+Spans and counters go to the Recorder of the current context. run_module gives every
+in-process node its own, which the threads it starts through map_concurrently and
+asyncio.to_thread inherit; everything else records into the process-wide one. The
+runners put Recorder.summary() in a node's result and merge_summaries() of all of them
+in the run summary.
+
+Optional outputs, each off unless its variable is set:
+- CENAPLUS_TRACE_FILE: every finished span as a JSON line (name, seconds, attributes)
+- CENAPLUS_METRICS_FILE: the process recorder's summary, written at exit; run_script
+  sets it to read a subprocess node's metrics back
+- OTEL_EXPORTER_OTLP_ENDPOINT: spans exported over OTLP/HTTP to an OpenTelemetry
+  collector (e.g. http://localhost:4318), named after OTEL_SERVICE_NAME. Needs
+  opentelemetry-sdk and opentelemetry-exporter-otlp-proto-http, which aren't in the
+  requirements; without them export is disabled with a warning
+"""
+import atexit
+import contextvars
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+TRACE_FILE_ENV = "CENAPLUS_TRACE_FILE"
+METRICS_FILE_ENV = "CENAPLUS_METRICS_FILE"
+OTLP_ENDPOINT_ENV = "OTEL_EXPORTER_OTLP_ENDPOINT"
+DEFAULT_SERVICE_NAME = "cenaplus-data"
+
+
+class Recorder:
+    """Thread-safe totals per span name (count, errors, seconds, slowest) and counters."""
+
+    def __init__(self, name: str = "process"):
+        self.name = name
+        self.spans: Dict[str, Dict[str, float]] = {}
+        self.counters: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def add_span(self, name: str, seconds: float, error: bool = False) -> None:
+        with self._lock:
+            stats = self.spans.setdefault(name, {"count": 0, "errors": 0, "seconds": 0.0, "max_seconds": 0.0})
+            stats["count"] += 1
+            stats["errors"] += int(error)
+            stats["seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+
+    def add(self, name: str, value: float = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self) -> Dict[str, Any]:
+        """JSON-serializable totals, as stored in run results."""
+        with self._lock:
+            return {
+                "spans": {name: {**stats, "seconds": round(stats["seconds"], 3), "max_seconds": round(stats["max_seconds"], 3)}
+                          for name, stats in sorted(self.spans.items())},
+                "counters": dict(sorted(self.counters.items())),
+            }
+
+
+def merge_summaries(summaries: Iterable[Optional[Dict[str, Any]]]) -> Dict[str, Any]:
+    """Totals of several Recorder summaries (e.g. every node of a run); None entries are skipped."""
+    merged = Recorder("merged")
+    for summary in summaries:
+        if not summary:
+            continue
+        for name, stats in summary.get("spans", {}).items():
+            total = merged.spans.setdefault(name, {"count": 0, "errors": 0, "seconds": 0.0, "max_seconds": 0.0})
+            total["count"] += stats["count"]
+            total["errors"] += stats["errors"]
+            total["seconds"] += stats["seconds"]
+            total["max_seconds"] = max(total["max_seconds"], stats["max_seconds"])
+        for name, value in summary.get("counters", {}).items():
+            merged.add(name, value)
+    return merged.summary()
+
+
+def report(summary: Dict[str, Any], top: int = 10) -> List[str]:
+    """Lines for the console: the spans with the most total time, then the counters."""
+    spans = sorted(summary.get("spans", {}).items(), key=lambda item: item[1]["seconds"], reverse=True)
+    lines = [
+        f"{name:<28} {stats['count']:>7}x {stats['seconds']:>10.2f}s  max {stats['max_seconds']:.2f}s"
+        + (f"  {stats['errors']} errors" if stats["errors"] else "")
+        for name, stats in spans[:top]
+    ]
+    lines += [f"{name:<28} {value:>12,.0f}" for name, value in summary.get("counters", {}).items()]
+    return lines
+
+
+process_recorder = Recorder()
+_current: contextvars.ContextVar[Optional[Recorder]] = contextvars.ContextVar("metrics_recorder", default=None)
+
+
+def current() -> Recorder:
+    return _current.get() or process_recorder
+
+
+@contextmanager
+def recording(recorder: Recorder) -> Iterator[Recorder]:
+    """Record this context's spans and counters (and those of tasks and threads started from it) into recorder."""
+    token = _current.set(recorder)
+    try:
+        yield recorder
+    finally:
+        _current.reset(token)
+
+
+def count(name: str, value: float = 1) -> None:
+    current().add(name, value)
+
+
+_trace_lock = threading.Lock()
+_trace_file = None
+
+
+def trace_event(event: Dict[str, Any]) -> None:
+    global _trace_file
+    path = os.environ.get(TRACE_FILE_ENV)
+    if not path:
+        return
+    line = json.dumps(event, ensure_ascii=False, default=str)
+    with _trace_lock:
+        if _trace_file is None:
+            _trace_file = open(path, "a", encoding="utf-8", buffering=1)
+            atexit.register(_trace_file.close)
+        _trace_file.write(line + "\n")
+
+
+_tracer_lock = threading.Lock()
+_tracer = None
+
+
+def otel_tracer():
+    """OpenTelemetry tracer exporting to OTEL_EXPORTER_OTLP_ENDPOINT, None when that isn't set or the SDK is missing."""
+    global _tracer
+    if not os.environ.get(OTLP_ENDPOINT_ENV):
+        return None
+    with _tracer_lock:
+        if _tracer is None:
+            try:
+                from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+                from opentelemetry.sdk.resources import Resource
+                from opentelemetry.sdk.trace import TracerProvider
+                from opentelemetry.sdk.trace.export import BatchSpanProcessor
+            except ImportError as e:
+                print(f"OpenTelemetry export disabled: {e}")
+                _tracer = False
+            else:
+                service = os.environ.get("OTEL_SERVICE_NAME", DEFAULT_SERVICE_NAME)
+                provider = TracerProvider(resource=Resource.create({"service.name": service}))
+                provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+                atexit.register(provider.shutdown)  # Flushes the spans still queued
+                _tracer = provider.get_tracer(__name__)
+        return _tracer or None
+
+
+def otel_value(value):
+    return value if isinstance(value, (str, bool, int, float)) else str(value)
+
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator[Dict[str, Any]]:
+    """
+    Time the block as a span of the current recorder. Yields the attributes, so the
+    block can add what it learns (status, rows, ...) to the trace line / OTel span.
+    An exception counts as an error and is re-raised.
+    """
+    tracer = otel_tracer()
+    otel_span = tracer.start_as_current_span(name) if tracer else nullcontext()
+    error = None
+    start = time.perf_counter()
+    with otel_span as otel:
+        try:
+            yield attributes
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            recorder = current()
+            recorder.add_span(name, seconds, error is not None)
+            if otel is not None:
+                otel.set_attributes({key: otel_value(value) for key, value in attributes.items() if value is not None})
+            trace_event({
+                "ts": datetime.now().isoformat(timespec="milliseconds"),
+                "span": name,
+                "seconds": round(seconds, 4),
+                "recorder": recorder.name,
+                "thread": threading.current_thread().name,
+                **attributes,
+                **({"error": repr(error)} if error is not None else {}),
+            })
+
+
+def write_summary(path: str) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(process_recorder.summary(), f, ensure_ascii=False, indent=2)
+
+
+if os.environ.get(METRICS_FILE_ENV):
+    atexit.register(write_summary, os.environ[METRICS_FILE_ENV])
@@ -1,67 +1,267 @@
-"""Run the full data pipeline: scrape → categorize → embed → group."""
+"""
+Run the full data pipeline as a DAG: scrape → categorize → embed per market, then group per sub-category.
+
+Each market's products move on to categorization and embedding as soon as its scraper
+finishes, instead of waiting for the slowest scraper and every stage before them.
+Grouping a sub-category compares products across markets, so it starts once every
+market's embedding node has finished (passed or given up on); a broken scraper only
+holds back its own market.
+
+Failed nodes are retried on their own (with backoff) and their dependents are skipped,
+while the rest of the DAG carries on. The run state is saved after every node, so
+--resume skips the nodes that already passed, unless something upstream of them runs again.
+
+Nodes run in this process by default, calling each stage's main() on a worker thread:
+pandas, langchain, google-genai etc. are imported once instead of by every node's
+interpreter, and the stages share the embeddings client and a pool of DB connections.
+--subprocess runs every node in a fresh interpreter instead, for isolation.
+
+Every node's result carries its metrics (time in HTTP fetches, parsing, DB writes, LLM
+and embedding requests, grouping; see metrics.py) and the state file their totals.
+"""
 from __future__ import annotations
-import os
-import subprocess
+import argparse
+import json
+import re
 import sys
 import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from datetime import datetime
 from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
 
-from run_scrapers import find_scraper_scripts
+from backend.data.db_utils import close_connection_pool, connect_to_db, ensure_schema, use_connection_pool
+from backend.data.group_products import grouped_sub_categories
+from backend.data.metrics import merge_summaries, report
+from backend.data.run_scrapers import PROJECT_ROOT, find_scraper_scripts, run_module, run_script, script_module, timestamp
 
-PROJECT_ROOT = str(Path(__file__).resolve().parents[2])
+DATA_DIR = Path(__file__).parent.resolve()
+DEFAULT_LOGS_DIR = DATA_DIR / "logs"
+DEFAULT_STATE_PATH = DEFAULT_LOGS_DIR / "pipeline_state.json"
 
-SCRIPTS = [
-    "run_scrapers.py",
-    "categorize_products.py",
-    "embed_products.py",
-    "group_products.py",
-]
+DEFAULT_RETRIES = 2
+RETRY_BASE_DELAY = 30.0
 
-def main() -> int:
-    data_dir = Path(__file__).parent.resolve()
-    failed = []
-
-    num_scrapers = len(find_scraper_scripts(data_dir / "scrapers"))
-
-    for script in SCRIPTS:
-        path = data_dir / script
-        if not path.exists():
-            print(f"Script not found: {path}")
-            failed.append(script)
-            continue
-
-        print(f"\n{'='*60}")
-        print(f"Running {script}...")
-        print(f"{'='*60}")
-        start = time.perf_counter()
-        env = os.environ.copy()
-        env["PYTHONPATH"] = PROJECT_ROOT
-
-        cmd = [sys.executable, str(path)]
-        if script == "run_scrapers.py" and num_scrapers > 0:
-            cmd += ["--parallel", str(num_scrapers)]
-
-        result = subprocess.run(
-            cmd,
-            cwd=str(data_dir),
-            env=env,
-        )
-        elapsed = round(time.perf_counter() - start, 2)
-
-        if result.returncode != 0:
-            print(f"{script} failed (exit code {result.returncode}) after {elapsed}s")
-            failed.append(script)
+PASSED, FAILED, SKIPPED, PENDING = "passed", "failed", "skipped", "pending"
+DONE = (PASSED, FAILED, SKIPPED)
+
+
+@dataclass
+class Node:
+    name: str
+    module: str  # Its main(**kwargs) is the node's work; as a script it takes them as --options
+    kwargs: Dict[str, str] = field(default_factory=dict)
+    requires: Tuple[str, ...] = ()  # Must pass, otherwise this node is skipped
+    after: Tuple[str, ...] = ()  # Must have finished, whatever the outcome
+    lock: Optional[str] = None  # Nodes sharing a lock run one at a time
+
+    @property
+    def script(self) -> Path:
+        return Path(PROJECT_ROOT, *self.module.split(".")).with_suffix(".py")
+
+    @property
+    def args(self) -> List[str]:
+        return [arg for key, value in self.kwargs.items() for arg in ("--" + key.replace("_", "-"), value)]
+
+
+def scraper_market(script: Path) -> str:
+    """The MARKET_NAME a scraper script saves its products under."""
+    match = re.search(r"^MARKET_NAME\s*=\s*['\"]([^'\"]+)['\"]", script.read_text(encoding="utf-8"), re.MULTILINE)
+    return match.group(1) if match else script.stem.removesuffix("_scraper").lower()
+
+
+def build_dag(scrapers_dir: Path) -> Dict[str, Node]:
+    nodes: List[Node] = []
+    embed_nodes = []
+    for script in find_scraper_scripts(scrapers_dir):
+        market = scraper_market(script)
+        nodes.append(Node(f"scrape:{market}", script_module(script)))
+        # Categorization shares the Gemini quota and the dead-letter file, so markets take turns;
+        # later markets then also reuse the earlier ones' categorizations of the same items
+        nodes.append(Node(f"categorize:{market}", "backend.data.categorize_products", {"market": market},
+                          requires=(f"scrape:{market}",), lock="categorize"))
+        nodes.append(Node(f"embed:{market}", "backend.data.embed_products", {"market": market},
+                          requires=(f"categorize:{market}",)))
+        embed_nodes.append(f"embed:{market}")
+
+    for main_category, sub_category in grouped_sub_categories():
+        nodes.append(Node(f"group:{main_category}/{sub_category}", "backend.data.group_products",
+                          {"main_category": main_category, "sub_category": sub_category},
+                          after=tuple(embed_nodes)))
+    return {node.name: node for node in nodes}
+
+
+def load_state(path: Path) -> Dict[str, Any]:
+    if not path.exists():
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_state(state: Dict[str, Any], path: Path) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+    tmp.replace(path)
+
+
+def run_node(node: Node, logs_dir: Path, retries: int, in_process: bool) -> Dict[str, Any]:
+    """Run a node, retrying failures with exponential backoff."""
+    for attempt in range(retries + 1):
+        if attempt:
+            delay = RETRY_BASE_DELAY * 2 ** (attempt - 1)
+            print(f"Retrying {node.name} in {delay:.0f}s (attempt {attempt + 1}/{retries + 1})")
+            time.sleep(delay)
+        if in_process:
+            result = run_module(node.module, logs_dir, stream=True, kwargs=node.kwargs, label=node.name)
+        else:
+            result = run_script(node.script, logs_dir, stream=True, args=node.args, label=node.name)
+        result["attempts"] = attempt + 1
+        if result["status"] == PASSED:
             break
-        print(f"{script} completed in {elapsed}s")
+    return result
+
+
+def resume_status(nodes: Dict[str, Node], results: Dict[str, Any]) -> Dict[str, str]:
+    """
+    Starting status of every node when resuming: PASSED for the nodes that passed last
+    time, unless a node they depend on (through requires or after, transitively) runs
+    again, since its output would then be newer than theirs.
+    """
+    status = {name: PASSED if results.get(name, {}).get("status") == PASSED else PENDING for name in nodes}
+    dependents: Dict[str, List[str]] = {name: [] for name in nodes}
+    for name, node in nodes.items():
+        for dep in node.requires + node.after:
+            dependents[dep].append(name)
+
+    rerun = [name for name, s in status.items() if s == PENDING]
+    while rerun:
+        for dependent in dependents[rerun.pop()]:
+            if status[dependent] == PASSED:
+                status[dependent] = PENDING
+                rerun.append(dependent)
+    return status
+
+
+def run_dag(nodes: Dict[str, Node], state: Dict[str, Any], state_path: Path, logs_dir: Path,
+            max_workers: int, retries: int, in_process: bool = True) -> Dict[str, Any]:
+    results = state.setdefault("nodes", {})
+    status = resume_status(nodes, results)
+    resumed = [name for name, s in status.items() if s == PASSED]
+    if resumed:
+        print(f"Resuming: skipping {len(resumed)} nodes that already passed")
+
+    running: Dict[Any, str] = {}
+    held_locks = set()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            for name, node in nodes.items():
+                if status[name] != PENDING:
+                    continue
+                if any(status[dep] in (FAILED, SKIPPED) for dep in node.requires):
+                    status[name] = SKIPPED
+                    results[name] = {"name": name, "status": SKIPPED,
+                                     "reason": "failed dependency: " + ", ".join(
+                                         dep for dep in node.requires if status[dep] != PASSED)}
+                    print(f"Skipping {name} ({results[name]['reason']})")
+                    continue
+                if not (all(status[dep] == PASSED for dep in node.requires)
+                        and all(status[dep] in DONE for dep in node.after)):
+                    continue
+                if len(running) >= max_workers or (node.lock and node.lock in held_locks):
+                    continue
+                if node.lock:
+                    held_locks.add(node.lock)
+                status[name] = "running"
+                running[executor.submit(run_node, node, logs_dir, retries, in_process)] = name
+
+            if not running:
+                if any(s == PENDING for s in status.values()):
+                    # Only skips were recorded this pass; look again for nodes they unblocked
+                    continue
+                break
 
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                node = nodes[name]
+                if node.lock:
+                    held_locks.discard(node.lock)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = {"name": name, "status": FAILED, "error": str(e)}
+                status[name] = result["status"]
+                results[name] = result
+                print(f"--> {name}: {result['status']} in {result.get('duration_seconds')}s "
+                      f"after {result.get('attempts', 1)} attempt(s)")
+            save_state(state, state_path)
+    save_state(state, state_path)
+    return results
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Run the data pipeline (scrape → categorize → embed → group) as a DAG.")
+    parser.add_argument("--scrapers-dir", default=str(DATA_DIR / "scrapers"), help="Path to scrapers folder")
+    parser.add_argument("--logs-dir", default=str(DEFAULT_LOGS_DIR), help="Where to store logs")
+    parser.add_argument("--state-file", default=str(DEFAULT_STATE_PATH), help="Run state, for --resume")
+    parser.add_argument("--resume", action="store_true", help="Skip the nodes that passed in the last run")
+    parser.add_argument("--workers", type=int, default=0, help="Nodes running at once (0 = one per scraper)")
+    parser.add_argument("--retries", type=int, default=DEFAULT_RETRIES, help="Retries of a failed node")
+    parser.add_argument("--subprocess", action="store_true", help="Run every node in its own interpreter")
+    parser.add_argument("--dry-run", action="store_true", help="List the DAG without executing")
+    args = parser.parse_args()
+
+    scraper_dir = Path(args.scrapers_dir).resolve()
+    logs_dir = Path(args.logs_dir).resolve()
+    state_path = Path(args.state_file).resolve()
+
+    nodes = build_dag(scraper_dir)
+    if args.dry_run:
+        for node in nodes.values():
+            deps = ", ".join(node.requires + node.after) or "-"
+            print(f" - {node.name}  <- {deps}")
+        print(f"Dry-run mode: {len(nodes)} nodes, not executing any.")
+        return 0
+
+    state = load_state(state_path) if args.resume else {}
+    if not state:
+        state = {"run_id": timestamp(), "started": datetime.now().isoformat(timespec="seconds")}
+    max_workers = args.workers or max(1, len(find_scraper_scripts(scraper_dir)))
+
+    in_process = not args.subprocess
+    start = time.perf_counter()
+    if in_process:
+        # One connection per worker thread; a stage that opens a second gets a connection of its own
+        use_connection_pool(max_workers)
+    try:
+        # Before the scrapers start saving in parallel, instead of each creating it in its save
+        conn = connect_to_db()
+        try:
+            ensure_schema(conn)
+        finally:
+            conn.close()
+        results = run_dag(nodes, state, state_path, logs_dir, max_workers, args.retries, in_process)
+    finally:
+        close_connection_pool()
+    elapsed = round(time.perf_counter() - start, 2)
+    state["metrics"] = merge_summaries(result.get("metrics") for result in results.values())
+    save_state(state, state_path)
+
+    counts = {s: sum(1 for name in nodes if results.get(name, {}).get("status") == s) for s in DONE}
     print(f"\n{'='*60}")
-    if failed:
-        print(f"Pipeline stopped. Failed: {', '.join(failed)}")
-        return 1
-    print("Pipeline completed successfully.")
-    return 0
+    for name in nodes:
+        result = results.get(name, {})
+        if result.get("status") != PASSED:
+            print(f"{name:<50} {result.get('status')!s:<7} log: {result.get('log_file', '-')}")
+    for line in report(state["metrics"]):
+        print(line)
+    print(f"Pipeline finished in {elapsed}s: {counts[PASSED]} passed, {counts[FAILED]} failed, {counts[SKIPPED]} skipped")
+    print(f"State file: {state_path}")
+    return 0 if counts[PASSED] == len(nodes) else 1
 
 
 if __name__ == "__main__":
     sys.exit(main())
-
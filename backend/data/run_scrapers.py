@@ -1,13 +1,23 @@
 from __future__ import annotations
 import argparse
+import asyncio
+import importlib
+import inspect
+import io
 import json
 import os
+import re
 import sys
 import subprocess
+import threading
 import time
+import traceback
+from contextlib import contextmanager
 from pathlib import Path
 from datetime import datetime
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Sequence, TextIO
+
+from backend.data.metrics import METRICS_FILE_ENV, Recorder, merge_summaries, recording, report
 
 PROJECT_ROOT = str(Path(__file__).resolve().parents[2])
 
@@ -21,14 +31,39 @@ def find_scraper_scripts(scraper_dir: Path) -> List[Path]:
     return scripts
 
 
-def run_script(script_path: Path, logs_dir: Path, stream: bool = True) -> Dict[str, Any]:
+def script_module(script_path: Path) -> str:
+    """Dotted module name of a script under the project root."""
+    return ".".join(script_path.resolve().relative_to(PROJECT_ROOT).with_suffix("").parts)
+
+
+def log_file(logs_dir: Path, label: str) -> Path:
+    stem = re.sub(r"[^\w.-]+", "_", label)
+    return logs_dir / f"{stem}-{timestamp()}.log"
+
+
+def load_metrics(path: Path) -> Optional[Dict[str, Any]]:
+    """The metrics summary a subprocess wrote at exit, None if it didn't get that far."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def run_script(script_path: Path, logs_dir: Path, stream: bool = True, args: Sequence[str] = (),
+               label: str = None) -> Dict[str, Any]:
+    """
+    Run script_path with args in a subprocess, logging to logs_dir; `label` names the log
+    and streamed lines. The script's metrics summary is written next to the log.
+    """
     start = time.perf_counter()
-    log_path = logs_dir / f"{script_path.stem}-{timestamp()}.log"
+    name = label or script_path.name
+    log_path = log_file(logs_dir, label or script_path.stem)
     logs_dir.mkdir(parents=True, exist_ok=True)
 
     result: Dict[str, Any] = {
         "script": str(script_path),
-        "name": script_path.name,
+        "name": name,
         "start": datetime.now().isoformat(timespec="seconds"),
         "end": None,
         "duration_seconds": None,
@@ -39,7 +74,7 @@ def run_script(script_path: Path, logs_dir: Path, stream: bool = True) -> Dict[s
 
     with open(log_path, "w", encoding="utf-8", errors="replace") as log:
         header = (
-            f"=== Running {script_path.name} ===\n"
+            f"=== Running {' '.join([script_path.name, *args])} ===\n"
             f"Started: {result['start']}\n"
             f"CWD: {script_path.parent}\n"
             f"Python: {sys.executable}\n"
@@ -51,10 +86,12 @@ def run_script(script_path: Path, logs_dir: Path, stream: bool = True) -> Dict[s
         env = os.environ.copy()
         env["PYTHONPATH"] = os.pathsep.join([PROJECT_ROOT, str(script_path.parent)])
         env["PYTHONIOENCODING"] = "utf-8"
+        metrics_path = log_path.with_suffix(".metrics.json")
+        env[METRICS_FILE_ENV] = str(metrics_path)
 
         try:
             proc = subprocess.Popen(
-                [sys.executable, str(script_path)],
+                [sys.executable, str(script_path), *args],
                 cwd=str(script_path.parent),
                 env=env,
                 stdout=subprocess.PIPE,
@@ -67,15 +104,15 @@ def run_script(script_path: Path, logs_dir: Path, stream: bool = True) -> Dict[s
             for line in proc.stdout:
                 log.write(line)
                 if stream:
-                    print(f"[{script_path.name}] {line}", end="")
+                    print(f"[{name}] {line}", end="")
             proc.wait()
             exit_code = proc.returncode
         except Exception as e:
             exit_code = 1
-            err = f"Exception while running {script_path.name}: {e}\n"
+            err = f"Exception while running {name}: {e}\n"
             log.write(err)
             if stream:
-                print(f"[{script_path.name}] {err}", end="")
+                print(f"[{name}] {err}", end="")
 
     end = time.perf_counter()
     duration = round(end - start, 2)
@@ -84,16 +121,130 @@ def run_script(script_path: Path, logs_dir: Path, stream: bool = True) -> Dict[s
     result["duration_seconds"] = duration
     result["exit_code"] = exit_code
     result["status"] = "passed" if exit_code == 0 else "failed"
+    result["metrics"] = load_metrics(metrics_path)
+    return result
+
+
+class ThreadOutput(io.TextIOBase):
+    """
+    Stand-in for sys.stdout / sys.stderr while scripts run in-process: whatever a
+    script's thread prints goes to its log, and to the console prefixed with its label
+    when streaming. Threads a script starts itself aren't tracked and print straight
+    to the console, as does everything outside run_module.
+    """
+
+    def __init__(self, console: TextIO):
+        self.console = console
+        self._local = threading.local()
+
+    @contextmanager
+    def routed(self, log: TextIO, label: str, stream: bool):
+        self._local.target = (log, label, stream)
+        self._local.line = ""
+        try:
+            yield
+        finally:
+            if self._local.line and stream:
+                self.console.write(f"[{label}] {self._local.line}\n")
+            self._local.target = None
+
+    def write(self, text: str) -> int:
+        target = getattr(self._local, "target", None)
+        if target is None:
+            return self.console.write(text)
+        log, label, stream = target
+        log.write(text)
+        if stream:
+            *lines, self._local.line = (self._local.line + text).split("\n")
+            for line in lines:
+                self.console.write(f"[{label}] {line}\n")
+        return len(text)
+
+    def flush(self):
+        self.console.flush()
+
+    @property
+    def encoding(self):
+        return self.console.encoding
+
+
+_outputs_lock = threading.Lock()
+_outputs: Optional[tuple] = None
+
+
+def thread_outputs() -> tuple:
+    """The ThreadOutputs installed as sys.stdout / sys.stderr (installed on first use)."""
+    global _outputs
+    with _outputs_lock:
+        if _outputs is None:
+            sys.stdout = ThreadOutput(sys.stdout)
+            sys.stderr = ThreadOutput(sys.stderr)
+            _outputs = (sys.stdout, sys.stderr)
+        return _outputs
+
+
+def run_module(module: str, logs_dir: Path, stream: bool = True, kwargs: Dict[str, Any] = None,
+               label: str = None) -> Dict[str, Any]:
+    """
+    In-process counterpart of run_script: import module (once per process) and call its
+    main(**kwargs) on this thread, awaiting it if it's a coroutine. An exception or a
+    non-zero SystemExit fails the run; its output is logged like run_script's and its
+    metrics are recorded apart from those of other modules running at the same time.
+    """
+    start = time.perf_counter()
+    name = label or module
+    log_path = log_file(logs_dir, label or module.rsplit(".", 1)[-1])
+    logs_dir.mkdir(parents=True, exist_ok=True)
+
+    result: Dict[str, Any] = {
+        "script": module,
+        "name": name,
+        "start": datetime.now().isoformat(timespec="seconds"),
+        "end": None,
+        "duration_seconds": None,
+        "exit_code": None,
+        "status": None,
+        "log_file": str(log_path),
+    }
+
+    stdout, stderr = thread_outputs()
+    recorder = Recorder(name)
+    with open(log_path, "w", encoding="utf-8", errors="replace") as log:
+        log.write(
+            f"=== Running {module}.main({', '.join(f'{k}={v!r}' for k, v in (kwargs or {}).items())}) ===\n"
+            f"Started: {result['start']}\n"
+            f"In-process: {sys.executable} (pid {os.getpid()})\n"
+            f"===============================\n"
+        )
+        with stdout.routed(log, name, stream), stderr.routed(log, name, stream), recording(recorder):
+            try:
+                outcome = importlib.import_module(module).main(**(kwargs or {}))
+                if inspect.iscoroutine(outcome):
+                    asyncio.run(outcome)
+                exit_code = 0
+            except SystemExit as e:
+                exit_code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+            except Exception:
+                exit_code = 1
+                traceback.print_exc()
+
+    result["end"] = datetime.now().isoformat(timespec="seconds")
+    result["duration_seconds"] = round(time.perf_counter() - start, 2)
+    result["exit_code"] = exit_code
+    result["status"] = "passed" if exit_code == 0 else "failed"
+    result["metrics"] = recorder.summary()
     return result
 
 
-def run_parallel(scripts: List[Path], logs_dir: Path, max_workers: int) -> List[Dict[str, Any]]:
+def run_parallel(scripts: List[Path], logs_dir: Path, max_workers: int, in_process: bool = False) -> List[Dict[str, Any]]:
     from concurrent.futures import ThreadPoolExecutor, as_completed
 
     results: List[Dict[str, Any]] = []
     print(f"Running {len(scripts)} scripts in parallel with {max_workers} workers...")
 
     def _runner(p: Path) -> Dict[str, Any]:
+        if in_process:
+            return run_module(script_module(p), logs_dir, stream=False, label=p.name)
         return run_script(p, logs_dir, stream=False)
 
     with ThreadPoolExecutor(max_workers=max_workers) as ex:
@@ -124,6 +275,7 @@ def main() -> int:
     parser.add_argument("--scrapers-dir", default=str(Path(__file__).parent / "scrapers"), help="Path to scrapers folder")
     parser.add_argument("--logs-dir", default=str(Path(__file__).parent / "logs"), help="Where to store logs")
     parser.add_argument("--parallel", type=int, default=0, help="Run in parallel with N workers (0 = sequential)")
+    parser.add_argument("--in-process", action="store_true", help="Run the scrapers' main() in this process instead of a subprocess each")
     parser.add_argument("--dry-run", action="store_true", help="List scripts without executing")
     args = parser.parse_args()
 
@@ -150,11 +302,14 @@ def main() -> int:
     summary: List[Dict[str, Any]] = []
 
     if args.parallel and args.parallel > 1:
-        summary = run_parallel(scripts, logs_dir, max_workers=args.parallel)
+        summary = run_parallel(scripts, logs_dir, max_workers=args.parallel, in_process=args.in_process)
     else:
         print("Running sequentially...")
         for p in scripts:
-            res = run_script(p, logs_dir, stream=True)
+            if args.in_process:
+                res = run_module(script_module(p), logs_dir, stream=True, label=p.name)
+            else:
+                res = run_script(p, logs_dir, stream=True)
             summary.append(res)
             print(f"--> {p.name}: {res['status']} in {res['duration_seconds']}s (log: {res['log_file']})")
 
@@ -172,6 +327,9 @@ def main() -> int:
     for r in summary:
         print(f"{r['name']:<25} {r['status']:<6} {r['duration_seconds']!s:>6}s  log: {r['log_file']}")
     print(f"Total: {len(summary)}, Passed: {passed}, Failed: {failed}, Accumulated time: {total_time}s")
+    print("\n=== Metrics ===")
+    for line in report(merge_summaries(r.get("metrics") for r in summary)):
+        print(line)
     print(f"Summary file: {summary_path}")
 
     return 0 if failed == 0 else 1
@@ -1,10 +1,15 @@
 import concurrent.futures
-import requests
-from backend.data.db_utils import *
-from kam_pdf_utils import extract_name_price
+import multiprocessing
+import time
+from typing import Iterator
 from datetime import datetime
-import html
-import uuid
+
+from backend.data.metrics import span
+from backend.data.scrapers.http_cache import default_cache
+from backend.data.scrapers.kam_pdf_utils import extract_name_price
+from backend.data.scrapers.promotions import promotion_from_dict
+from backend.data.scrapers.scraper_base import ConditionalResponse, HttpClient, ScrapedProduct, map_concurrently, save_products
+from backend.data.scrapers.store_prices import StorePriceMatrix
 
 headers = {
     'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'
@@ -101,28 +106,75 @@ numbers_all_markets = [1, 2, 3, 5, 6, 7, 8, 9, 11, 12, 13, 14, 15, 16, 17, 18, 1
 numbers_skopje = [1, 3, 5, 6, 7, 8, 9, 11, 12, 13, 14, 15, 17, 19, 20, 27, 31, 33, 37, 39, 41, 42, 43, 52, 53, 57, 66, 76, 78, 89, 91, 92, 93, 95, 98]
 
 MARKET_NAME = 'kam'
+FIELDS = ("price", "singular_price", "in_stock", "store_stock", "store_prices")
+
+# Each pipeline worker carries one PDF from download through extraction, so at most
+# PIPELINE_WORKERS PDFs are held in memory while EXTRACT_WORKERS of them are parsed
+PIPELINE_WORKERS = 8
+EXTRACT_WORKERS = 4
+# Bump when extract_name_price's output changes, so cached extractions aren't reused
+EXTRACT_VERSION = 2
+# Forking while other scrapers' threads run (in-process pipeline runs) can copy the locks
+# they hold, so the extraction processes come from a fork server where the platform has one
+EXTRACT_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else None
+
 
-def download_pdf(url: str, timeout: int = 30) -> str | None:
+def download_pdf(client: HttpClient, url: str, timeout: int = 30) -> ConditionalResponse:
+    """
+    Download a store's PDF into memory, unless it's the same document as last run.
+
+    The url is dated, so the cache key is the store's PDF name (and the extraction's
+    version) and an unchanged PDF is recognised by its content hash.
+    """
     filename = url.split('/')[-1]
-    try:
-        r = requests.get(url, headers=headers, timeout=timeout)
-        r.raise_for_status()
-        with open(filename, 'wb') as f:
-            f.write(r.content)
-        return filename
-    except Exception:
-        # failed download
+    result = client.get_conditional(url, key=f"kam/v{EXTRACT_VERSION}/{filename}", timeout=timeout)
+    result.response.raise_for_status()
+    return result
+
+
+def process_pdf(client: HttpClient, url: str, extract_pool: concurrent.futures.Executor) -> dict | None:
+    """
+    Products of one store's PDF: the cached ones if it's unchanged, otherwise its
+    bytes are handed straight to an extraction process (no file on disk) while this
+    thread waits, letting the other workers keep downloading.
+    """
+    filename = url.split('/')[-1]
+    result = download_pdf(client, url)
+    if not result.changed:
+        print(f"Unchanged since last run, reused {len(result.cached)} from {filename}")
+        return result.cached
+
+    with span("parse", url=url):
+        new_products = extract_pool.submit(extract_name_price, result.content, filename).result(timeout=300)
+    if not isinstance(new_products, dict) or not new_products:
+        print(f"No products from {filename}")
         return None
+    client.remember(result, new_products)
+    return new_products
 
-def merge_products(dest: dict, new: dict) -> None:
-    for k, v in new.items():
-        dest[k] = v
 
-if __name__ == "__main__":
+def store_products(new_products: dict) -> Iterator[ScrapedProduct]:
+    for name, (price, singular_price, promotion) in new_products.items():
+        yield ScrapedProduct(name=name, price=price, singular_price=singular_price, promotion=promotion_from_dict(promotion))
+
+
+def scrape_pdfs(client: HttpClient, urls: list[str]) -> StorePriceMatrix:
+    """Per-store prices from each store's PDF; the stores are the PDFs' numbers, in urls order."""
+    matrix = StorePriceMatrix([url.split('/')[-1].removesuffix('.pdf') for url in urls])
+    store_index = {url: i for i, url in enumerate(urls)}
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=EXTRACT_WORKERS, mp_context=multiprocessing.get_context(EXTRACT_START_METHOD),
+    ) as extract_pool:
+        for url, new_products in map_concurrently(
+            lambda url: process_pdf(client, url, extract_pool), urls, PIPELINE_WORKERS, label="PDF",
+        ):
+            if new_products:
+                matrix.add_store(store_index[url], store_products(new_products))
+    return matrix
+
+
+def main():
     start = time.time()
-    all_products = {}
-    download_futures = {}
-    extract_futures = {}
 
     # https://kam.com.mk/2025/11/25/73.pdf
     #  year / month / day / number.pdf
@@ -131,67 +183,19 @@ if __name__ == "__main__":
     day = f"{datetime.now().day:02d}"
     urls = [f'https://kam.com.mk/{year}/{month}/{day}/{n}.pdf' for n in numbers_skopje]
 
-    # adjust worker counts to your CPU / network
-    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as dl_pool, \
-         concurrent.futures.ProcessPoolExecutor(max_workers=4) as proc_pool:
-
-        # submit downloads
-        for url in urls:
-            fut = dl_pool.submit(download_pdf, url)
-            download_futures[fut] = url
-
-        # as downloads finish, submit extraction jobs
-        for dl_done in concurrent.futures.as_completed(download_futures):
-            filename = dl_done.result()
-            url = download_futures[dl_done]
-            if not filename:
-                print(f"Download failed: {url}")
-                continue
-            # submit extraction to process pool
-            ef = proc_pool.submit(extract_name_price, filename)
-            extract_futures[ef] = filename
-
-        # collect extraction results and cleanup files
-        for ex_done in concurrent.futures.as_completed(extract_futures):
-            filename = extract_futures[ex_done]
-            try:
-                new_products = ex_done.result(timeout=300)
-                if isinstance(new_products, dict):
-                    merge_products(all_products, new_products)
-                    print(f"Extracted {len(new_products)} from {filename}")
-                else:
-                    print(f"No products from {filename}")
-            except Exception as e:
-                print(f"Extraction failed for {filename}: {e}")
-            finally:
-                # remove temp file
-                try:
-                    os.remove(filename)
-                except Exception:
-                    pass
-
-    print(f"Total products: {len(all_products)} in {round(time.time() - start, 2)}s")
-    print("Saving to PostgreSQL products table")
-
-    db = connect_to_db()
-    existing_products = get_products_by_market(db, MARKET_NAME)
-    products_to_upsert = []
-    now = datetime.now()
-
-    for key, value in all_products.items():
-        normalized_name = html.unescape(key)
-        existing_id = existing_products.get((normalized_name, MARKET_NAME))
-        fields = {
-            'id': existing_id if existing_id else str(uuid.uuid4()),
-            'name': key,
-            'price': value[0],
-            'singular_price': value[1],
-            'in_stock': True,
-            'market': MARKET_NAME,
-            'ETL_loadtime': now,
-            'last_updated': now
-        }
-        products_to_upsert.append(fields)
-
-    save_products_to_products_table(db, MARKET_NAME, products_to_upsert, set(all_products.keys()))
+    with HttpClient(pool_size=PIPELINE_WORKERS, headers=headers, cache=default_cache()) as client:
+        matrix = scrape_pdfs(client, urls)
+        all_products = matrix.chain_products()
+
+        print(f"Total products: {len(all_products)} in {round(time.time() - start, 2)}s")
+        if client.nothing_changed():
+            print("No PDF changed since the last run, skipping save")
+        else:
+            print("Saving to PostgreSQL products table")
+            save_products(MARKET_NAME, all_products, FIELDS, stores=matrix.stores)
+        client.commit_cache()
     print(f"Overall done in {round(time.time() - start, 2)}s")
+
+
+if __name__ == "__main__":
+    main()
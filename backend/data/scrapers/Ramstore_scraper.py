@@ -1,13 +1,23 @@
+import time
+from io import StringIO
+
 import pandas as pd
 from tqdm import tqdm
-from backend.data.db_utils import *
-from datetime import datetime
-import html
-import uuid
 
-start = time.time()
+from backend.data.metrics import span
+from backend.data.scrapers.promotions import first_date, make_promotion
+from backend.data.scrapers.scraper_base import DEFAULT_FIELDS, HttpClient, ScrapedProduct, map_concurrently, save_products
+from backend.data.scrapers.store_prices import StorePriceMatrix
 
 MARKET_NAME = 'ramstore'
+FIELDS = DEFAULT_FIELDS + ("store_stock", "store_prices")
+MAX_WORKERS = 8
+
+PRICE_COL = 'ПРОДАЖНА ЦЕНА'
+DISCOUNT_PRICE_COL = 'ЦЕНА СО ПОПУСТ'
+PERIOD_COL = 'ВРЕМЕТРАЕЊЕ НА АКЦИЈА'
+# "from - to", split on a single " - " (periods with more than one give no dates)
+PERIOD_PATTERN = r'^(?P<promotionDateFrom>(?:(?! - ).)*) - (?P<promotionDateTo>(?:(?! - ).)*)$'
 
 stores = [
     "https://ramstore.com.mk/marketi/ramstore-vardar/",
@@ -39,76 +49,85 @@ stores = [
     # "https://ramstore.com.mk/marketi/ramstore-strumicza-bulevar/"
 ]
 
-df = pd.DataFrame()
-now = datetime.now()
-date_time = now.strftime("%d-%m-%Y")
-
-def extract_dates(period):
-    if pd.isna(period) or period == '':
-        return None, None
-    try:
-        from_date, to_date = period.split(' - ')
-        return from_date.strip(), to_date.strip()
-    except ValueError:
-        return None, None
-
-for store in tqdm(stores):
-    counter = 1
-    store_prefix = store.rsplit('_', 1)[0]
-    store_id = store.rsplit('_', 1)[0].split('marketi/')[1].replace('/', '')
-    df_new = pd.read_html(store)[0]
-    df_new["storeId"] = store_id
-
-    if df_new.empty:
+
+def store_id(store_url: str) -> str:
+    return store_url.rsplit('_', 1)[0].split('marketi/')[1].replace('/', '')
+
+
+def fetch_store(client: HttpClient, index: int, store: str) -> pd.DataFrame:
+    """One store's price table, tagged with the store's index in `stores`."""
+    response = client.get(store)
+    response.raise_for_status()
+    with span("parse", url=store):
+        df = pd.read_html(StringIO(response.text))[0]
+    if df.empty:
         print(f"No data found for store: {store}")
-        continue
-
-    df_new[['promotionDateFrom', 'promotionDateTo']] = df_new['ВРЕМЕТРАЕЊЕ НА АКЦИЈА'].apply(
-        lambda x: pd.Series(extract_dates(x))
-    )
-    df_new = df_new.drop(columns='ВРЕМЕТРАЕЊЕ НА АКЦИЈА')
-    df = pd.concat([df, df_new])
-
-product_col = df.columns[0]
-items_map = {}
-cena_popust = 'ЦЕНА СО ПОПУСТ'
-
-for _, row in df.iterrows():
-    name = str(row[product_col]).strip()
-    data = {}
-    for col in df.columns:
-        if col == product_col:
-            continue
-        val = row[col]
-        data[col] = None if pd.isna(val) else val
-    items_map[name]=[int(data['ПРОДАЖНА ЦЕНА']), data['ОПИС НА ПРОИЗВОД'], data['ЕДИНЕЧНА ЦЕНА']]
-
-    if cena_popust in data.keys() and data[cena_popust] is not None:
-        price = data[cena_popust].rsplit(' ', 1)[0]
-        items_map[name][0]=int(price[:-3])
-
-print(f"Products scraped: {len(items_map)}")
-print(f"Scraping finished in {round(time.time() - start, 3)} seconds.")
-
-db = connect_to_db()
-existing_products = get_products_by_market(db, MARKET_NAME)
-products_to_upsert = []
-
-for key, value in items_map.items():
-    normalized_name = html.unescape(key)
-    existing_id = existing_products.get((normalized_name, MARKET_NAME))
-    fields = {
-        'id': existing_id if existing_id else str(uuid.uuid4()),
-        'name': key,
-        'price': value[0],
-        'description': value[1],
-        'singular_price': value[2],
-        'in_stock': True,
-        'market': MARKET_NAME,
-        'ETL_loadtime': now,
-        'last_updated': now
-    }
-    products_to_upsert.append(fields)
-
-save_products_to_products_table(db, MARKET_NAME, products_to_upsert, set(items_map.keys()))
-print(f"Overall done in {round(time.time() - start, 2)}s")
\ No newline at end of file
+    df["storeIndex"] = index
+    return df.rename(columns={df.columns[0]: "name"})
+
+
+def promotion_dates(periods: pd.Series) -> pd.DataFrame:
+    """promotionDateFrom / promotionDateTo from "from - to" periods, None where there's no period."""
+    dates = periods.astype("string").str.extract(PERIOD_PATTERN)
+    return dates.apply(lambda col: col.str.strip()).astype(object).where(dates.notna(), None)
+
+
+def discounted_prices(df: pd.DataFrame) -> pd.Series:
+    """Price with the discount applied where there is one: "149.00 ден" -> 149."""
+    prices = pd.to_numeric(df[PRICE_COL], errors="coerce")
+    if DISCOUNT_PRICE_COL in df.columns:
+        discount = pd.to_numeric(
+            df[DISCOUNT_PRICE_COL].astype("string").str.rsplit(" ", n=1).str[0].str[:-3], errors="coerce"
+        )
+        prices = discount.fillna(prices)
+    return prices
+
+
+def optional(series: pd.Series) -> list:
+    return series.astype(object).where(series.notna(), None).tolist()
+
+
+def main():
+    start = time.time()
+    matrix = StorePriceMatrix([store_id(store) for store in stores])
+
+    frames = []
+    with HttpClient(pool_size=MAX_WORKERS) as client:
+        for _, df_store in tqdm(map_concurrently(
+            lambda item: fetch_store(client, *item), enumerate(stores), MAX_WORKERS, label="store",
+        ), total=len(stores)):
+            frames.append(df_store)
+    if not frames:
+        print("No store could be scraped")
+        return
+
+    df = pd.concat(frames, ignore_index=True).sort_values("storeIndex", kind="stable")
+    df["name"] = df["name"].astype(str).str.strip()
+    df["regularPrice"] = pd.to_numeric(df[PRICE_COL], errors="coerce")
+    df["price"] = discounted_prices(df)
+    df = df.join(promotion_dates(df[PERIOD_COL])).drop(columns=PERIOD_COL)
+
+    missing_price = df["price"].isna()
+    if missing_price.any():
+        print(f"Skipping {int(missing_price.sum())} rows without a price")
+        df = df[~missing_price]
+
+    for index, name, price, regular_price, date_from, date_to, description, singular_price in zip(
+        df["storeIndex"].tolist(), df["name"].tolist(), df["price"].astype(int).tolist(),
+        optional(df["regularPrice"]), df["promotionDateFrom"].tolist(), df["promotionDateTo"].tolist(),
+        optional(df['ОПИС НА ПРОИЗВОД']), optional(df['ЕДИНЕЧНА ЦЕНА']),
+    ):
+        promotion = make_promotion(regular_price, price, valid_from=first_date(date_from), valid_to=first_date(date_to))
+        matrix.add(index, ScrapedProduct(name=name, price=price, description=description, singular_price=singular_price,
+                                         promotion=promotion))
+
+    items_map = matrix.chain_products()
+    print(f"Products scraped: {len(items_map)}")
+    print(f"Scraping finished in {round(time.time() - start, 3)} seconds.")
+
+    save_products(MARKET_NAME, items_map, FIELDS, stores=matrix.stores)
+    print(f"Overall done in {round(time.time() - start, 2)}s")
+
+
+if __name__ == "__main__":
+    main()
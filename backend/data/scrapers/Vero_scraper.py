@@ -1,26 +1,34 @@
+import time
 import requests
 from bs4 import BeautifulSoup
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from threading import Lock
-import html
-import uuid
 
-from backend.data.db_utils import *
+from backend.data.scrapers.html_tables import extract_tables
+from backend.data.scrapers.http_cache import default_cache
+from backend.data.scrapers.scraper_base import HttpClient, ScrapedProduct, map_concurrently, merge_products, save_products
 
 # --- Configuration ---
 BASE_URL = 'https://pricelist.vero.com.mk/'
-SESSION = requests.Session()
-SESSION.headers.update({"User-Agent": "Mozilla/5.0"})
 MAX_WORKERS = 10  # Adjust the number of threads as needed
 
 MARKET_NAME = 'vero'
 
-# --- Global shared data ---
-products = {}
-products_lock = Lock()
 
+def parse_shop_page(content: bytes) -> list:
+    """Product rows of a shop page, header/footer rows skipped."""
+    return [cols for rows in extract_tables(content) for cols in rows[3:-1]]
 
-def scrape_shop(shop_link: str):
+
+def parse_shop_links(content: bytes) -> list:
+    soup = BeautifulSoup(content, 'html.parser')
+    shop_links = []
+    for shop in soup.find_all('td'):
+        a_tag = shop.find('a')
+        if a_tag and a_tag.has_attr('href'):
+            shop_links.append(BASE_URL + a_tag['href'])
+    return shop_links
+
+
+def scrape_shop(client: HttpClient, shop_link: str) -> dict:
     """Scrapes all pages for a single shop category and returns its products."""
     shop_products = {}
     counter = 1
@@ -29,35 +37,29 @@ def scrape_shop(shop_link: str):
     while True:
         page_link = base_link + f"{counter}.html"
         try:
-            page = SESSION.get(page_link, timeout=10)
-            if page.status_code == 404:
+            # Unchanged pages (304 or same content) reuse the rows parsed last run
+            rows = client.get_cached(page_link, parse_shop_page, missing_ok=True)
+            if rows is None:
                 break  # No more pages in this category
-            page.raise_for_status()  # Raise an exception for bad status codes (4xx or 5xx)
 
             print(f"Processing shop link: {page_link} -- ")
-            soup = BeautifulSoup(page.content, 'html.parser')
-            tables = soup.find_all('table')
-
-            for table in tables:
-                rows = table.find_all('tr')
-                for row in rows[3:-1]:  # Skip header/footer rows
-                    cols = [ele.text.strip() for ele in row.find_all('td')]
-                    if len(cols) < 5:
-                        continue
-
-                    name = cols[0]
-                    try:
-                        price = int(cols[1])
-                    except ValueError:
-                        continue  # Skip if price is not a valid integer
-
-                    unit_price = cols[2]
-                    in_stock = 1 if cols[3] == 'Да' else 0
-                    category = cols[4]
-
-                    # Use local dictionary to avoid locking on every product
-                    if name not in shop_products:
-                        shop_products[name] = [price, unit_price, category, in_stock]
+            for cols in rows:
+                if len(cols) < 5:
+                    continue
+
+                try:
+                    price = int(cols[1])
+                except ValueError:
+                    continue  # Skip if price is not a valid integer
+
+                # Use local dictionary to avoid locking on every product
+                merge_products(shop_products, [ScrapedProduct(
+                    name=cols[0],
+                    price=price,
+                    singular_price=cols[2],
+                    in_stock=cols[3] == 'Да',
+                    description=cols[4],
+                )])
 
             counter += 1
         except requests.RequestException as e:
@@ -71,61 +73,34 @@ def main():
     """Main function to orchestrate the scraping process."""
     start = time.time()
 
-    # 1. Get all shop category links from the main page
-    index_page = SESSION.get(BASE_URL + "index.html")
-    index_page.raise_for_status()
-    soup = BeautifulSoup(index_page.content, 'html.parser')
+    with HttpClient(pool_size=MAX_WORKERS, timeout=10, cache=default_cache()) as client:
+        # 1. Get all shop category links from the main page (conditionally, so a shop
+        # that disappears from the index counts as a change)
+        shop_links = client.get_cached(BASE_URL + "index.html", parse_shop_links)
 
-    shop_links = []
-    for shop in soup.find_all('td'):
-        a_tag = shop.find('a')
-        if a_tag and a_tag.has_attr('href'):
-            shop_links.append(BASE_URL + a_tag['href'])
-
-    # Exclude first and last two links as in the original script
-    links_to_scrape = shop_links[1:-2]
-    print(f"Found {len(links_to_scrape)} shop categories to scrape.")
+        # Exclude first and last two links as in the original script
+        links_to_scrape = shop_links[1:-2]
+        print(f"Found {len(links_to_scrape)} shop categories to scrape.")
 
-    # 2. Use a thread pool to scrape all categories in parallel
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        # Submit all scraping tasks
-        future_to_link = {executor.submit(scrape_shop, link): link for link in links_to_scrape}
-
-        for future in as_completed(future_to_link):
-            shop_products = future.result()
+        # 2. Use a thread pool to scrape all categories in parallel
+        products = {}
+        for _, shop_products in map_concurrently(
+            lambda link: scrape_shop(client, link), links_to_scrape, MAX_WORKERS, label="shop",
+        ):
             if shop_products:
-                # Safely merge results into the global dictionary
-                with products_lock:
-                    products.update(shop_products)
+                merge_products(products, shop_products.values())
                 print(f"Finished shop. Total unique products so far: {len(products)}")
 
-    print(f"\nTotal unique products: {len(products)}")
-    print(f"Scraping took {round(time.time() - start, 2)}s")
-    print("Saving to PostgreSQL products table")
-
-    db = connect_to_db()
-    existing_products = get_products_by_market(db, MARKET_NAME)
-    products_to_upsert = []
-    now = datetime.now()
-
-    for key, value in products.items():
-        normalized_name = html.unescape(key)
-        existing_id = existing_products.get((normalized_name, MARKET_NAME))
-        fields = {
-            'id': existing_id if existing_id else str(uuid.uuid4()),
-            'name': key,
-            'price': value[0],
-            'singular_price': value[1],
-            'description': value[2],
-            'in_stock': value[3] == 1,
-            'market': MARKET_NAME,
-            'ETL_loadtime': now,
-            'last_updated': now
-        }
-        products_to_upsert.append(fields)
-
-    save_products_to_products_table(db, MARKET_NAME, products_to_upsert, set(products.keys()))
+        print(f"\nTotal unique products: {len(products)}")
+        print(f"Scraping took {round(time.time() - start, 2)}s")
+        if client.nothing_changed():
+            print("No page changed since the last run, skipping save")
+        else:
+            print("Saving to PostgreSQL products table")
+            save_products(MARKET_NAME, products)
+        client.commit_cache()
     print(f"Overall done in {round(time.time() - start, 2)}s")
 
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,118 @@
+"""
+Asyncio scraping engine: one event loop drives every store of a chain.
+
+- AsyncFetcher: httpx.AsyncClient with a single per-host concurrency limit shared by
+  all fetches, keep-alive connections and retries on RETRY_STATUSES / network errors
+- FetchQueue: priority queue of page fetches drained by a fixed set of workers;
+  handlers can enqueue follow-up fetches (e.g. the pages of a market once its
+  product count is known)
+
+Compared to nested thread pools (markets × pages threads) the load on a site is
+bounded by one number and the thread count stays flat.
+"""
+import asyncio
+import itertools
+import random
+from typing import Awaitable, Callable, Dict
+from urllib.parse import urlsplit
+
+import httpx
+
+from backend.data.metrics import count, span
+from backend.data.scrapers.scraper_base import DEFAULT_HEADERS, RETRY_STATUSES
+
+
+class AsyncFetcher:
+    def __init__(self, per_host_limit: int = 16, retries: int = 3, backoff_factor: float = 0.5,
+                 timeout: float = 30, headers: dict = None):
+        self.per_host_limit = per_host_limit
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.client = httpx.AsyncClient(
+            headers=headers or DEFAULT_HEADERS,
+            timeout=timeout,
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=None, max_keepalive_connections=per_host_limit),
+        )
+        self._host_slots: Dict[str, asyncio.Semaphore] = {}
+
+    def _slots(self, url: str) -> asyncio.Semaphore:
+        host = urlsplit(url).netloc
+        if host not in self._host_slots:
+            self._host_slots[host] = asyncio.Semaphore(self.per_host_limit)
+        return self._host_slots[host]
+
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        for attempt in range(self.retries + 1):
+            try:
+                async with self._slots(url):
+                    with span("http.fetch", host=urlsplit(url).netloc) as attributes:
+                        response = await self.client.get(url, **kwargs)
+                        attributes["status"] = response.status_code
+                count("http.bytes", len(response.content))
+                if response.status_code not in RETRY_STATUSES or attempt == self.retries:
+                    return response
+                retry_after = response.headers.get("Retry-After", "")
+                delay = float(retry_after) if retry_after.isdigit() else self._backoff(attempt)
+            except httpx.TransportError:
+                if attempt == self.retries:
+                    raise
+                delay = self._backoff(attempt)
+            # Sleep outside the host slot so other fetches keep going
+            await asyncio.sleep(delay)
+
+    def _backoff(self, attempt: int) -> float:
+        return self.backoff_factor * (2 ** attempt) * random.uniform(0.5, 1.0)
+
+    async def close(self):
+        await self.client.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+Handler = Callable[[httpx.Response], Awaitable[None]]
+
+
+class FetchQueue:
+    """
+    Page fetches ordered by priority (lower first, FIFO within a priority).
+
+    Each job is (url, handler); the worker fetches the url, raises on HTTP errors and
+    awaits handler(response). Errors are printed and the job dropped, like the
+    per-page try/except of the thread-pool scrapers.
+    """
+
+    def __init__(self, fetcher: AsyncFetcher, workers: int = None):
+        self.fetcher = fetcher
+        self.workers = workers or fetcher.per_host_limit
+        self.queue = asyncio.PriorityQueue()
+        self.sequence = itertools.count()
+        self.failed = 0
+
+    def put(self, priority: int, url: str, handler: Handler):
+        self.queue.put_nowait((priority, next(self.sequence), url, handler))
+
+    async def _worker(self):
+        while True:
+            _, _, url, handler = await self.queue.get()
+            try:
+                response = await self.fetcher.get(url)
+                response.raise_for_status()
+                await handler(response)
+            except Exception as e:
+                self.failed += 1
+                print(f"Error fetching {url}: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def run(self):
+        """Drain the queue, including jobs enqueued by handlers, then stop the workers."""
+        workers = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        await self.queue.join()
+        for w in workers:
+            w.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
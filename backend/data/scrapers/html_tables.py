@@ -0,0 +1,69 @@
+"""
+Fast extraction of HTML table cells with lxml.
+
+The price pages are plain tables of thousands of rows (perPage=10000 on
+proverkanaceni), and walking them with BeautifulSoup's html.parser was most of a
+scraper's CPU time. lxml parses in C and the cells are read straight off the tree.
+"""
+from typing import List, Optional
+
+import lxml.html
+from bs4.dammit import UnicodeDammit
+
+Row = List[str]
+
+
+def utf8_html(content) -> bytes:
+    """Page content as UTF-8 bytes, so lxml never has to guess the charset."""
+    if isinstance(content, str):
+        return content.encode("utf-8")
+    try:
+        content.decode("utf-8")
+        return content
+    except UnicodeDecodeError:
+        # Not UTF-8: let BeautifulSoup's detector work out the charset (meta tag, cp1251, ...)
+        return UnicodeDammit(content, is_html=True).unicode_markup.encode("utf-8")
+
+
+def _cell_text(td) -> str:
+    # Most cells are a single text node; text_content() builds the string through XPath
+    if len(td) == 0:
+        return (td.text or "").strip()
+    return td.text_content().strip()
+
+
+def _rows(table, tbody: bool) -> List[Row]:
+    if tbody:
+        table = table.find(".//tbody")
+        if table is None:
+            return []
+    return [[_cell_text(td) for td in tr.iter("td")] for tr in table.iter("tr")]
+
+
+def extract_tables(content, table_class: Optional[str] = None, tbody: bool = False, first: bool = False) -> List[List[Row]]:
+    """
+    Cell texts of the tables in an HTML page, one list of rows per table.
+
+    table_class: only tables whose class attribute is exactly this string
+    tbody: only rows inside the table's (first) <tbody>
+    first: stop at the first matching table
+    """
+    data = utf8_html(content)
+    if not data.strip():
+        return []
+    # Parsers aren't safe to share between threads, and creating one is cheap
+    root = lxml.html.document_fromstring(data, parser=lxml.html.HTMLParser(encoding="utf-8"))
+
+    if table_class:
+        tables = root.xpath("//table[@class=$cls]", cls=table_class)
+    else:
+        tables = root.xpath("//table")
+    if first:
+        tables = tables[:1]
+    return [_rows(table, tbody) for table in tables]
+
+
+def extract_rows(content, table_class: Optional[str] = None, tbody: bool = False) -> List[Row]:
+    """Rows of the first matching table, or [] if there is none."""
+    tables = extract_tables(content, table_class, tbody, first=True)
+    return tables[0] if tables else []
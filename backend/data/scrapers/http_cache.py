@@ -0,0 +1,94 @@
+"""
+On-disk cache of page validators and parse results, for conditional fetching.
+
+For every page (or PDF) a scraper parsed, the cache keeps its ETag/Last-Modified,
+a hash of the body and the parse result. The next run sends If-None-Match /
+If-Modified-Since, and when the server answers 304 (or the body hashes the same)
+the stored parse result is used instead of parsing again.
+
+Entries are staged during a run and written by commit(), which scrapers call only
+after their products are saved, so a failed save never leaves the cache claiming
+pages were already processed.
+
+Set CENAPLUS_HTTP_CACHE to a file path to move the cache, or to "off" to disable it.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+DEFAULT_PATH = Path(__file__).resolve().parents[1] / "cache" / "http_cache.sqlite"
+
+
+def content_hash(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+@dataclass
+class CacheEntry:
+    url: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+    content_hash: str
+    parsed: Any
+
+
+class HttpCache:
+    def __init__(self, path: Path = DEFAULT_PATH):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._pending: Dict[str, tuple] = {}
+        with self._lock, self._db:
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    url TEXT NOT NULL,
+                    etag TEXT,
+                    last_modified TEXT,
+                    content_hash TEXT NOT NULL,
+                    parsed TEXT NOT NULL,
+                    fetched_at TEXT NOT NULL
+                )
+            """)
+
+    def lookup(self, key: str) -> Optional[CacheEntry]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT url, etag, last_modified, content_hash, parsed FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        url, etag, last_modified, digest, parsed = row
+        return CacheEntry(url, etag, last_modified, digest, json.loads(parsed))
+
+    def store(self, key: str, entry: CacheEntry):
+        """Stage an entry; it's written by commit()."""
+        with self._lock:
+            self._pending[key] = (
+                key, entry.url, entry.etag, entry.last_modified, entry.content_hash,
+                json.dumps(entry.parsed, ensure_ascii=False), datetime.now().isoformat(timespec="seconds"),
+            )
+
+    def commit(self):
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)", list(self._pending.values())
+            )
+            self._pending.clear()
+
+    def close(self):
+        self._db.close()
+
+
+def default_cache() -> Optional[HttpCache]:
+    setting = os.getenv("CENAPLUS_HTTP_CACHE", "")
+    if setting.lower() == "off":
+        return None
+    return HttpCache(Path(setting) if setting else DEFAULT_PATH)
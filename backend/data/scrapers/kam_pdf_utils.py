@@ -15,13 +15,29 @@ header_lines = ["стока-",
 "на промоција",
 "или попустДатум и време на последно ажурирање на цените:"]
 
+import ctypes
+import io
 import re
-from typing import List, Dict
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass
+from functools import lru_cache
+from typing import List, Dict, Iterator, Tuple
+
+import pypdfium2 as pdfium
+import pypdfium2.raw as pdfium_c
+
+from backend.data.scrapers.promotions import make_promotion
 
 NAME_KEYWORDS = ("назив", "стока", "производ")
 PRICE_KEYWORDS = ("продажна", "продажна цена", "цена")
 DESC_KEYWORDS = ("опис", "опис на стока")
 SINGULAR_KEYWORDS = ("единечна", "единечна цена", "единична", "единична цена")
+# Discount columns are optional and only matched in full, never by the partial fallback
+REGULAR_KEYWORDS = ("редовна",)
+PROMO_KEYWORDS = ("цена со попуст",)
+PERCENT_KEYWORDS = ("попуст(%", "попуст (%")
+PERIOD_KEYWORDS = ("времетраење",)
 
 
 def _col_index_from_headers(headers: List[str], keywords: tuple) -> int | None:
@@ -37,6 +53,17 @@ def _col_index_from_headers(headers: List[str], keywords: tuple) -> int | None:
                 return i
     return None
 
+def _exact_col_index(headers: Tuple[str, ...], keywords: tuple) -> int | None:
+    for i, h in enumerate(headers):
+        if any(kw in h.lower() for kw in keywords):
+            return i
+    return None
+
+
+def _clean_percent(s: str) -> float | None:
+    m = re.search(r'(\d+(?:[.,]\d+)?)', str(s or ""))
+    return float(m.group(1).replace(',', '.')) if m else None
+
 def _clean_price(s: str) -> int | None:
     if not s:
         return None
@@ -49,103 +76,273 @@ def _clean_price(s: str) -> int | None:
         return int(float(m.group(1).replace(',', '.')))
     return None
 
-def extract_name_price_with_camelot(pdf_path: str) -> List[Dict]:
+
+# Path segments closer than this (in points) count as one rule of the table grid
+RULE_TOLERANCE = 1.5
+
+
+@dataclass(frozen=True)
+class TableLayout:
+    """Where the fields of a price list table are, detected from its header row."""
+    columns: int
+    name: int
+    price: int
+    description: int | None
+    singular_price: int | None
+    regular_price: int | None = None
+    promo_price: int | None = None
+    percent: int | None = None
+    period: int | None = None
+
+
+def _normalize(cell) -> str:
+    return " ".join(str(cell or "").split())
+
+
+@lru_cache(maxsize=32)
+def detect_layout(header: Tuple[str, ...]) -> TableLayout | None:
+    """
+    Layout of a table whose first row is `header`, None when that row isn't a header.
+    Cached per header fingerprint: every page and PDF of the same price list format
+    shares one detection.
+    """
+    name_col = _col_index_from_headers(header, NAME_KEYWORDS)
+    price_col = _col_index_from_headers(header, PRICE_KEYWORDS)
+    if name_col is None or price_col is None or _clean_price(header[price_col]) is not None:
+        return None
+    return TableLayout(
+        columns=len(header),
+        name=name_col,
+        price=price_col,
+        description=_col_index_from_headers(header, DESC_KEYWORDS),
+        singular_price=_col_index_from_headers(header, SINGULAR_KEYWORDS),
+        regular_price=_exact_col_index(header, REGULAR_KEYWORDS),
+        promo_price=_exact_col_index(header, PROMO_KEYWORDS),
+        percent=_exact_col_index(header, PERCENT_KEYWORDS),
+        period=_exact_col_index(header, PERIOD_KEYWORDS),
+    )
+
+
+def _row_promotion(row: List[str], layout: TableLayout, price: int) -> dict | None:
+    """The row's discount as a Promotion dict (JSON-safe, for the HTTP cache), None without one."""
+    if layout.promo_price is None:
+        return None
+    promo_price = _clean_price(row[layout.promo_price])
+    if promo_price is None:
+        return None
+    regular_price = _clean_price(row[layout.regular_price]) if layout.regular_price is not None else price
+    promotion = make_promotion(
+        regular_price,
+        promo_price,
+        percent=_clean_percent(row[layout.percent]) if layout.percent is not None else None,
+        period=row[layout.period] if layout.period is not None else None,
+    )
+    return asdict(promotion) if promotion else None
+
+
+def _table_products(rows: List[List[str]], layout: TableLayout | None) -> Tuple[List[tuple], TableLayout | None]:
+    """
+    (name, price, singular_price, promotion) of a table's rows. A header row sets the layout;
+    tables continuing onto a page without one reuse the layout of the previous page.
+    """
+    if not rows:
+        return [], layout
+    header_layout = detect_layout(tuple(_normalize(cell) for cell in rows[0]))
+    if header_layout is not None:
+        layout, rows = header_layout, rows[1:]
+    elif layout is None or len(rows[0]) != layout.columns:
+        return [], layout
+
+    products = []
+    for row in rows:
+        if len(row) != layout.columns:
+            continue
+        name = _normalize(row[layout.name])
+        price = _clean_price(row[layout.price])
+        if not name or price is None:
+            continue
+        description = _normalize(row[layout.description]) if layout.description is not None else ""
+        singular_price = None
+        if layout.singular_price is not None:
+            singular_price = _normalize(row[layout.singular_price]) or None
+        products.append((
+            f"{name} - {description}" if description else name, price, singular_price, _row_promotion(row, layout, price),
+        ))
+    return products, layout
+
+
+def _cluster(values: List[Tuple[float, float]], min_length: float) -> List[float]:
+    """Positions of rules from (position, length) segments, merging segments that are less than RULE_TOLERANCE apart."""
+    rules = []
+    for position, length in sorted(values):
+        if rules and position - rules[-1][0] <= RULE_TOLERANCE:
+            rules[-1][1] += length
+        else:
+            rules.append([position, length])
+    return [position for position, length in rules if length >= min_length]
+
+
+def _page_rules(page: pdfium.PdfPage) -> Tuple[List[float], List[float]]:
+    """x of the vertical and y of the horizontal rules drawn on a page (lines or thin rectangles)."""
+    vertical, horizontal = [], []
+
+    def add_edge(start: Tuple[float, float], end: Tuple[float, float]):
+        (x0, y0), (x1, y1) = start, end
+        if abs(x1 - x0) <= RULE_TOLERANCE and abs(y1 - y0) > RULE_TOLERANCE:
+            vertical.append(((x0 + x1) / 2, abs(y1 - y0)))
+        elif abs(y1 - y0) <= RULE_TOLERANCE and abs(x1 - x0) > RULE_TOLERANCE:
+            horizontal.append(((y0 + y1) / 2, abs(x1 - x0)))
+
+    # Raw pdfium calls with reused buffers: the object wrappers cost more than the work on pages of thousands of paths
+    x, y = pdfium_c.FS_FLOAT(), pdfium_c.FS_FLOAT()
+    m = pdfium_c.FS_MATRIX()
+    for index in range(pdfium_c.FPDFPage_CountObjects(page.raw)):
+        obj = pdfium_c.FPDFPage_GetObject(page.raw, index)
+        if pdfium_c.FPDFPageObj_GetType(obj) != pdfium_c.FPDF_PAGEOBJ_PATH:
+            continue
+        pdfium_c.FPDFPageObj_GetMatrix(obj, m)
+        subpath_start = previous = None
+        for i in range(pdfium_c.FPDFPath_CountSegments(obj)):
+            segment = pdfium_c.FPDFPath_GetPathSegment(obj, i)
+            pdfium_c.FPDFPathSegment_GetPoint(segment, x, y)
+            point = (m.a * x.value + m.c * y.value + m.e, m.b * x.value + m.d * y.value + m.f)
+            kind = pdfium_c.FPDFPathSegment_GetType(segment)
+            if kind == pdfium_c.FPDF_SEGMENT_MOVETO:
+                subpath_start = point
+            elif kind == pdfium_c.FPDF_SEGMENT_LINETO and previous is not None:
+                add_edge(previous, point)
+            if pdfium_c.FPDFPathSegment_GetClose(segment) and subpath_start is not None:
+                # Rectangles ("re") come as three line segments and a close
+                add_edge(point, subpath_start)
+            previous = point
+    if not vertical or not horizontal:
+        return [], []
+    # Rules of the table span (most of) it; shorter ones are decoration or merged cells
+    height = max(p for p, _ in horizontal) - min(p for p, _ in horizontal)
+    width = max(p for p, _ in vertical) - min(p for p, _ in vertical)
+    return _cluster(vertical, height / 2), _cluster(horizontal, width / 2)
+
+
+def _page_table(page: pdfium.PdfPage) -> List[List[str]] | None:
+    """
+    Cells of the ruled table on a page, read in one pass over pdfium's characters:
+    each character goes to the cell of the grid its box falls in. None when the
+    page has no grid to go by.
+    """
+    xs, ys = _page_rules(page)
+    if len(xs) < 2 or len(ys) < 2:
+        return None
+    textpage = page.get_textpage()
     try:
-        import camelot
-    except Exception:
-        return []
-    results = []
-    for flavor in ("lattice", "stream"):
+        count = textpage.count_chars()
+        text = textpage.get_text_range()
+        if len(text) != count:
+            return None
+        cells: Dict[Tuple[int, int], List[str]] = {}
+        current = None
+        left, right, bottom, top = (ctypes.c_double() for _ in range(4))
+        for i, char in enumerate(text):
+            if char.isspace():
+                # Spaces and line breaks (often generated, without a box) belong to the preceding character's cell
+                if current is not None:
+                    current.append(" ")
+                continue
+            pdfium_c.FPDFText_GetCharBox(textpage.raw, i, left, right, bottom, top)
+            col = bisect_right(xs, (left.value + right.value) / 2) - 1
+            row = len(ys) - 1 - bisect_right(ys, (bottom.value + top.value) / 2)
+            if not 0 <= col < len(xs) - 1 or not 0 <= row < len(ys) - 1:
+                current = None
+                continue
+            current = cells.setdefault((row, col), [])
+            current.append(char)
+    finally:
+        textpage.close()
+
+    rows = {}
+    for (row, col), chars in cells.items():
+        rows.setdefault(row, [""] * (len(xs) - 1))[col] = _normalize("".join(chars))
+    return [rows[row] for row in sorted(rows)]
+
+
+def _plumber_tables(pdf: str | bytes, page_index: int) -> List[List[List[str]]]:
+    """Fallback for a page without a grid pdfium can read: pdfplumber's table finder, for that page only."""
+    import pdfplumber
+    with pdfplumber.open(io.BytesIO(pdf) if isinstance(pdf, bytes) else pdf, pages=[page_index + 1]) as document:
         try:
-            tables = camelot.read_pdf(pdf_path, pages="all", flavor=flavor)
+            return document.pages[0].extract_tables()
         except Exception:
-            tables = []
-        for t in tables:
-            df = t.df.copy()
-            if df.empty:
-                continue
-            headers = df.iloc[0].tolist()
-            name_col = _col_index_from_headers(headers, NAME_KEYWORDS)
-            price_col = _col_index_from_headers(headers, PRICE_KEYWORDS)
-            desc_col = _col_index_from_headers(headers, DESC_KEYWORDS)
-            sing_col = _col_index_from_headers(headers, SINGULAR_KEYWORDS)
-
-            data_rows = df.iloc[1:] if isinstance(name_col, int) and isinstance(price_col, int) else df
-            for _, row in data_rows.iterrows():
-                try:
-                    name = str(row[name_col]).replace('\n', ' ').strip() if name_col is not None else None
-                    price = _clean_price(row[price_col]) if price_col is not None else None
-                    description = str(row[desc_col]).replace('\n', ' ').strip() if desc_col is not None else ""
-                    singular_price = None
-                    if sing_col is not None:
-                        raw = row[sing_col]
-                        singular_price = str(raw).replace('\n', ' ').strip() if raw not in (None, "") else None
-                except Exception:
-                    continue
-
-                if name and price is not None:
-                    full_name = f"{name} - {description}" if description else name
-                    results.append({"name": full_name, "price": price, "singular_price": singular_price})
-        if results:
-            return results
-    return results
-
-def extract_name_price_with_pdfplumber(pdf_path: str) -> List[Dict]:
+            return []
+
+
+def _extract_pages(pdf: str | bytes, start: int, stop: int, layout: TableLayout | None = None):
+    """Products of pages [start, stop), the layout in effect after them and how many pages fell back."""
+    products = []
+    fallbacks = 0
+    document = pdfium.PdfDocument(pdf)
     try:
-        import pdfplumber
-    except Exception:
-        return []
-    results = []
-    with pdfplumber.open(pdf_path) as pdf:
-        for index, page in enumerate(pdf.pages):
+        for page_index in range(start, stop):
+            page = document[page_index]
             try:
-                tables = page.extract_tables()
-            except Exception:
-                tables = []
-            for table in tables:
-                if not table or not any(table):
-                    continue
-                headers = [str(x or "").strip() for x in table[0]]
-                name_col = _col_index_from_headers(headers, NAME_KEYWORDS)
-                price_col = _col_index_from_headers(headers, PRICE_KEYWORDS)
-                desc_col = _col_index_from_headers(headers, DESC_KEYWORDS)
-                sing_col = _col_index_from_headers(headers, SINGULAR_KEYWORDS)
-                start = 1 if (name_col is not None and price_col is not None) else 0
-                for row in table[start:]:
-                    try:
-                        name = str(row[name_col]).strip() if name_col is not None and name_col < len(row) else None
-                        price = _clean_price(row[price_col]) if price_col is not None and price_col < len(row) else None
-                        description = str(row[desc_col]).strip() if desc_col is not None and desc_col < len(row) else ""
-                        singular_price = None
-                        if sing_col is not None and sing_col < len(row):
-                            raw = row[sing_col]
-                            singular_price = str(raw).replace('\n', ' ').strip() if raw not in (None, "") else None
-                    except Exception:
-                        continue
-
-                    if name and price is not None:
-                        name = name.replace('\n', ' ').strip()
-                        description = description.replace('\n', ' ').strip()
-                        full_name = f"{name} - {description}" if description else name
-                        results.append({"name": full_name, "price": price, "singular_price": singular_price})
-    return results
-
-def extract_name_price(pdf_path: str) -> Dict:
+                table = _page_table(page)
+            finally:
+                page.close()
+            page_products, layout = _table_products(table or [], layout)
+            if not page_products:
+                # No grid, or one that didn't read as a price table: this page only goes through pdfplumber
+                fallbacks += 1
+                for rows in _plumber_tables(pdf, page_index):
+                    table_products, layout = _table_products(rows, layout)
+                    page_products.extend(table_products)
+            products.extend(page_products)
+    finally:
+        document.close()
+    return products, layout, fallbacks
+
+
+def _page_ranges(start: int, stop: int, parts: int) -> Iterator[Tuple[int, int]]:
+    size = -(-(stop - start) // parts)
+    for first in range(start, stop, size):
+        yield first, min(first + size, stop)
+
+
+def extract_name_price(pdf: str | bytes, label: str = None, page_workers: int = 1) -> Dict:
+    """
+    Products of a price list PDF, given as a path or as its bytes (label names it in the log),
+    as {name: [price, singular_price, promotion dict or None]}.
+
+    The first page is read here, detecting the layout; with page_workers > 1 the other
+    pages are split into ranges read by that many processes, all with the same layout.
+    """
     start = time.time()
-    rows = extract_name_price_with_camelot(pdf_path)
-    if not rows:
-        rows = extract_name_price_with_pdfplumber(pdf_path)
+    document = pdfium.PdfDocument(pdf)
+    page_count = len(document)
+    document.close()
+
+    products, layout, fallbacks = _extract_pages(pdf, 0, min(1, page_count))
+    if page_workers > 1 and page_count > 2:
+        with ProcessPoolExecutor(max_workers=page_workers) as executor:
+            futures = [
+                executor.submit(_extract_pages, pdf, first, last, layout)
+                for first, last in _page_ranges(1, page_count, page_workers)
+            ]
+            # A range starting mid-table gets the first page's layout; a range's own header rows still win
+            for future in futures:
+                range_products, _, range_fallbacks = future.result()
+                products.extend(range_products)
+                fallbacks += range_fallbacks
+    else:
+        range_products, _, range_fallbacks = _extract_pages(pdf, 1, page_count, layout)
+        products.extend(range_products)
+        fallbacks += range_fallbacks
+
     result = {}
-    for row in rows:
-        result[row["name"]] = [row["price"], row["singular_price"]]
-    print(f"Extracted {len(result)} products from {pdf_path} in {round(time.time() - start, 2)} seconds.")
+    for name, price, singular_price, promotion in products:
+        result[name] = [price, singular_price, promotion]
+    fallback_note = f", {fallbacks} pages via pdfplumber" if fallbacks else ""
+    print(f"Extracted {len(result)} products from {label or (pdf if isinstance(pdf, str) else 'the PDF')} ({page_count} pages{fallback_note}) in {round(time.time() - start, 2)} seconds.")
     return result
 
 # Example usage
 if __name__ == "__main__":
     df = extract_name_price("6.pdf")
     print(f"Found {len(df)} rows")
-    # print(df)
-    # print(df[df["name"].str.contains("КОЛАЧ")])
-    # optionally save:
-    # df.to_csv('products_name_price.csv', index=False, encoding='utf-8-sig')
\ No newline at end of file
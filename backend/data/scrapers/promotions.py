@@ -0,0 +1,66 @@
+"""
+Promotions (discounts) as the stores publish them, saved to the promotions table by
+save_products for the API's deals endpoint.
+
+Dates are ISO strings so a Promotion survives the JSON round trip of the HTTP cache.
+"""
+import re
+from dataclasses import dataclass
+from datetime import date
+from typing import Optional, Tuple
+
+DATE_PATTERN = re.compile(r'(\d{1,2})[./](\d{1,2})[./](\d{4}|\d{2})(?!\d)')
+
+
+@dataclass
+class Promotion:
+    regular_price: int
+    promo_price: int
+    percent: float
+    valid_from: Optional[str] = None
+    valid_to: Optional[str] = None
+
+
+def parse_date(day: str, month: str, year: str) -> Optional[str]:
+    try:
+        return date(int(year) + (2000 if len(year) == 2 else 0), int(month), int(day)).isoformat()
+    except ValueError:
+        return None
+
+
+def first_date(text: Optional[str]) -> Optional[str]:
+    """The first dd.mm.yyyy date in text, as an ISO date."""
+    match = DATE_PATTERN.search(text) if text else None
+    return parse_date(*match.groups()) if match else None
+
+
+def parse_period(period: Optional[str]) -> Tuple[Optional[str], Optional[str]]:
+    """(valid_from, valid_to) of a "dd.mm.yyyy - dd.mm.yyyy" period; a single date is the end date."""
+    if not period:
+        return None, None
+    dates = [parse_date(*match) for match in DATE_PATTERN.findall(str(period))]
+    if not dates:
+        return None, None
+    if len(dates) == 1:
+        return None, dates[0]
+    return dates[0], dates[-1]
+
+
+def make_promotion(regular_price, promo_price, percent: float = None, period: str = None,
+                   valid_from: str = None, valid_to: str = None) -> Optional[Promotion]:
+    """A Promotion when promo_price is an actual discount on regular_price, otherwise None."""
+    if regular_price is None or promo_price is None:
+        return None
+    regular_price, promo_price = int(regular_price), int(promo_price)
+    if not 0 < promo_price < regular_price:
+        return None
+    if percent is None:
+        percent = (regular_price - promo_price) * 100 / regular_price
+    if period is not None:
+        valid_from, valid_to = parse_period(period)
+    return Promotion(regular_price, promo_price, round(float(percent), 1), valid_from, valid_to)
+
+
+def promotion_from_dict(data: Optional[dict]) -> Optional[Promotion]:
+    """Promotion back from its cached (asdict) form."""
+    return Promotion(**data) if data else None
@@ -0,0 +1,254 @@
+"""
+Scraper for the *.proverkanaceni.mk price pages shared by Zito and Stokomak:
+one select of markets (orgs), each listing its products in a paginated table.
+
+Two engines drive the same parsing:
+- "async" (default): one event loop and a FetchQueue for all markets, with a single
+  per-host limit on concurrent requests
+- "threads": a thread pool over markets, each with its own pool over pages
+"""
+import asyncio
+import math
+import time
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
+
+from bs4 import BeautifulSoup
+
+from backend.data.metrics import span
+from backend.data.scrapers.async_engine import AsyncFetcher, FetchQueue
+from backend.data.scrapers.html_tables import extract_rows
+from backend.data.scrapers.scraper_base import DEFAULT_FIELDS, HttpClient, ScrapedProduct, map_concurrently, save_products
+
+ENGINES = ("async", "threads")
+PRICE_TABLE_CLASS = "table table-bordered table-striped table-hover"
+
+
+def market_url(base_url: str, org_id: int) -> str:
+    return f"{base_url}?org={org_id}&search=&perPage=10"
+
+
+def page_url(base_url: str, org_id: int, page_num: int) -> str:
+    return f"{base_url}?page={page_num}&perPage=10000&search=&org={org_id}"
+
+
+def parse_markets(content: bytes) -> List[int]:
+    soup = BeautifulSoup(content, "html.parser")
+    markets_numbers_select = soup.find_all("select", class_="form-select")
+    if not markets_numbers_select:
+        return []
+
+    return [
+        int(option["value"])
+        for option in markets_numbers_select[0].find_all("option")[1:]
+        if option.get("value")
+    ]
+
+
+def parse_product_count(content: bytes, org_id: int) -> Optional[int]:
+    """Number of products in a market, from its first (perPage=10) page."""
+    soup = BeautifulSoup(content, "html.parser")
+    p_tag = soup.find("p")
+    if not p_tag:
+        print(f"Could not find product count for market {org_id}")
+        return None
+
+    try:
+        return int(p_tag.text.strip().split(" ")[-2])
+    except (ValueError, IndexError):
+        print(f"Failed to parse product count for market {org_id}: {p_tag.text.strip()}")
+        return None
+
+
+def parse_rows(content: bytes) -> List[List[str]]:
+    with span("parse"):
+        return extract_rows(content, table_class=PRICE_TABLE_CLASS, tbody=True)
+
+
+def remaining_pages(num_products: int, first_page_rows: int) -> range:
+    """
+    Pages to fetch after page 1, from the page size the site actually served.
+
+    perPage=10000 usually returns a whole market on page 1; deriving the page count
+    from count // 100 requested a dozen empty pages per market on top of it.
+    """
+    if first_page_rows == 0 or first_page_rows >= num_products:
+        return range(0)
+    return range(2, math.ceil(num_products / first_page_rows) + 1)
+
+
+def merge_store_rows(products: Dict[str, ScrapedProduct], rows: List[List[str]], store_bit: int) -> None:
+    """
+    Merge one page of a store into the chain's products.
+
+    Stores of a chain share most of their catalogue, so a row whose product is
+    already known from another store only contributes its stock (to in_stock and the
+    store's bit in store_stock); new products are built from the row as usual. Every
+    store's pages are still downloaded and parsed in full: the site serves the same
+    table whether or not the catalogue is known.
+    """
+    for cols in rows:
+        if len(cols) < 5:
+            continue
+
+        product_name, price, unit_price, category, availability = cols[:5]
+        in_stock = "Да" in availability
+        known = products.get(product_name)
+        if known is not None:
+            if in_stock:
+                known.in_stock = True
+                known.store_stock |= store_bit
+            continue
+
+        # price could be like "0.01 ден", skip products that contain 2 '.' chars
+        if price.count(".") >= 2:
+            print(f"Skipping {product_name}, {price}")
+            continue
+
+        products[product_name] = ScrapedProduct(
+            name=product_name,
+            price=int(price[0:-5]),
+            singular_price=unit_price,
+            description=category,
+            in_stock=in_stock,
+            store_stock=store_bit if in_stock else 0,
+        )
+
+
+def parse_page(content: bytes) -> Dict[str, ScrapedProduct]:
+    """Parse the products table of a single page."""
+    page_products = {}
+    merge_store_rows(page_products, parse_rows(content), 0)
+    return page_products
+
+
+def fetch(client: HttpClient, url: str) -> bytes:
+    resp = client.get(url)
+    resp.raise_for_status()
+    return resp.content
+
+
+def scrape_chain_threads(base_url: str, market_workers: int, page_workers: int, per_host_limit: int) -> Tuple[Dict[str, ScrapedProduct], List[int]]:
+    # Markets × pages threads share one pool, capped per host
+    with HttpClient(pool_size=per_host_limit, per_host_limit=per_host_limit) as client:
+        markets_numbers = parse_markets(fetch(client, base_url))
+        if not markets_numbers:
+            print("Could not find markets select")
+            return {}, []
+
+        print(f"Found {len(markets_numbers)} markets")
+        store_bits = {org_id: 1 << i for i, org_id in enumerate(markets_numbers)}
+        products = {}
+        products_lock = Lock()
+
+        def scrape_market(org_id: int, counts: Dict[int, int]):
+            """Scrape all pages for a given market (org) using threads for pages."""
+            print(f"Scraping market: {org_id}")
+            first_rows = parse_rows(fetch(client, page_url(base_url, org_id, 1)))
+            pages = remaining_pages(counts[org_id], len(first_rows))
+
+            def scrape_page(page_num: int):
+                return parse_rows(fetch(client, page_url(base_url, org_id, page_num)))
+
+            page_rows = [first_rows] + [rows for _, rows in map_concurrently(
+                scrape_page, pages, page_workers, label=f"org {org_id}, page",
+            )]
+            with products_lock:
+                for rows in page_rows:
+                    merge_store_rows(products, rows, store_bits[org_id])
+            print(f"Scraped market {org_id}, rows in this market: {sum(len(rows) for rows in page_rows)}")
+
+        # Product counts first: they give each market's page count
+        counts = {}
+        for org_id, count in map_concurrently(
+            lambda org_id: parse_product_count(fetch(client, market_url(base_url, org_id)), org_id),
+            markets_numbers, market_workers, label="market",
+        ):
+            if count is not None:
+                counts[org_id] = count
+
+        for _ in map_concurrently(lambda org_id: scrape_market(org_id, counts), list(counts), market_workers, label="market"):
+            pass
+    return products, markets_numbers
+
+
+async def scrape_chain_async(base_url: str, per_host_limit: int) -> Tuple[Dict[str, ScrapedProduct], List[int]]:
+    # Pages after the first go ahead of other markets' first pages, so started markets finish
+    MORE_PAGES_PRIORITY, FIRST_PAGE_PRIORITY = 0, 1
+    products = {}
+    counts: Dict[int, int] = {}
+    rows_seen: Dict[int, int] = {}
+    pages_left: Dict[int, int] = {}
+
+    async with AsyncFetcher(per_host_limit=per_host_limit) as fetcher:
+        response = await fetcher.get(base_url)
+        response.raise_for_status()
+        markets_numbers = parse_markets(response.content)
+        if not markets_numbers:
+            print("Could not find markets select")
+            return {}, []
+
+        print(f"Found {len(markets_numbers)} markets")
+        store_bits = {org_id: 1 << i for i, org_id in enumerate(markets_numbers)}
+        queue = FetchQueue(fetcher)
+
+        def on_count(org_id: int):
+            async def handler(response):
+                count = parse_product_count(response.content, org_id)
+                if count is not None:
+                    counts[org_id] = count
+            return handler
+
+        def on_page(org_id: int, page_num: int):
+            async def handler(response):
+                # Parsing is CPU-bound, keep it off the event loop
+                rows = await asyncio.to_thread(parse_rows, response.content)
+                merge_store_rows(products, rows, store_bits[org_id])
+                rows_seen[org_id] += len(rows)
+                if page_num == 1:
+                    pages = remaining_pages(counts[org_id], len(rows))
+                    pages_left[org_id] += len(pages)
+                    for next_page in pages:
+                        queue.put(MORE_PAGES_PRIORITY, page_url(base_url, org_id, next_page), on_page(org_id, next_page))
+                pages_left[org_id] -= 1
+                if pages_left[org_id] == 0:
+                    print(f"Scraped market {org_id}, rows in this market: {rows_seen[org_id]}")
+            return handler
+
+        def start_market(org_id: int):
+            print(f"Scraping market: {org_id}")
+            rows_seen[org_id] = 0
+            pages_left[org_id] = 1
+            queue.put(FIRST_PAGE_PRIORITY, page_url(base_url, org_id, 1), on_page(org_id, 1))
+
+        # Product counts first: they give each market's page count
+        for org_id in markets_numbers:
+            queue.put(FIRST_PAGE_PRIORITY, market_url(base_url, org_id), on_count(org_id))
+        await queue.run()
+
+        for org_id in list(counts):
+            start_market(org_id)
+        await queue.run()
+
+    return products, markets_numbers
+
+
+def save_chain(market_name: str, products: Dict[str, ScrapedProduct], markets_numbers: List[int]):
+    save_products(market_name, products, DEFAULT_FIELDS + ("store_stock",), stores=[str(org_id) for org_id in markets_numbers])
+
+
+def run(base_url: str, market_name: str, market_workers: int, page_workers: int, per_host_limit: int, engine: str = "async"):
+    """Scrape every market of the chain and save the merged products."""
+    start = time.time()
+    if engine == "async":
+        products, markets_numbers = asyncio.run(scrape_chain_async(base_url, per_host_limit))
+    else:
+        products, markets_numbers = scrape_chain_threads(base_url, market_workers, page_workers, per_host_limit)
+    if not products:
+        return
+
+    print(f"Total unique products scraped: {len(products)}")
+    print("Done in ", round(time.time() - start, 2), " seconds")
+
+    save_chain(market_name, products, markets_numbers)
+    print(f"Overall done in {round(time.time() - start, 2)}s")
@@ -0,0 +1,327 @@
+"""
+Shared building blocks for the market scrapers.
+
+- HttpClient: one pooled requests.Session per scraper, sized to its worker count, with
+  retries on transient statuses and a cap on concurrent requests per host; with an
+  HttpCache it fetches conditionally and reuses the parse of unchanged pages
+- ScrapedProduct: the uniform record every scraper produces
+- merge_products / map_concurrently: the merge and thread-pool boilerplate
+- save_products: the standard path into the products table (and the promotions table)
+"""
+import contextvars
+import html
+import json
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from backend.data.db_utils import connect_to_db, ensure_schema, get_products_by_market, save_market_stores, save_products_to_products_table, save_promotions
+from backend.data.metrics import count, span
+from backend.data.scrapers.http_cache import CacheEntry, HttpCache, content_hash
+from backend.data.scrapers.promotions import Promotion
+
+DEFAULT_HEADERS = {"User-Agent": "Mozilla/5.0"}
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+@dataclass
+class ConditionalResponse:
+    key: str
+    url: str
+    response: requests.Response
+    entry: Optional[CacheEntry]  # What the cache held for the key before this fetch
+    changed: bool
+
+    @property
+    def status_code(self) -> int:
+        return self.response.status_code
+
+    @property
+    def content(self) -> bytes:
+        return self.response.content
+
+    @property
+    def cached(self):
+        """Stored parse result of an unchanged page."""
+        return self.entry.parsed if self.entry else None
+
+
+class HttpClient:
+    """
+    requests.Session with a connection pool sized to the scraper's worker count.
+
+    Connections are kept alive and reused across workers instead of opening one per
+    request, idempotent requests are retried with backoff on connection errors and
+    RETRY_STATUSES (honouring Retry-After), and at most `per_host_limit` requests run
+    against a single host at once no matter how many threads share the client.
+    """
+
+    def __init__(self, pool_size: int = 10, per_host_limit: int = None, retries: int = 3,
+                 backoff_factor: float = 0.5, timeout: float = 30, headers: dict = None,
+                 cache: HttpCache = None):
+        self.timeout = timeout
+        self.cache = cache
+        self.pages_changed = 0
+        self.pages_unchanged = 0
+        self.per_host_limit = per_host_limit or pool_size
+        self.session = requests.Session()
+        self.session.headers.update(headers or DEFAULT_HEADERS)
+
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=frozenset({"GET", "HEAD"}),
+            respect_retry_after_header=True,
+            raise_on_status=False,  # Hand the last response back so callers can raise_for_status()
+        )
+        adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=max(pool_size, self.per_host_limit),
+            max_retries=retry,
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self._host_slots = {}
+        self._host_slots_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+
+    def _slots(self, url: str) -> threading.BoundedSemaphore:
+        host = urlsplit(url).netloc
+        with self._host_slots_lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self.per_host_limit)
+            return self._host_slots[host]
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        with self._slots(url), span("http.fetch", host=urlsplit(url).netloc) as attributes:
+            response = self.session.get(url, **kwargs)
+            attributes["status"] = response.status_code
+        count("http.bytes", len(response.content))
+        return response
+
+    def get_json(self, url: str, **kwargs):
+        """GET a JSON endpoint, tolerating PHP warnings printed before the body (WordPress)."""
+        response = self.get(url, **kwargs)
+        response.raise_for_status()
+        return parse_json_body(response.text), response
+
+    def get_conditional(self, url: str, key: str = None, **kwargs) -> ConditionalResponse:
+        """
+        GET url with the validators cached under key (default: the url).
+
+        The page counts as unchanged on a 304, or on a 200 whose body hashes like the
+        cached one (servers without validators, or a new url for the same document,
+        e.g. a dated PDF under a stable key). Unchanged pages are re-staged in the
+        cache; for changed ones call remember() with their parse result.
+        """
+        key = key or url
+        entry = self.cache.lookup(key) if self.cache else None
+        headers = dict(kwargs.pop("headers", None) or {})
+        if entry and entry.url == url:
+            if entry.etag:
+                headers["If-None-Match"] = entry.etag
+            if entry.last_modified:
+                headers["If-Modified-Since"] = entry.last_modified
+        response = self.get(url, headers=headers, **kwargs)
+
+        changed = True
+        if entry and response.status_code == 304:
+            changed = False
+        elif entry and response.status_code == 200 and content_hash(response.content) == entry.content_hash:
+            changed = False
+        result = ConditionalResponse(key, url, response, entry, changed)
+
+        if not changed:
+            self.cache.store(key, CacheEntry(
+                url,
+                response.headers.get("ETag") or (entry.etag if entry.url == url else None),
+                response.headers.get("Last-Modified") or (entry.last_modified if entry.url == url else None),
+                entry.content_hash,
+                entry.parsed,
+            ))
+        with self._stats_lock:
+            if not changed:
+                self.pages_unchanged += 1
+                count("http.pages_unchanged")
+            elif response.status_code == 200 or entry is not None:
+                # A page that used to be there and now fails or is gone counts as a change too
+                self.pages_changed += 1
+                count("http.pages_changed")
+        return result
+
+    def remember(self, result: ConditionalResponse, parsed):
+        """Cache the parse result of a changed page (must be JSON-serializable)."""
+        if self.cache is None:
+            return
+        self.cache.store(result.key, CacheEntry(
+            result.url,
+            result.response.headers.get("ETag"),
+            result.response.headers.get("Last-Modified"),
+            content_hash(result.response.content),
+            parsed,
+        ))
+
+    def get_cached(self, url: str, parse: Callable[[bytes], object], key: str = None, missing_ok: bool = False, **kwargs):
+        """
+        Parsed content of url, reusing the cached parse when the page is unchanged.
+        Returns None for a 404 when missing_ok.
+        """
+        result = self.get_conditional(url, key, **kwargs)
+        if missing_ok and result.status_code == 404:
+            return None
+        if not result.changed:
+            return result.cached
+        result.response.raise_for_status()
+        with span("parse", url=url):
+            parsed = parse(result.content)
+        self.remember(result, parsed)
+        return parsed
+
+    def nothing_changed(self) -> bool:
+        """True when every page fetched conditionally came back unchanged."""
+        return self.pages_changed == 0 and self.pages_unchanged > 0
+
+    def commit_cache(self):
+        """Persist the staged cache entries; call once the run's products are saved."""
+        if self.cache:
+            print(f"HTTP cache: {self.pages_unchanged} unchanged, {self.pages_changed} changed pages")
+            self.cache.commit()
+
+    def close(self):
+        self.session.close()
+        if self.cache:
+            self.cache.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def parse_json_body(raw: str):
+    json_start = min(
+        raw.index('{') if '{' in raw else len(raw),
+        raw.index('[') if '[' in raw else len(raw),
+    )
+    return json.loads(raw[json_start:])
+
+
+@dataclass
+class ScrapedProduct:
+    name: str
+    price: int
+    singular_price: Optional[str] = None
+    description: Optional[str] = None
+    image: Optional[str] = None
+    link: Optional[str] = None
+    in_stock: bool = True
+    # Bit i set = in stock at the scraper's i-th store (see save_products' stores)
+    store_stock: int = 0
+    # Price at the scraper's i-th store, None where it isn't listed (see store_prices.StorePriceMatrix)
+    store_prices: Optional[List[Optional[int]]] = None
+    # The discount behind `price`, when the store publishes one
+    promotion: Optional[Promotion] = None
+
+
+# Columns written by save_products unless a scraper passes its own; every row of an
+# upsert must have the same columns, so optional ones a scraper never fills stay out
+DEFAULT_FIELDS = ("price", "singular_price", "description", "in_stock")
+
+
+def merge_products(dest: Dict[str, ScrapedProduct], new: Iterable[ScrapedProduct]) -> None:
+    """First price seen for a name wins; a product in stock anywhere is in stock."""
+    for product in new:
+        existing = dest.get(product.name)
+        if existing is None:
+            dest[product.name] = product
+        elif product.in_stock:
+            existing.in_stock = True
+            existing.store_stock |= product.store_stock
+
+
+def map_concurrently(fn: Callable, items: Iterable, max_workers: int, label: str = "item") -> Iterator[Tuple[object, object]]:
+    """
+    Run fn over items in a thread pool, yielding (item, result) as each finishes.
+    Failures are printed and skipped, like the per-page try/except in every scraper.
+    The workers run in a copy of the caller's context, so they record into its metrics.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(contextvars.copy_context().run, fn, item): item for item in items}
+        for future in as_completed(futures):
+            item = futures[future]
+            try:
+                yield item, future.result()
+            except Exception as e:
+                print(f"Error scraping {label} {item}: {e}")
+
+
+def stock_bitmap(store_stock: int) -> bytes:
+    """store_stock as little-endian bytes: bit i of the bitmap is the market's i-th store."""
+    return store_stock.to_bytes(max(1, (store_stock.bit_length() + 7) // 8), "little")
+
+
+def save_products(market: str, products: Dict[str, ScrapedProduct], fields: Iterable[str] = DEFAULT_FIELDS,
+                  stores: List[str] = None, upsert: Iterable[str] = None, mark_missing: bool = True) -> None:
+    """
+    Upsert scraped products (keeping existing ids) and mark the rest of the market out of stock.
+
+    With "store_stock" / "store_prices" in fields, `stores` lists the store ids behind
+    the bitmap's bits and the prices array and is saved to market_stores. `upsert` limits the upsert to those names (e.g. the
+    products of changed pages) while out-of-stock marking still uses all of `products`;
+    mark_missing=False skips the marking, for partial scrapes.
+
+    Promotions of all `products` are saved too, after the products they point to; ended
+    ones are removed (only for the upserted products when mark_missing is False).
+    """
+    db = connect_to_db()
+    ensure_schema(db)
+    if stores is not None:
+        save_market_stores(db, market, stores)
+    existing_products = get_products_by_market(db, market)
+    now = datetime.now()
+
+    products_to_upsert = []
+    upserted_ids = {}
+    names = products.keys() if upsert is None else upsert
+    for name in names:
+        product = products[name]
+        existing_id = existing_products.get((html.unescape(name), market))
+        row = {
+            'id': existing_id if existing_id else str(uuid.uuid4()),
+            'name': name,
+        }
+        upserted_ids[name] = row['id']
+        for field in fields:
+            row[field] = getattr(product, field)
+        if 'store_stock' in row:
+            row['store_stock'] = stock_bitmap(row['store_stock'])
+        row.update({
+            'market': market,
+            'ETL_loadtime': now,
+            'last_updated': now
+        })
+        products_to_upsert.append(row)
+
+    save_products_to_products_table(db, market, products_to_upsert, set(products.keys()), mark_missing)
+
+    promotions = []
+    for name, product in products.items():
+        product_id = upserted_ids.get(name) or existing_products.get((html.unescape(name), market))
+        if product.promotion is None or product_id is None:
+            continue
+        promotions.append({'product_id': product_id, 'market': market, **asdict(product.promotion), 'updated_at': now})
+    save_promotions(db, market, promotions, list(upserted_ids.values()), replace=mark_missing)
+    db.close()
+
@@ -0,0 +1,95 @@
+"""
+Per-store prices of a chain whose stores list prices separately (Kam PDFs, Ramstore tables).
+
+StorePriceMatrix keeps one row per product and one column per store in flat arrays,
+filled as each store's list comes in, whatever the order. The chain-level product
+(price, stock, details) is derived from the whole matrix at the end, so it no longer
+depends on which store happened to finish first or last.
+"""
+from array import array
+from dataclasses import replace
+from typing import Dict, Iterable, List, Sequence
+
+import numpy as np
+
+from backend.data.scrapers.scraper_base import ScrapedProduct
+
+# Price of a product a store doesn't list
+MISSING = -1
+CHAIN_PRICES = ("median", "min")
+
+
+class StorePriceMatrix:
+    def __init__(self, stores: Sequence[str]):
+        self.stores = list(stores)
+        self._rows: Dict[str, int] = {}
+        self._prices = array("i")
+        self._stock = array("b")
+        # Details (unit price, description, ...) come from the first store, in store order, that lists the product
+        self._details: List[ScrapedProduct] = []
+        self._details_store = array("i")
+        self._empty_prices = array("i", [MISSING] * len(self.stores))
+        self._empty_stock = array("b", [0] * len(self.stores))
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def add(self, store: int, product: ScrapedProduct) -> None:
+        """Record a product of the store with index `store`; a name listed twice by a store keeps its lower price."""
+        row = self._rows.get(product.name)
+        if row is None:
+            row = self._rows[product.name] = len(self._details)
+            self._prices.extend(self._empty_prices)
+            self._stock.extend(self._empty_stock)
+            self._details.append(product)
+            self._details_store.append(store)
+        elif store < self._details_store[row]:
+            self._details[row] = product
+            self._details_store[row] = store
+
+        cell = row * len(self.stores) + store
+        if self._prices[cell] == MISSING or product.price < self._prices[cell]:
+            self._prices[cell] = product.price
+        if product.in_stock:
+            self._stock[cell] = 1
+
+    def add_store(self, store: int, products: Iterable[ScrapedProduct]) -> None:
+        for product in products:
+            self.add(store, product)
+
+    def chain_products(self, chain_price: str = "median") -> Dict[str, ScrapedProduct]:
+        """
+        One product per name for the whole chain: its price is the median (the lower
+        one for an even count, so always a price some store charges) or the minimum
+        over the stores listing it, it's in stock if any store has it, and store_stock /
+        store_prices hold the per-store stock bits and prices in store order. The details'
+        promotion is kept only when its promo price is the chain price.
+        """
+        if not self._rows:
+            return {}
+        prices = np.frombuffer(self._prices, dtype=np.int32).reshape(len(self._rows), len(self.stores))
+        listed = prices != MISSING
+        stock = np.frombuffer(self._stock, dtype=np.int8).reshape(prices.shape).astype(bool) & listed
+        masked = np.where(listed, prices, np.nan)
+        if chain_price == "min":
+            chain = np.nanmin(masked, axis=1)
+        else:
+            chain = np.nanpercentile(masked, 50, axis=1, method="lower")
+        stock_bits = np.packbits(stock, axis=1, bitorder="little")
+
+        products = {}
+        for name, row in self._rows.items():
+            details = self._details[row]
+            promotion = details.promotion
+            if promotion is not None and promotion.promo_price != int(chain[row]):
+                # The details' store runs a promotion the chain price doesn't reflect
+                promotion = None
+            products[name] = replace(
+                details,
+                price=int(chain[row]),
+                promotion=promotion,
+                in_stock=bool(stock[row].any()),
+                store_stock=int.from_bytes(stock_bits[row].tobytes(), "little"),
+                store_prices=[int(price) if price != MISSING else None for price in prices[row]],
+            )
+        return products
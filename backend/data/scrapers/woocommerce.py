@@ -0,0 +1,205 @@
+"""
+Scraper for shops exposing the WooCommerce Store API (Bigshop, Reptil):
+paginated /wp-json/wc/store/v1/products with the page count in X-WP-TotalPages.
+
+Sync modes:
+- "full" (default): every page is requested, conditionally; unchanged pages reuse
+  last run's parse and only products of changed pages are upserted, while
+  out-of-stock marking still sees the whole catalogue
+- "incremental": only products modified since the last sync are requested
+  (date_column=modified_gmt&after=...) and upserted, nothing is marked out of
+  stock. Removed products and stock changes that don't touch the modified date
+  are only picked up by the full sync it falls back to every FULL_SYNC_EVERY,
+  or when the shop rejects or ignores the filter.
+"""
+import json
+import time
+from dataclasses import asdict
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+import requests
+
+from backend.data.metrics import span
+from backend.data.scrapers.http_cache import DEFAULT_PATH as CACHE_PATH, default_cache
+from backend.data.scrapers.promotions import Promotion, make_promotion, promotion_from_dict
+from backend.data.scrapers.scraper_base import HttpClient, ScrapedProduct, map_concurrently, merge_products, parse_json_body, save_products
+
+PER_PAGE = 100
+FIELDS = ("price", "image", "link", "singular_price", "description", "in_stock")
+SYNC_MODES = ("full", "incremental")
+
+# Bump when the parse_product functions' output changes, so cached pages are parsed again
+PARSE_VERSION = 2
+
+SYNC_STATE_PATH = CACHE_PATH.parent / "woocommerce_sync.json"
+FULL_SYNC_EVERY = timedelta(days=7)
+# Incremental syncs ask for a little more than the time since the last one, for clock skew
+SYNC_OVERLAP = timedelta(minutes=30)
+
+
+def parse_price(price_str: str, minor_unit: int) -> int:
+    """Convert API price string (e.g. '3200') to display integer (e.g. 32)"""
+    try:
+        return int(price_str) // (10 ** minor_unit)
+    except (ValueError, TypeError):
+        return 0
+
+
+def sale_promotion(prices: dict, minor_unit: int) -> Optional[Promotion]:
+    """The sale behind 'price', when the API reports a higher 'regular_price' (the Store API has no sale dates)."""
+    return make_promotion(parse_price(prices.get('regular_price'), minor_unit), parse_price(prices.get('price'), minor_unit))
+
+
+def cached_product(product: dict) -> ScrapedProduct:
+    return ScrapedProduct(**{**product, "promotion": promotion_from_dict(product.get("promotion"))})
+
+
+def load_sync_state(path: Path = SYNC_STATE_PATH) -> dict:
+    if not path.exists():
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_sync_state(state: dict, path: Path = SYNC_STATE_PATH):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=2)
+
+
+def fetch_page(client: HttpClient, url: str, parse_product: Callable[[dict], ScrapedProduct],
+               key: str = None) -> Tuple[List[ScrapedProduct], dict, bool]:
+    """
+    Products of one API page, its totals and whether it changed since last run.
+    Unchanged pages (304 or same body) reuse the products parsed last run.
+    """
+    result = client.get_conditional(url, f"{key or url}#parse-v{PARSE_VERSION}")
+    if result.changed:
+        result.response.raise_for_status()
+        with span("parse", url=url):
+            page = {
+                "total_pages": int(result.response.headers.get('X-WP-TotalPages', 1)),
+                "total": int(result.response.headers.get('X-WP-Total', 0)),
+                "products": [asdict(parse_product(item)) for item in parse_json_body(result.response.text)],
+            }
+        client.remember(result, page)
+    else:
+        page = result.cached
+    return [cached_product(product) for product in page["products"]], page, result.changed
+
+
+def scrape_pages(client: HttpClient, url: str, parse_product: Callable[[dict], ScrapedProduct], max_workers: int,
+                 key: str = None):
+    """
+    Every page of a product listing; page 1's response gives the page count and
+    is used as the first page. `key` caches pages of a listing whose url changes
+    between runs under a stable key.
+
+    Returns (products, names on changed pages, total reported by the API, pages that failed).
+    """
+    def page_key(page: int) -> Optional[str]:
+        return f"{key}&page={page}" if key else None
+
+    first_products, first_page, first_changed = fetch_page(client, f"{url}&page=1", parse_product, page_key(1))
+    total_pages = first_page["total_pages"]
+    print(f"Total pages to scrape: {total_pages}")
+
+    all_products = {}
+    changed_names = set()
+    merge_products(all_products, first_products)
+    if first_changed:
+        changed_names.update(p.name for p in first_products)
+
+    fetched = 1
+    for _, (items, _, changed) in map_concurrently(
+        lambda page: fetch_page(client, f"{url}&page={page}", parse_product, page_key(page)),
+        range(2, total_pages + 1), max_workers, label="page",
+    ):
+        fetched += 1
+        merge_products(all_products, items)
+        if changed:
+            changed_names.update(p.name for p in items)
+    return all_products, changed_names, first_page["total"], total_pages - fetched
+
+
+def sync_mode(market_name: str, requested: str, state: dict) -> str:
+    if requested != "incremental":
+        return "full"
+    last_full = state.get(market_name, {}).get("last_full_sync")
+    if not last_full or datetime.fromisoformat(last_full) < datetime.now(timezone.utc) - FULL_SYNC_EVERY:
+        print("No recent full sync, running a full sync")
+        return "full"
+    return "incremental"
+
+
+def scrape_modified(client: HttpClient, listing: str, market_state: dict, parse_product: Callable[[dict], ScrapedProduct],
+                    max_workers: int):
+    """
+    Products modified since the last sync, as (scrape_pages result, mode).
+    Falls back to "full": with no result when the shop rejects the filter, or with
+    the whole catalogue as changed when it ignores it and lists everything.
+    """
+    since = datetime.fromisoformat(market_state["last_sync"]) - SYNC_OVERLAP
+    try:
+        scraped = scrape_pages(
+            client, f"{listing}&date_column=modified_gmt&after={since.strftime('%Y-%m-%dT%H:%M:%S')}",
+            parse_product, max_workers, key=f"{listing}&modified",
+        )
+    except requests.HTTPError as e:
+        print(f"Modified filter rejected ({e}), running a full sync")
+        return None, "full"
+
+    products, _, total, failed = scraped
+    if total and total >= market_state.get("total", 0):
+        print("Modified filter ignored by the shop, treating as a full sync")
+        return (products, set(products), total, failed), "full"
+    print(f"Products modified since {since.isoformat(timespec='minutes')}: {len(products)}")
+    return scraped, "incremental"
+
+
+def run(base_url: str, market_name: str, parse_product: Callable[[dict], ScrapedProduct], max_workers: int,
+        mode: str = "full") -> Dict[str, ScrapedProduct]:
+    """Fetch the store API pages (all, or modified ones), parse each item with parse_product and save."""
+    start = time.time()
+    started_at = datetime.now(timezone.utc).isoformat()
+    state = load_sync_state()
+    mode = sync_mode(market_name, mode, state)
+    listing = f"{base_url}?per_page={PER_PAGE}"
+
+    with HttpClient(pool_size=max_workers, timeout=45, cache=default_cache()) as client:
+        scraped = None
+        if mode == "incremental":
+            scraped, mode = scrape_modified(client, listing, state[market_name], parse_product, max_workers)
+        if scraped is None:
+            # Initial request to get total pages, reused as page 1
+            try:
+                scraped = scrape_pages(client, listing, parse_product, max_workers)
+            except Exception as e:
+                print(f"Failed to fetch initial page/metadata: {e}")
+                return {}
+        all_products, changed_names, total, failed = scraped
+
+        print(f"Scraping done in {round(time.time() - start, 2)}s, total products: {len(all_products)}, "
+              f"on changed pages: {len(changed_names)}")
+        if failed:
+            # An incomplete catalogue must not mark the missing pages' products out of stock
+            print(f"{failed} pages failed, not marking missing products out of stock")
+        if mode == "incremental":
+            if all_products:
+                save_products(market_name, all_products, FIELDS, mark_missing=False)
+        elif client.nothing_changed():
+            print("No page changed since the last run, skipping save")
+        else:
+            save_products(market_name, all_products, FIELDS, upsert=changed_names, mark_missing=not failed)
+        client.commit_cache()
+
+    if not failed:
+        market_state = state.setdefault(market_name, {})
+        market_state["last_sync"] = started_at
+        if mode == "full":
+            market_state.update(last_full_sync=started_at, total=total)
+        save_sync_state(state)
+    print(f"Overall done in {round(time.time() - start, 2)}s")
+    return all_products
@@ -1,13 +1,25 @@
+from functools import lru_cache
+from typing import TYPE_CHECKING
+
 import numpy as np
 from cyrtranslit import to_cyrillic
-from langchain_google_genai import GoogleGenerativeAIEmbeddings
+
+if TYPE_CHECKING:
+    from langchain_google_genai import GoogleGenerativeAIEmbeddings
 
 
 def normalize_name(name: str) -> str:
     return ' '.join(sorted(to_cyrillic(name.lower(), 'mk').split(' ')))
 
 
-def get_embeddings_client() -> GoogleGenerativeAIEmbeddings:
+@lru_cache(maxsize=None)
+def get_embeddings_client() -> "GoogleGenerativeAIEmbeddings":
+    """
+    One client per process, shared by the stages run_pipeline runs in-process.
+    langchain (well over a second to import) is only loaded here, so the API starts without it.
+    """
+    from langchain_google_genai import GoogleGenerativeAIEmbeddings
+
     return GoogleGenerativeAIEmbeddings(
         model="models/gemini-embedding-001",
         task_type="semantic_similarity",
@@ -15,6 +27,13 @@ def get_embeddings_client() -> GoogleGenerativeAIEmbeddings:
     )
 
 
+def is_throttling_error(error: BaseException) -> bool:
+    """A Gemini 429, raised by google-genai or wrapped in langchain's GoogleGenerativeAIError."""
+    from google.genai import errors
+
+    return any(isinstance(e, errors.ClientError) and e.code == 429 for e in (error, error.__cause__))
+
+
 def normalize_embedding(embedding: np.ndarray) -> np.ndarray:
     n = np.linalg.norm(embedding)
     if n == 0: